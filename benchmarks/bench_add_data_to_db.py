@@ -0,0 +1,99 @@
+"""Measures how many rows per second add_data_to_db() (see sqlite_fun.py)
+inserts into a new SQLite database. Synthetic entries like the ones created
+by create_data_dict() are used, so no raster files are needed. Each scene
+adds three rows (Scene, Metadata and Geometry).
+
+The data directory in config.py still needs to exist, but the database
+stored there is not touched.
+
+Usage (from the root of the repository):
+    python benchmarks/bench_add_data_to_db.py [n_scenes] [batch_size]
+"""
+
+import os
+import sys
+import json
+import time
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(
+    __file__))))
+
+from config import Ingest
+from flask_app import app, db
+from sqlite_fun import add_data_to_db
+
+
+def create_synthetic_data_dict(n_scenes):
+    """Creates entries in the format of create_data_dict().
+
+    :param n_scenes: Number of scenes. [int]
+
+    :return: Synthetic information. [dict]
+    """
+    date = datetime(2015, 1, 1)
+    data_dict = {}
+    for i in range(n_scenes):
+        ## Dates need to be unique (see Scene.date)
+        d = date + timedelta(hours=i)
+        filename = f"S1A__IW___A_{d.strftime('%Y%m%dT%H%M%S')}_147_VV_" \
+                   f"grd_mli_norm_geo_db.tif"
+        data_dict[os.path.join("bench", filename)] = {
+            "sensor": "S1A",
+            "orbit": "ascending",
+            "date": d,
+            "acquisition_mode": "IW",
+            "polarisation": "VV",
+            "columns": 1000,
+            "rows": 1000,
+            "epsg": "32629",
+            "bounds_south": 4100000.0,
+            "bounds_north": 4110000.0,
+            "bounds_west": 700000.0,
+            "bounds_east": 710000.0,
+            "resolution": 10,
+            "nodata_val": -99,
+            "band_min": -25.0,
+            "band_max": 5.0,
+            "stats_mode": "stored",
+            "fingerprint": (1000000, 1590000000.0 + i, None)}
+
+    return data_dict
+
+
+def main(n_scenes=10000, batch_size=None):
+
+    if batch_size is None:
+        batch_size = Ingest.batch_size
+
+    ## Use a temporary database
+    tmp_dir = tempfile.mkdtemp()
+    app.config['SQLALCHEMY_DATABASE_URI'] = \
+        'sqlite:///' + os.path.join(tmp_dir, 'bench.db')
+
+    data_dict = create_synthetic_data_dict(n_scenes)
+
+    with app.app_context():
+        db.create_all()
+
+        start = time.perf_counter()
+        add_data_to_db(data_dict, batch_size=batch_size)
+        seconds = time.perf_counter() - start
+
+    rows = n_scenes * 3
+    result = {"benchmark": "add_data_to_db",
+              "scenes": n_scenes,
+              "batch_size": batch_size,
+              "rows": rows,
+              "seconds": round(seconds, 3),
+              "rows_per_second": round(rows / seconds, 1)}
+
+    print(json.dumps(result))
+
+    return result
+
+
+if __name__ == '__main__':
+    args = [int(a) for a in sys.argv[1:3]]
+    main(*args)
@@ -0,0 +1,174 @@
+"""Measures how the stages of the pipeline scale with the number of scenes.
+For each scene count, a synthetic dataset is written to a temporary
+directory (see generate_dataset.py) and the webapp's workflow is run on it
+in a separate process and a temporary working directory (the data
+directory is set with S1GRASS_DATA_DIR, see config.py):
+
+- db_main() (stages 'scan', 'extract' and 'database')
+- grass_main() (stages 'accumulate', 'import', 'cube' and 'mean')
+- create_avg_raster() on its own
+- get_timeseries() at random points of the average raster
+
+The results are printed and written as JSON, including the git revision,
+so runs of different revisions can be compared.
+
+Usage (from the root of the repository):
+    python benchmarks/bench_pipeline.py [output.json] [n_scenes,...] [size]
+        [nodata_fraction] [epsg,epsg,...]
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import platform
+import tempfile
+import subprocess
+import numpy as np
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from benchmarks.generate_dataset import generate_dataset
+
+## Number of random points at which time series are extracted
+N_POINTS = 100
+
+
+def main(output='bench_pipeline.json', scene_counts=(10, 100, 1000),
+         size=256, nodata_fraction=0.1, epsg_codes=(32629,)):
+
+    parameters = {"scene_counts": list(scene_counts),
+                  "size": size,
+                  "nodata_fraction": nodata_fraction,
+                  "epsg_codes": list(epsg_codes),
+                  "points": N_POINTS}
+    results = []
+    for n_scenes in scene_counts:
+        tmp_dir = tempfile.mkdtemp()
+        work_dir = tempfile.mkdtemp()
+        try:
+            generate_dataset(tmp_dir, n_scenes=n_scenes, size=size,
+                             nodata_fraction=nodata_fraction,
+                             epsg_codes=epsg_codes)
+
+            ## config.py reads the data directory when it's imported, so
+            ## each dataset is processed by a new process. It runs in an
+            ## empty working directory, so nothing is written to the
+            ## repository (e.g. files relative to the working directory).
+            env = dict(os.environ, S1GRASS_DATA_DIR=tmp_dir)
+            out = subprocess.run([sys.executable, os.path.abspath(__file__),
+                                  '--run'], env=env, cwd=work_dir, check=True,
+                                 stdout=subprocess.PIPE,
+                                 universal_newlines=True).stdout
+            result = json.loads(out.strip().splitlines()[-1])
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+            shutil.rmtree(work_dir, ignore_errors=True)
+
+        result["scenes"] = n_scenes
+        results.append(result)
+        print(json.dumps(result))
+
+    report = {"benchmark": "pipeline",
+              "revision": _get_revision(),
+              "created": datetime.utcnow().isoformat(),
+              "python": platform.python_version(),
+              "platform": platform.platform(),
+              "cpu_count": os.cpu_count(),
+              "parameters": parameters,
+              "results": results}
+
+    with open(output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"~~ Results written to {os.path.abspath(output)}")
+
+    return report
+
+
+def run_stages():
+    """Runs the pipeline on the data directory set in config.py and prints
+    the duration of each stage as JSON (last line of the output).
+    """
+    from flask_app import app
+    from config import Grass
+    from sqlite_fun import db_main
+    from grass_fun import grass_main, create_avg_raster, get_timeseries
+    from progress_fun import IngestProgress
+    from osgeo import gdal
+
+    timings = {}
+    progress = IngestProgress()
+    with app.app_context():
+        start = time.perf_counter()
+        added, changed, removed, epsg = db_main(progress=progress)
+        timings["db_main"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        grass_main(added, changed, removed, epsg, progress=progress)
+        timings["grass_main"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        create_avg_raster()
+        timings["create_avg_raster"] = time.perf_counter() - start
+
+        ## Random points within the average raster
+        data = gdal.Open(os.path.join(Grass.path_out, 'avg_raster.tif'))
+        ulx, xres, _, uly, _, yres = data.GetGeoTransform()
+        cols, rows = data.RasterXSize, data.RasterYSize
+        data = None
+
+        rng = np.random.default_rng(0)
+        latencies = []
+        for col, row in zip(rng.uniform(0, cols, N_POINTS),
+                            rng.uniform(0, rows, N_POINTS)):
+            coordinate = f"{ulx + col * xres},{uly + row * yres}"
+            start = time.perf_counter()
+            get_timeseries(coordinate, projection=epsg)
+            latencies.append(time.perf_counter() - start)
+
+    stages = progress.to_dict()['stages']
+    result = {"seconds": {k: round(v, 3) for k, v in timings.items()},
+              "stages": {name: {"seconds": s["seconds"],
+                                "scenes_per_second": s["scenes_per_second"],
+                                "mb_per_second": s["mb_per_second"]}
+                         for name, s in stages.items()},
+              "point_query_ms": {
+                  "p50": round(1000 * float(np.percentile(latencies, 50)), 2),
+                  "p95": round(1000 * float(np.percentile(latencies, 95)), 2),
+                  "max": round(1000 * max(latencies), 2)}}
+
+    print(json.dumps(result))
+
+    return result
+
+
+def _get_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT,
+                              check=True, stdout=subprocess.PIPE,
+                              universal_newlines=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+if __name__ == '__main__':
+    if sys.argv[1:2] == ['--run']:
+        run_stages()
+        sys.exit(0)
+
+    args = sys.argv[1:]
+    kwargs = {}
+    if len(args) > 0:
+        kwargs['output'] = args[0]
+    if len(args) > 1:
+        kwargs['scene_counts'] = [int(n) for n in args[1].split(',')]
+    if len(args) > 2:
+        kwargs['size'] = int(args[2])
+    if len(args) > 3:
+        kwargs['nodata_fraction'] = float(args[3])
+    if len(args) > 4:
+        kwargs['epsg_codes'] = [int(e) for e in args[4].split(',')]
+    main(**kwargs)
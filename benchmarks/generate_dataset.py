@@ -0,0 +1,125 @@
+"""Writes a synthetic dataset of GeoTIFF files named after pyroSAR's file
+naming scheme (see _get_filename_info() in sqlite_fun.py), so the whole
+pipeline can be run without real Sentinel-1 scenes. The scenes overlap
+around a common center, contain backscatter-like values in dB and can be
+split across multiple CRSs.
+
+Usage (from the root of the repository):
+    python benchmarks/generate_dataset.py <path> [n_scenes] [size]
+        [nodata_fraction] [epsg,epsg,...]
+"""
+
+import os
+import sys
+import numpy as np
+from datetime import datetime, timedelta
+from osgeo import gdal, osr
+gdal.UseExceptions()
+
+## Center of the scenes (longitude, latitude) and pixel size in meters
+CENTER = (-6.4, 37.0)
+RESOLUTION = 20
+NODATA = -99
+
+
+def generate_dataset(path, n_scenes=10, size=256, nodata_fraction=0.1,
+                     epsg_codes=(32629,), seed=0):
+    """Writes synthetic scenes to a directory.
+
+    :param path: Full path of the output directory. It's created if it
+        doesn't exist. [str]
+    :param n_scenes: Number of scenes. [int]
+    :param size: Number of rows and columns of each scene. [int]
+    :param nodata_fraction: Fraction of the pixels of each scene that are
+        set to the nodata value. [float]
+    :param epsg_codes: The scenes are split evenly across these CRSs
+        (projected CRSs in meters). [list]
+    :param seed: Seed of the random values. [int]
+
+    :return: Full paths of the written scenes. [list]
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+
+    rng = np.random.default_rng(seed)
+    driver = gdal.GetDriverByName('GTiff')
+    date = datetime(2018, 1, 1)
+
+    ## Smooth pattern that is shared by all scenes, so time series and
+    ## composites show a structure
+    ys, xs = np.mgrid[0:size, 0:size] / size
+    pattern = -12 + 4 * np.sin(6 * xs) * np.cos(4 * ys)
+
+    paths = []
+    for i in range(n_scenes):
+        epsg = int(epsg_codes[i % len(epsg_codes)])
+        x, y = _get_center(epsg)
+
+        ## Scenes are shifted by a few pixels, so the extents differ
+        shift = rng.integers(-size // 10, size // 10 + 1, 2) * RESOLUTION
+        ulx = x - size * RESOLUTION / 2 + shift[0]
+        uly = y + size * RESOLUTION / 2 + shift[1]
+
+        ## Dates need to be unique (see Scene.date)
+        d = date + timedelta(days=6 * (i // 2), hours=12 * (i % 2))
+        sensor = "S1A_" if i % 4 < 2 else "S1B_"
+        orbit = "A" if i % 2 == 0 else "D"
+        pol = "VV" if i % 3 else "VH"
+        filename = f"{sensor}_IW___{orbit}_{d.strftime('%Y%m%dT%H%M%S')}_" \
+                   f"147_{pol}_grd_mli_norm_geo_db.tif"
+
+        ## Seasonal signal and noise on top of the pattern
+        values = pattern + 3 * np.sin(2 * np.pi * d.timetuple().tm_yday
+                                      / 365) \
+            + rng.normal(0, 1.5, (size, size))
+        values[rng.random((size, size)) < nodata_fraction] = NODATA
+
+        filepath = os.path.join(path, filename)
+        data = driver.Create(filepath, size, size, 1, gdal.GDT_Float32,
+                             options=['TILED=YES', 'COMPRESS=DEFLATE'])
+        data.SetGeoTransform([ulx, RESOLUTION, 0, uly, 0, -RESOLUTION])
+        srs = osr.SpatialReference()
+        srs.ImportFromEPSG(epsg)
+        data.SetProjection(srs.ExportToWkt())
+        band = data.GetRasterBand(1)
+        band.SetNoDataValue(NODATA)
+        band.WriteArray(values.astype(np.float32))
+        band.ComputeStatistics(False)
+        data = None
+
+        paths.append(filepath)
+
+    return paths
+
+
+def _get_center(epsg):
+    ## Transform the center of all scenes to the given CRS
+    source = osr.SpatialReference()
+    source.ImportFromEPSG(4326)
+    source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(epsg)
+    target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    return osr.CoordinateTransformation(source, target). \
+        TransformPoint(*CENTER)[:2]
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    if len(args) == 0:
+        print(__doc__)
+        sys.exit(1)
+
+    kwargs = {}
+    if len(args) > 1:
+        kwargs['n_scenes'] = int(args[1])
+    if len(args) > 2:
+        kwargs['size'] = int(args[2])
+    if len(args) > 3:
+        kwargs['nodata_fraction'] = float(args[3])
+    if len(args) > 4:
+        kwargs['epsg_codes'] = [int(e) for e in args[4].split(',')]
+
+    paths = generate_dataset(args[0], **kwargs)
+    print(f"~~ Wrote {len(paths)} scenes to {os.path.abspath(args[0])}")
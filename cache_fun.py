@@ -0,0 +1,157 @@
+from config import Grass, Cache
+from metrics_fun import cache_requests
+
+from osgeo import gdal
+from collections import OrderedDict
+import os
+import shelve
+import threading
+import numpy as np
+gdal.UseExceptions()
+
+
+class PlotCache(object):
+    """Keeps generated plots in memory, so clicking the same pixel again
+    doesn't extract the timeseries and create the plot again. Plots are
+    stored by the pixel of the common grid and the generation of the
+    dataset (see make_key()), which changes every time scenes are added,
+    changed or removed. The least recently used plots are removed once the
+    cache exceeds its size limit. Optionally, the cache is also stored on
+    disk, so it survives a restart of the webapp.
+    """
+
+    def __init__(self, max_size=None, path=None):
+        if max_size is None:
+            max_size = Cache.max_size * 1024 * 1024
+        if path is None and Cache.persist:
+            path = Cache.path
+
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._size = 0
+        self._generation = None
+        self._shelf = None
+
+        ## Load plots that were stored on disk
+        if path is not None:
+            self._shelf = shelve.open(path)
+            for key in list(self._shelf.keys()):
+                self._add(key, self._shelf[key])
+                self._generation = key.split('/')[0]
+
+    def get(self, key):
+        """Returns a cached plot or None if it isn't cached."""
+        with self.lock:
+            value = self._items.get(key)
+            if value is None:
+                self.misses += 1
+                cache_requests.inc(cache='plot', result='miss')
+                return None
+
+            self._items.move_to_end(key)
+            self.hits += 1
+            cache_requests.inc(cache='plot', result='hit')
+
+            return value
+
+    def put(self, key, value):
+        """Stores a plot in the cache. Plots of older generations of the
+        dataset are removed, because they can't be requested anymore.
+        """
+        generation = key.split('/')[0]
+
+        with self.lock:
+            if generation != self._generation:
+                self._clear()
+                self._generation = generation
+
+            self._add(key, value)
+            if self._shelf is not None:
+                self._shelf[key] = value
+                self._shelf.sync()
+
+    def stats(self):
+        """Returns number of hits, misses and cached plots and the size of
+        the cache in bytes. [dict]
+        """
+        with self.lock:
+            return {'hits': self.hits,
+                    'misses': self.misses,
+                    'items': len(self._items),
+                    'size': self._size}
+
+    def _add(self, key, value):
+        if key in self._items:
+            self._size -= len(self._items.pop(key))
+        self._items[key] = value
+        self._size += len(value)
+
+        ## Remove least recently used plots
+        while self._size > self.max_size and len(self._items) > 1:
+            old_key, old_value = self._items.popitem(last=False)
+            self._size -= len(old_value)
+            if self._shelf is not None:
+                del self._shelf[old_key]
+
+    def _clear(self):
+        self._items.clear()
+        self._size = 0
+        if self._shelf is not None:
+            self._shelf.clear()
+
+
+## Cache that is shared by all requests of the webapp
+plot_cache = PlotCache()
+
+## Geotransform of the common grid, reloaded if avg_raster.tif changes
+_grid = {'mtime': None, 'transform': None}
+
+
+def make_key(coordinate, generation, filters=None):
+    """Creates the key of a plot. Coordinates are snapped to the pixel of
+    the common grid (avg_raster.tif) they are located in, so all
+    coordinates within the same pixel share a key.
+
+    :param coordinate: Output of transform_coord() in grass_fun.py. [str]
+    :param generation: Generation of the dataset (see get_generation() in
+        sqlite_fun.py). [int]
+    :param filters: Filters of the scenes used for the plot (see
+        parse_scene_filters() in sqlite_fun.py). [dict]
+
+    :return: Key of the plot. [str]
+    """
+    x, y = [float(c) for c in coordinate.split(",")]
+
+    transform = _get_grid_transform()
+    if transform is None:
+        ## Without a grid, coordinates are only rounded
+        key = f"{generation}/{round(x, 3)}/{round(y, 3)}"
+    else:
+        ulx, xres, _, uly, _, yres = transform
+        col = int(np.floor((x - ulx) / xres))
+        row = int(np.floor((y - uly) / yres))
+        key = f"{generation}/{col}/{row}"
+
+    if filters:
+        key += "/" + "&".join(f"{k}={v}" for k, v in sorted(filters.items()))
+
+    return key
+
+
+def _get_grid_transform():
+    path = os.path.join(Grass.path_out, 'avg_raster.tif')
+    try:
+        mtime = os.stat(path).st_mtime_ns
+    except OSError:
+        return None
+
+    if _grid['mtime'] != mtime:
+        data = gdal.Open(path)
+        _grid['transform'] = data.GetGeoTransform()
+        _grid['mtime'] = mtime
+        data = None
+
+    return _grid['transform']
@@ -0,0 +1,463 @@
+from config import Composite
+from flask_app import db
+from flask_app.models import Scene, Metadata
+from sqlite_fun import apply_scene_filters
+from tile_fun import VIRIDIS
+from gdal_fun import get_srs
+from progress_fun import IngestProgress
+
+from osgeo import gdal
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import OrderedDict
+from datetime import date, timedelta
+import os
+import re
+import threading
+import multiprocessing
+import numpy as np
+gdal.UseExceptions()
+
+## Statistics that can be computed across the scenes of each pixel. In
+## addition, percentiles can be requested as 'p' followed by a number
+## between 0 and 100 (e.g. 'p10' or 'p90').
+REDUCERS = {'mean': np.nanmean,
+            'median': np.nanmedian,
+            'std': np.nanstd,
+            'min': np.nanmin,
+            'max': np.nanmax}
+
+## Names of the seasons by the month they start with
+SEASONS = {12: 'DJF', 3: 'MAM', 6: 'JJA', 9: 'SON'}
+
+## Methods of change detection (see create_change_raster()). Values are
+## expected in dB, so the log-ratio is computed from the mean of each window
+## in linear power.
+CHANGE_METHODS = ('log_ratio', 'difference')
+
+## Scenes, grid and method of a worker process of
+## create_change_raster() (see _init_change_worker())
+_change_worker = {}
+
+## Options of the exported GeoTIFF (the same as in create_stat_raster() of
+## grass_fun.py)
+CREATE_OPTIONS = ['TILED=YES', 'COMPRESS=DEFLATE']
+OVERVIEW_LEVELS = [2, 4, 8, 16, 32]
+
+
+def create_composite_raster(stat, out_path, grid, filters=None,
+                            progress=None, scenes=None):
+    """Alternative to the GRASS workflow of create_stat_raster() in
+    grass_fun.py. All scenes are warped onto the common grid and read in
+    aligned blocks (see Composite.block_size), so only the values of one
+    block of all scenes are kept in memory per thread. The statistic of each
+    block is computed with NumPy by a pool of threads and written to a
+    temporary float raster, so the scenes are only read once. The float
+    raster is then rescaled from the range of the result to 1-255 and
+    exported with a histogram-equalized viridis color table (like r.rescale
+    and r.colors -e in GRASS).
+
+    Each thread warps every scene once and keeps the warped VRTs for all of
+    its blocks, so Composite.workers times the number of scenes files are
+    open while the composite is computed.
+
+    :param stat: 'mean', 'median', 'std', 'min', 'max' or a percentile like
+        'p90'. [str]
+    :param out_path: Full path of the output GeoTIFF. [str]
+    :param grid: Common grid of the GRASS project (see get_common_grid() in
+        grass_fun.py). [dict]
+    :param filters: Only use scenes matching these filters (see
+        parse_scene_filters() in sqlite_fun.py). [dict]
+    :param progress: Keeps track of the progress (see IngestProgress in
+        progress_fun.py). [IngestProgress]
+    :param scenes: Filepath and nodata value of the scenes to use instead
+        of the scenes in the database (e.g. of an ingestion that isn't
+        published yet, see grass_main() in grass_fun.py). [list]
+
+    :returns: GeoTIFF at out_path
+    """
+    if progress is None:
+        progress = IngestProgress()
+    reducer = get_reducer(stat)
+
+    ## Get filepath and nodata value of the scenes
+    if scenes is None:
+        query = db.session.query(Scene.filepath, Metadata.nodata). \
+            join(Metadata, Metadata.scene_id == Scene.id)
+        scenes = apply_scene_filters(query, filters). \
+            order_by(Scene.date).all()
+    if len(scenes) == 0:
+        raise ValueError("No scenes match the filters.")
+
+    print(f"~~ Creating {stat} raster from {len(scenes)} scenes...")
+
+    blocks = _get_blocks(grid, Composite.block_size)
+    progress.start('composite', total=len(blocks))
+
+    ## The float raster is written next to the output, so it can be replaced
+    ## at once
+    float_path = out_path[:-len('.tif')] + '.float.tif'
+    float_data = _create_raster(float_path, grid, gdal.GDT_Float32,
+                                driver='GTiff',
+                                options=CREATE_OPTIONS + ['BIGTIFF=IF_SAFER'])
+    float_band = float_data.GetRasterBand(1)
+    float_band.SetNoDataValue(float('nan'))
+
+    ## Each thread warps the scenes separately, because GDAL datasets can't
+    ## be shared between threads
+    local = threading.local()
+
+    def work(block):
+        if not hasattr(local, 'bands'):
+            local.bands = [_warp_to_grid(filepath, nodata, grid)
+                           for filepath, nodata in scenes]
+        col, row, n_cols, n_rows = block
+        stack = np.full((len(scenes), n_rows, n_cols), np.nan,
+                        dtype=np.float32)
+        for i, (vrt, band) in enumerate(local.bands):
+            band.ReadAsArray(col, row, n_cols, n_rows, buf_obj=stack[i])
+
+        ## Only pixels with at least one valid value are reduced, so NumPy
+        ## doesn't warn about empty slices (the others stay NaN)
+        values = np.full((n_rows, n_cols), np.nan, dtype=np.float32)
+        valid = np.isfinite(stack).any(axis=0)
+        if valid.any():
+            values[valid] = reducer(stack[:, valid], axis=0)
+
+        return values
+
+    ## Blocks are written in order as soon as they are reduced
+    v_min, v_max = np.inf, -np.inf
+    with ThreadPoolExecutor(max_workers=Composite.workers) as executor:
+        for (col, row, _, _), values in zip(blocks,
+                                            executor.map(work, blocks)):
+            float_band.WriteArray(values, col, row)
+            if np.isfinite(values).any():
+                v_min = min(v_min, float(np.nanmin(values)))
+                v_max = max(v_max, float(np.nanmax(values)))
+            progress.advance()
+
+    float_band = None
+    float_data = None
+    progress.finish()
+
+    if not np.isfinite(v_min):
+        os.remove(float_path)
+        raise ValueError("The scenes don't contain any valid values.")
+
+    _export_composite(float_path, out_path, grid, v_min, v_max)
+    os.remove(float_path)
+
+
+def create_change_raster(filters_a, filters_b, out_path, grid,
+                         method='log_ratio', progress=None):
+    """Computes a change map between two sets of scenes (e.g. two time
+    windows). The common grid is split into blocks (see
+    Composite.block_size), which are processed independently by a pool of
+    worker processes, so the throughput scales with the number of cores.
+    The result is written as float32 GeoTIFF with overviews and can be
+    displayed with get_tile() in tile_fun.py.
+
+    :param filters_a: Filters of the scenes before the change (see
+        parse_scene_filters() in sqlite_fun.py). [dict]
+    :param filters_b: Filters of the scenes after the change. [dict]
+    :param out_path: Full path of the output GeoTIFF. [str]
+    :param grid: Common grid of the GRASS project (see get_common_grid() in
+        grass_fun.py). [dict]
+    :param method: 'log_ratio' (10 * log10(mean_b / mean_a) of the linear
+        power, in dB) or 'difference' (mean_b - mean_a). [str]
+    :param progress: Keeps track of the progress (see IngestProgress in
+        progress_fun.py). [IngestProgress]
+
+    :returns: GeoTIFF at out_path
+    """
+    if progress is None:
+        progress = IngestProgress()
+    if method not in CHANGE_METHODS:
+        raise ValueError(f"Unknown method '{method}'. Use one of "
+                         f"{list(CHANGE_METHODS)}.")
+
+    query = db.session.query(Scene.filepath, Metadata.nodata). \
+        join(Metadata, Metadata.scene_id == Scene.id)
+    scenes_a = [tuple(s) for s in apply_scene_filters(query, filters_a)]
+    scenes_b = [tuple(s) for s in apply_scene_filters(query, filters_b)]
+    if len(scenes_a) == 0 or len(scenes_b) == 0:
+        raise ValueError("No scenes match the filters of both windows.")
+
+    print(f"~~ Creating {method} change map from {len(scenes_a)} and "
+          f"{len(scenes_b)} scenes...")
+
+    blocks = _get_blocks(grid, Composite.block_size)
+    progress.start('change', total=len(blocks))
+
+    tmp_path = out_path[:-len('.tif')] + '.float.tif'
+    data = _create_raster(tmp_path, grid, gdal.GDT_Float32, driver='GTiff',
+                          options=CREATE_OPTIONS + ['BIGTIFF=IF_SAFER'])
+    band = data.GetRasterBand(1)
+    band.SetNoDataValue(float('nan'))
+
+    ## A sample of each block is kept to derive the range of the colormap.
+    ## The worker processes are spawned instead of forked, so they don't
+    ## inherit locks held by other threads of the webapp (e.g. of GDAL), and
+    ## receive the scenes and the grid only once when they are started.
+    samples = []
+    with ProcessPoolExecutor(max_workers=Composite.workers,
+                             mp_context=multiprocessing.get_context('spawn'),
+                             initializer=_init_change_worker,
+                             initargs=(scenes_a, scenes_b, grid,
+                                       method)) as executor:
+        for (col, row, _, _), values in zip(
+                blocks, executor.map(_change_block, blocks)):
+            band.WriteArray(values, col, row)
+            sample = values[::16, ::16]
+            samples.append(sample[np.isfinite(sample)])
+            progress.advance()
+
+    ## Symmetric range around 0 (no change) without outliers
+    samples = np.concatenate(samples)
+    if len(samples) == 0:
+        band = None
+        data = None
+        os.remove(tmp_path)
+        raise ValueError("The scenes of both windows don't overlap.")
+    limit = float(np.percentile(np.abs(samples), 98)) or 1.0
+
+    band.SetMetadata({'METHOD': method, 'VALUE_RANGE': f"{-limit},{limit}"})
+    band = None
+    data.BuildOverviews('AVERAGE', OVERVIEW_LEVELS)
+
+    ## The overviews are copied in front of the full resolution data and the
+    ## previous output is replaced at once
+    gdal.GetDriverByName('GTiff').CreateCopy(
+        out_path[:-len('.tif')] + '.tmp.tif', data,
+        options=CREATE_OPTIONS + ['COPY_SRC_OVERVIEWS=YES',
+                                  'BIGTIFF=IF_SAFER'])
+    data = None
+    os.remove(tmp_path)
+    os.replace(out_path[:-len('.tif')] + '.tmp.tif', out_path)
+    progress.finish()
+
+
+def _init_change_worker(scenes_a, scenes_b, grid, method):
+    ## Runs once in each worker process of create_change_raster()
+    _change_worker.update(scenes_a=scenes_a, scenes_b=scenes_b, grid=grid,
+                          method=method)
+
+
+def _change_block(block):
+    """Computes the change of a single block. This runs in the worker
+    processes of create_change_raster() (see _init_change_worker()). Each
+    process warps every scene once and keeps the warped VRTs for all of its
+    blocks.
+
+    :return: Change of each pixel (NaN if either window has no valid
+        value). [numpy.ndarray]
+    """
+    col, row, n_cols, n_rows = block
+    grid = _change_worker['grid']
+    method = _change_worker['method']
+
+    if 'bands' not in _change_worker:
+        _change_worker['bands'] = [
+            [_warp_to_grid(filepath, nodata, grid)
+             for filepath, nodata in _change_worker[key]]
+            for key in ('scenes_a', 'scenes_b')]
+
+    means = []
+    for bands in _change_worker['bands']:
+        total = np.zeros((n_rows, n_cols), dtype=np.float64)
+        count = np.zeros((n_rows, n_cols), dtype=np.int32)
+        for vrt, band in bands:
+            values = band.ReadAsArray(col, row, n_cols, n_rows)
+            valid = np.isfinite(values)
+            if method == 'log_ratio':
+                values = np.power(10, values / 10)
+            total[valid] += values[valid]
+            count[valid] += 1
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            means.append(np.where(count > 0, total / count, np.nan))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        if method == 'log_ratio':
+            change = 10 * np.log10(means[1] / means[0])
+        else:
+            change = means[1] - means[0]
+
+    return change.astype(np.float32)
+
+
+def get_time_windows(period='month'):
+    """Groups the dates of all scenes into time windows, which can be passed
+    as 'date_from' and 'date_to' filters to create_composite() in
+    grass_fun.py. Only windows containing at least one scene are returned.
+
+    :param period: 'month' or 'season' (meteorological seasons, December
+        belongs to the winter of the following year). [str]
+
+    :return: List of windows, each with 'name', 'date_from', 'date_to'
+        (YYYY-MM-DD) and 'n_scenes'. [list]
+    """
+    if period not in ('month', 'season'):
+        raise ValueError("'period' must be 'month' or 'season'.")
+
+    windows = OrderedDict()
+    for (scene_date,) in db.session.query(Scene.date).order_by(Scene.date):
+        if period == 'month':
+            start = date(scene_date.year, scene_date.month, 1)
+            n_months = 1
+            name = start.strftime('%Y-%m')
+        else:
+            month = scene_date.month - scene_date.month % 3
+            start = date(scene_date.year - (month == 0), month or 12, 1)
+            n_months = 3
+            name = f"{SEASONS[start.month]} {start.year + (start.month == 12)}"
+
+        if name not in windows:
+            ## Last day of the window
+            end_month = start.month - 1 + n_months
+            end = date(start.year + end_month // 12, end_month % 12 + 1,
+                       1) - timedelta(days=1)
+            windows[name] = {'name': name,
+                             'date_from': start.isoformat(),
+                             'date_to': end.isoformat(),
+                             'n_scenes': 0}
+        windows[name]['n_scenes'] += 1
+
+    return list(windows.values())
+
+
+def get_reducer(stat):
+    """Gets the function that computes a statistic along an axis while
+    ignoring NaN values.
+
+    :param stat: See create_composite_raster(). [str]
+
+    :return: Function with the signature f(array, axis). [function]
+    """
+    if stat in REDUCERS:
+        return REDUCERS[stat]
+
+    match = re.fullmatch(r'p(\d{1,2}(\.\d+)?|100)', stat)
+    if match is None:
+        raise ValueError(f"Unknown statistic '{stat}'. Use one of "
+                         f"{list(REDUCERS.keys())} or a percentile like "
+                         f"'p90'.")
+    q = float(match.group(1))
+
+    return lambda a, axis: np.nanpercentile(a, q, axis=axis)
+
+
+def rescale(values, v_min, v_max):
+    """Rescales values linearly to the range from 1 to 255 like r.rescale
+    in GRASS. NaN values become 0, which is used as nodata value.
+
+    :param values: Array of values. [numpy.ndarray]
+    :param v_min: Value that is mapped to 1. [float]
+    :param v_max: Value that is mapped to 255. [float]
+
+    :return: Rescaled values. [numpy.ndarray]
+    """
+    scale = 254 / max(v_max - v_min, 1e-12)
+
+    valid = np.isfinite(values)
+    out = np.zeros(values.shape, dtype=np.uint8)
+    out[valid] = np.clip(np.rint((values[valid] - v_min) * scale + 1),
+                         1, 255)
+
+    return out
+
+
+def equalized_color_table(histogram, lut=VIRIDIS):
+    """Creates a color table that is equalized by a histogram like
+    r.colors -e in GRASS: each value gets the color at the position of its
+    cumulative frequency, so all colors are used by a similar number of
+    pixels. Value 0 (nodata) is transparent.
+
+    :param histogram: Number of pixels of each value from 0 to 255.
+        [numpy.ndarray]
+    :param lut: Colormap as array of RGBA values. [numpy.ndarray]
+
+    :return: Color table. [gdal.ColorTable]
+    """
+    counts = np.asarray(histogram, dtype=np.float64).copy()
+    counts[0] = 0
+    total = max(counts.sum(), 1)
+
+    ## Center of each value in the cumulative histogram
+    position = (np.cumsum(counts) - counts / 2) / total
+    index = np.clip(np.rint(position * (len(lut) - 1)), 0,
+                    len(lut) - 1).astype(int)
+
+    ct = gdal.ColorTable()
+    ct.SetColorEntry(0, (0, 0, 0, 0))
+    for value in range(1, 256):
+        ct.SetColorEntry(value, tuple(int(c) for c in lut[index[value]]))
+
+    return ct
+
+
+def _export_composite(float_path, out_path, grid, v_min, v_max):
+    """Rescales the float raster of create_composite_raster() to 1-255 block
+    by block, applies the equalized color table and writes the output with
+    overviews. The output is written to a temporary file first and replaces
+    the previous version at once.
+    """
+    float_data = gdal.Open(float_path)
+    float_band = float_data.GetRasterBand(1)
+
+    tmp_path = out_path[:-len('.tif')] + '.tmp.tif'
+    data = _create_raster(tmp_path, grid, gdal.GDT_Byte, driver='GTiff',
+                          options=CREATE_OPTIONS)
+    band = data.GetRasterBand(1)
+    band.SetNoDataValue(0)
+
+    histogram = np.zeros(256, dtype=np.int64)
+    for col, row, n_cols, n_rows in _get_blocks(grid, Composite.block_size):
+        values = rescale(float_band.ReadAsArray(col, row, n_cols, n_rows),
+                         v_min, v_max)
+        band.WriteArray(values, col, row)
+        histogram += np.bincount(values.ravel(), minlength=256)
+    float_band = None
+    float_data = None
+
+    band.SetRasterColorTable(equalized_color_table(histogram))
+    band.SetRasterColorInterpretation(gdal.GCI_PaletteIndex)
+    band = None
+    data.BuildOverviews('NEAREST', OVERVIEW_LEVELS)
+    data = None
+
+    os.replace(tmp_path, out_path)
+
+
+def _warp_to_grid(filepath, nodata, grid):
+    """Warps a scene onto the common grid as VRT, so it is only read when
+    blocks are requested (see _write_scenes() in cube_fun.py).
+
+    :return: The VRT and its band. [tuple]
+    """
+    ulx, xres, _, uly, _, yres = grid['transform']
+    bounds = (ulx, uly + grid['rows'] * yres, ulx + grid['cols'] * xres, uly)
+    vrt = gdal.Warp('', filepath, format='VRT', outputBounds=bounds,
+                    width=grid['cols'], height=grid['rows'],
+                    dstSRS=f"EPSG:{grid['epsg']}", resampleAlg='near',
+                    outputType=gdal.GDT_Float32, srcNodata=nodata,
+                    dstNodata=np.nan)
+
+    return vrt, vrt.GetRasterBand(1)
+
+
+def _create_raster(path, grid, data_type, driver, options=()):
+    data = gdal.GetDriverByName(driver).Create(
+        path, grid['cols'], grid['rows'], 1, data_type, options=list(options))
+    data.SetGeoTransform(grid['transform'])
+    data.SetProjection(get_srs(grid['epsg']).ExportToWkt())
+
+    return data
+
+
+def _get_blocks(grid, block_size):
+    ## Column, row, number of columns and number of rows of each block
+    return [(col, row, min(block_size, grid['cols'] - col),
+             min(block_size, grid['rows'] - row))
+            for row in range(0, grid['rows'], block_size)
+            for col in range(0, grid['cols'], block_size)]
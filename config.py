@@ -6,6 +6,10 @@ data_dir = "D:/GEO450_data"
 
 ###############################################################################
 
+## The data directory can also be set with the environment variable
+## S1GRASS_DATA_DIR (e.g. to run the benchmarks on a synthetic dataset)
+data_dir = os.environ.get('S1GRASS_DATA_DIR', data_dir)
+
 ## Convert to normalized path (just in case) and print error message if it
 ## doesn't exist
 data_dir = os.path.abspath(data_dir)
@@ -21,6 +25,7 @@ if not os.path.exists(data_dir):
 sqlite_dir = os.path.join(data_dir, 'sqlite')
 grass_dir = os.path.join(data_dir, 'grass')
 grass_dir_out = os.path.join(grass_dir, 'output')
+cube_dir = os.path.join(data_dir, 'cube')
 
 if not os.path.exists(sqlite_dir):
     os.makedirs(sqlite_dir)
@@ -28,6 +33,8 @@ if not os.path.exists(grass_dir):
     os.makedirs(grass_dir)
 if not os.path.exists(grass_dir_out):
     os.makedirs(grass_dir_out)
+if not os.path.exists(cube_dir):
+    os.makedirs(cube_dir)
 
 
 ## Configurations that are imported in __init__.py
@@ -50,3 +57,81 @@ class Grass(object):
 
 class Database(object):
     path = sqlite_dir
+
+
+## Settings for the extraction of time series (see get_timeseries() in
+## grass_fun.py). The 'gdal' engine reads values directly from the GeoTIFF
+## files inside the webapp, 'grass' uses the r.what module of GRASS GIS
+## instead (slower, but kept as a fallback).
+class Timeseries(object):
+    engine = 'gdal'
+    pool_size = 64  # max. number of GDAL datasets that are kept open
+    block_cache = 256  # size of GDAL's block cache in MB
+
+
+## Settings for the datacube (see cube_fun.py), which stores all scenes on
+## the common grid of the GRASS project in a pixel-major layout. If it
+## exists, time series are read from the datacube instead of the scenes.
+class Cube(object):
+    path = cube_dir
+    enabled = True
+    chunk_size = 64  # number of scenes stored in each chunk
+    ## Fraction of slots of removed (or changed) scenes at which the
+    ## datacube is compacted (see update_cube() in cube_fun.py)
+    compact_ratio = 0.25
+
+
+## Settings for the ingestion of new scenes (see db_main() in sqlite_fun.py)
+class Ingest(object):
+    workers = os.cpu_count() or 1  # processes used to extract metadata
+    ## How the min/max of each scene is determined: 'exact' (read all
+    ## pixels), 'approx' (from overviews or a sample of the pixels) or
+    ## 'stored' (statistics stored in the GeoTIFF or .aux.xml file. If none
+    ## are stored, 'approx' is used instead)
+    stats_mode = 'stored'
+    ## Also hash the header of each file to notice modified files (in
+    ## addition to their size and modification time)
+    header_hash = False
+    batch_size = 500  # scenes inserted into the database per statement
+    ## How scenes are imported to GRASS: 'copy' (r.in.gdal), 'link'
+    ## (r.external, no data is copied into the GRASS database) or 'parallel'
+    ## (multiple r.in.gdal imports at once)
+    grass_import = 'copy'
+    grass_workers = 4  # number of parallel imports
+
+
+## Settings for the tiles of the maps (see tile_fun.py). Rendered tiles are
+## cached on disk up to the given size.
+class Tiles(object):
+    path = os.path.join(grass_dir_out, 'tiles')
+    max_size = 512  # MB
+
+
+## Settings for the cache of generated plots (see cache_fun.py). If
+## 'persist' is True, the cache is also stored on disk and survives a
+## restart of the webapp.
+class Cache(object):
+    path = os.path.join(sqlite_dir, 'plot_cache')
+    max_size = 64  # MB
+    persist = False
+
+
+## Settings for the watcher of the data directory (see watch_fun.py), which
+## ingests new, changed or removed scenes without restarting the webapp.
+## The watchdog package is used if it's installed, otherwise the directory
+## is polled.
+class Watcher(object):
+    enabled = False
+    debounce = 5  # seconds without new changes before scenes are ingested
+    poll_interval = 10  # seconds between two scans of the data directory
+
+
+## Settings for the composites of all scenes (e.g. avg_raster.tif, see
+## create_stat_raster() in grass_fun.py). The 'grass' engine derives them
+## from accumulators in GRASS GIS, 'numpy' reads the scenes in blocks and
+## computes the statistic with NumPy (see composite_fun.py), which also
+## supports the median and percentiles.
+class Composite(object):
+    engine = 'grass'
+    block_size = 512  # rows/columns of the blocks that are read at once
+    workers = os.cpu_count() or 1  # threads that compute the blocks
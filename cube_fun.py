@@ -0,0 +1,369 @@
+from config import Cube
+from flask_app import db
+from flask_app.models import Scene, Metadata
+from gdal_fun import transform_point
+from progress_fun import IngestProgress
+
+from osgeo import gdal
+from datetime import datetime
+import os
+import re
+import json
+import threading
+import numpy as np
+gdal.UseExceptions()
+
+## The datacube consists of an index file and multiple chunks. Each chunk is
+## a raw float32 array with the shape (rows, columns, Cube.chunk_size), so
+## the values of a single pixel for all scenes of a chunk are stored next to
+## each other on disk.
+INDEX_FILE = 'cube.json'
+
+## Number of rows that are warped and written to the datacube at once
+STRIP_ROWS = 256
+## Number of rows that are copied at once when the datacube is compacted
+## (all slots of a chunk are read for each strip)
+COMPACT_ROWS = 16
+
+## Open chunks and the loaded index are cached while reading. Chunks that
+## aren't part of the datacube anymore, but couldn't be removed yet, are
+## kept in 'obsolete' (see publish_cube()).
+_cache = {'mtime': None, 'index': None, 'chunks': [], 'obsolete': []}
+_cache_lock = threading.Lock()
+
+
+def cube_exists():
+    """Checks if a datacube has been built (see update_cube()).
+
+    :return: True if the datacube exists. [bool]
+    """
+    return os.path.isfile(os.path.join(Cube.path, INDEX_FILE))
+
+
+def update_cube(grid, changed=(), progress=None, scenes=None, publish=True):
+    """Appends all scenes of the database that haven't been written to the
+    datacube yet. Scenes that have been removed from the database are
+    marked as removed, changed scenes are marked as removed and appended
+    again. If the fraction of removed slots exceeds Cube.compact_ratio, the
+    datacube is compacted (see _compact_cube()). If the datacube doesn't
+    exist or the common grid of the GRASS project has changed (e.g. because
+    new scenes extended the region), the datacube is rebuilt from all scenes
+    in chronological order.
+    New slots and chunks are written next to the ones the current index
+    refers to, so the datacube can be read in the meantime and only changes
+    once the new index is saved (see publish_cube()).
+
+    :param grid: Common grid of the GRASS project (see get_common_grid() in
+        grass_fun.py). [dict]
+    :param changed: Scenes that were changed (see db_main() in
+        sqlite_fun.py). [set]
+    :param progress: Keeps track of the progress (see IngestProgress in
+        progress_fun.py). [IngestProgress]
+    :param scenes: Filepath, date and nodata value of all scenes of the
+        dataset (see get_staged_scenes() in sqlite_fun.py). Defaults to the
+        scenes in the database. [list]
+    :param publish: If False, the new index is returned instead of saved,
+        so it can be published once the database has been updated (see
+        IngestWorker in ingest_fun.py). [bool]
+
+    :return: New index of the datacube (only if publish is False). [dict]
+    """
+    if progress is None:
+        progress = IngestProgress()
+
+    index = _load_index()
+    if index is None or not _same_grid(index['grid'], grid):
+        if index is not None:
+            print("~~ The common grid of the GRASS project has changed. The "
+                  "datacube will be rebuilt.")
+        index = _new_index(grid, index)
+
+    ## Get filepath, date and nodata value of all scenes in database
+    if scenes is None:
+        scenes = db.session.query(Scene.filepath, Scene.date,
+                                  Metadata.nodata). \
+            join(Metadata, Metadata.scene_id == Scene.id). \
+            order_by(Scene.date).all()
+    db_scenes = set(filepath for (filepath, date, nodata) in scenes)
+
+    ## Mark scenes that are not in the database anymore or were changed as
+    ## removed (a copy of the entries is changed, so readers of the current
+    ## index aren't affected)
+    index['scenes'] = [
+        dict(entry, removed=True) if entry['filepath'] not in db_scenes
+        or entry['filepath'] in changed else entry
+        for entry in index['scenes']]
+
+    ## Rewrite the datacube without the removed slots, so it doesn't grow
+    ## with every change
+    n_removed = sum(entry['removed'] for entry in index['scenes'])
+    if n_removed > 0 and \
+            n_removed / len(index['scenes']) > Cube.compact_ratio:
+        print(f"~~ Compacting the datacube ({n_removed} removed slots)...")
+        index = _compact_cube(index)
+
+    ## Append new scenes
+    cube_scenes = set(entry['filepath'] for entry in index['scenes']
+                      if not entry['removed'])
+    new_scenes = [(filepath, date, nodata) for (filepath, date, nodata)
+                  in scenes if filepath not in cube_scenes]
+
+    if len(new_scenes) > 0:
+        print(f"~~ Writing {len(new_scenes)} scenes to the datacube...")
+    progress.start('cube', total=len(new_scenes))
+
+    ## Scenes are written in batches that fill up the current chunk (see
+    ## _write_scenes())
+    start = 0
+    while start < len(new_scenes):
+        slot = len(index['scenes'])
+        n = index['chunk_size'] - slot % index['chunk_size']
+        batch = new_scenes[start:start + n]
+        _write_scenes([(filepath, nodata) for (filepath, date, nodata)
+                       in batch], grid, slot, index)
+        for filepath, date, nodata in batch:
+            index['scenes'].append({'filepath': filepath,
+                                    'date': date.isoformat(),
+                                    'removed': False})
+            progress.advance(nbytes=os.path.getsize(filepath))
+        start += n
+
+    progress.finish()
+    if not publish:
+        return index
+
+    publish_cube(index)
+
+
+def publish_cube(index):
+    """Saves a new index of the datacube (see update_cube()), so it's used
+    by all following reads, and removes the chunks that aren't part of it
+    anymore (e.g. after the datacube was compacted or rebuilt).
+
+    :param index: Index of the datacube. [dict]
+    """
+    _save_index(index)
+
+    ## Files of open memory maps can't be removed on Windows, so the cached
+    ## chunks are closed first. Chunks that are still being read by a
+    ## request are removed once the cache is reloaded (see _open_cube()).
+    chunk_file = re.compile(re.escape(index['prefix']) + r'_\d{5}\.dat')
+    with _cache_lock:
+        _cache['mtime'] = None
+        _cache['index'] = None
+        _cache['chunks'] = []
+        _cache['obsolete'] = [os.path.join(Cube.path, f)
+                              for f in os.listdir(Cube.path)
+                              if f.startswith('chunk_')
+                              and not chunk_file.fullmatch(f)]
+        _remove_obsolete_chunks()
+
+
+def read_cube(x, y, epsg=None, filepaths=None):
+    """Reads the timeseries of a single location from the datacube.
+
+    :param x: X coordinate. [float]
+    :param y: Y coordinate. [float]
+    :param epsg: EPSG code of the coordinate. If None, the coordinate is
+        expected to be in the projection of the datacube. [str or int]
+    :param filepaths: Only return the values of these scenes. If None,
+        the values of all scenes are returned. [set]
+
+    :return values_list: List of extracted values.
+    :return dates_list: List of dates associated with values_list.
+    """
+    with _cache_lock:
+        index, chunks = _open_cube()
+
+    grid = index['grid']
+    scenes = index['scenes']
+    x, y = transform_point(x, y, epsg, grid['epsg'])
+
+    ## Get pixel of the common grid
+    ulx, xres, _, uly, _, yres = grid['transform']
+    col = int(np.floor((x - ulx) / xres))
+    row = int(np.floor((y - uly) / yres))
+
+    if 0 <= col < grid['cols'] and 0 <= row < grid['rows']:
+        ## Read the values of the pixel from each chunk
+        values = []
+        chunk_size = index['chunk_size']
+        for i, chunk in enumerate(chunks):
+            n = min(chunk_size, len(scenes) - i * chunk_size)
+            values.extend(chunk[row, col, :n].tolist())
+    else:
+        values = [np.nan] * len(scenes)
+
+    ## Scenes that were appended later can be older than the ones before
+    ## them, so the values are sorted by date
+    use = sorted((i for i, s in enumerate(scenes)
+                  if not s['removed'] and (filepaths is None or
+                                           s['filepath'] in filepaths)),
+                 key=lambda i: scenes[i]['date'])
+    values_list = [values[i] for i in use]
+    dates_list = [datetime.fromisoformat(scenes[i]['date']) for i in use]
+
+    return values_list, dates_list
+
+
+def _write_scenes(scenes, grid, slot, index):
+    """Warps scenes onto the common grid and writes them to consecutive
+    slots of the datacube, starting at the given slot (all of them have to
+    fit into its chunk). The scenes are processed in strips of rows to keep
+    the memory usage low. Since the values of a pixel are stored next to
+    each other, all scenes are written at once for each strip, so every
+    page of the chunk is only written once.
+
+    :param scenes: Filepath and nodata value of each scene. [list]
+    """
+
+    ## Open chunk (a new one is created if the slot is the first of a chunk)
+    chunk_id, pos = divmod(slot, index['chunk_size'])
+    chunk = _get_chunk(chunk_id, index, mode='w+' if pos == 0 else 'r+')
+
+    ## Warp scenes onto the common grid (VRTs are used, so the scenes are
+    ## only read when the strips are requested)
+    ulx, xres, _, uly, _, yres = grid['transform']
+    bounds = (ulx, uly + grid['rows'] * yres, ulx + grid['cols'] * xres, uly)
+    vrts = [gdal.Warp('', filepath, format='VRT', outputBounds=bounds,
+                      width=grid['cols'], height=grid['rows'],
+                      dstSRS=f"EPSG:{grid['epsg']}", resampleAlg='near',
+                      outputType=gdal.GDT_Float32, srcNodata=nodata,
+                      dstNodata=np.nan)
+            for (filepath, nodata) in scenes]
+    bands = [vrt.GetRasterBand(1) for vrt in vrts]
+
+    ## The more scenes are written at once, the fewer rows are read per
+    ## strip, so the memory usage stays about the same
+    strip_rows = max(COMPACT_ROWS, STRIP_ROWS // len(scenes))
+    for row in range(0, grid['rows'], strip_rows):
+        n_rows = min(strip_rows, grid['rows'] - row)
+        strip = np.stack([band.ReadAsArray(0, row, grid['cols'], n_rows)
+                          for band in bands], axis=2)
+        chunk[row:row + n_rows, :, pos:pos + len(scenes)] = strip
+
+    chunk.flush()
+    bands = vrts = None
+
+
+def _compact_cube(index):
+    """Copies the slots of all scenes that aren't removed to new chunks,
+    sorted by date. The new chunks get a new file prefix and the old ones
+    are only deleted once the new index is published (see publish_cube()),
+    so the datacube can still be read while it is compacted.
+
+    :return: Index of the compacted datacube. [dict]
+    """
+    scenes = index['scenes']
+    chunk_size = index['chunk_size']
+    rows = index['grid']['rows']
+    new_index = _new_index(index['grid'], index)
+
+    live = sorted((slot for slot, entry in enumerate(scenes)
+                   if not entry['removed']),
+                  key=lambda slot: scenes[slot]['date'])
+    n_old = -(-len(scenes) // chunk_size)
+    old_chunks = [_get_chunk(i, index) for i in range(n_old)]
+
+    new_size = new_index['chunk_size']
+    for start in range(0, len(live), new_size):
+        slots = live[start:start + new_size]
+        chunk = _get_chunk(start // new_size, new_index, mode='w+')
+        for row in range(0, rows, COMPACT_ROWS):
+            n_rows = min(COMPACT_ROWS, rows - row)
+            for pos, slot in enumerate(slots):
+                old_id, old_pos = divmod(slot, chunk_size)
+                chunk[row:row + n_rows, :, pos] = \
+                    old_chunks[old_id][row:row + n_rows, :, old_pos]
+        chunk.flush()
+        del chunk
+    del old_chunks
+
+    new_index['scenes'] = [scenes[slot] for slot in live]
+
+    return new_index
+
+
+def _new_index(grid, index=None):
+    """Creates the index of an empty datacube. Its chunks get a prefix that
+    differs from the one of the current index, so the current chunks aren't
+    overwritten before the new index is published.
+    """
+    compactions = 1 if index is None else index.get('compactions', 0) + 1
+
+    return {'grid': grid, 'chunk_size': Cube.chunk_size,
+            'prefix': f'chunk_c{compactions}',
+            'compactions': compactions, 'scenes': []}
+
+
+def _get_chunk(chunk_id, index, mode='r'):
+    """Opens a chunk of the datacube as numpy.memmap."""
+    grid = index['grid']
+
+    return np.memmap(_get_chunk_path(chunk_id, index), dtype=np.float32,
+                     mode=mode, shape=(grid['rows'], grid['cols'],
+                                       index['chunk_size']))
+
+
+def _get_chunk_path(chunk_id, index):
+    ## Datacubes written before compaction was added have no prefix
+    prefix = index.get('prefix', 'chunk')
+
+    return os.path.join(Cube.path, f'{prefix}_{chunk_id:05d}.dat')
+
+
+def _open_cube():
+    """Returns the index and all chunks of the datacube. Both are reloaded
+    only if the index file has changed since the last call.
+    """
+    path = os.path.join(Cube.path, INDEX_FILE)
+    mtime = os.stat(path).st_mtime_ns
+
+    if _cache['mtime'] != mtime:
+        index = _load_index()
+        n_chunks = -(-len(index['scenes']) // index['chunk_size'])
+        _cache['index'] = index
+        _cache['chunks'] = [_get_chunk(i, index) for i in range(n_chunks)]
+        _cache['mtime'] = mtime
+        _remove_obsolete_chunks()
+
+    return _cache['index'], _cache['chunks']
+
+
+def _remove_obsolete_chunks():
+    ## Must be called with _cache_lock held. Chunks that are still opened
+    ## (e.g. by a running read_cube()) are kept for the next attempt.
+    remaining = []
+    for path in _cache['obsolete']:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        except OSError:
+            remaining.append(path)
+    _cache['obsolete'] = remaining
+
+
+def _load_index():
+    path = os.path.join(Cube.path, INDEX_FILE)
+    if not os.path.isfile(path):
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_index(index):
+    ## Write to a temporary file first, so the index is replaced at once and
+    ## never read while it is only partially written
+    path = os.path.join(Cube.path, INDEX_FILE)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(index, f)
+    os.replace(path + '.tmp', path)
+
+
+def _same_grid(grid_a, grid_b):
+    return (str(grid_a['epsg']) == str(grid_b['epsg'])
+            and grid_a['rows'] == grid_b['rows']
+            and grid_a['cols'] == grid_b['cols']
+            and np.allclose(grid_a['transform'], grid_b['transform']))
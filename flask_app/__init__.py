@@ -4,11 +4,36 @@ from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_migrate import Migrate
 from flask_bootstrap import Bootstrap
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+import sqlite3
+
+
+def include_object(object, name, type_, reflected, compare_to):
+    """Excludes the tables of the spatial index (see spatial_fun.py), which
+    are created outside of the models, from the migrations of flask-migrate.
+    """
+    return not (type_ == 'table' and name.startswith('scene_rtree'))
+
 
 app = Flask(__name__)
 app.config.from_object(Config)
 db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+migrate = Migrate(app, db, include_object=include_object)
 bootstrap = Bootstrap(app)
 
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragma(dbapi_connection, connection_record):
+    """Uses write-ahead logging for the SQLite database, so the database can
+    be read while scenes are added and each commit needs fewer syncs to
+    disk.
+    """
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA journal_mode = WAL")
+        cursor.execute("PRAGMA synchronous = NORMAL")
+        cursor.close()
+
+
 from flask_app import routes, models
@@ -10,6 +10,9 @@ class Scene(db.Model):
     date = db.Column(db.DateTime, index=True, unique=True)
     filepath = db.Column(db.String(1000), index=True, unique=True)
     time_added = db.Column(db.DateTime, index=True, default=datetime.utcnow)
+    file_size = db.Column(db.BigInteger)
+    file_mtime = db.Column(db.Float)
+    file_hash = db.Column(db.String(40))
     meta = db.relationship('Metadata', backref='s1_scene', lazy='dynamic')
     geo = db.relationship('Geometry', backref='s1_scene', lazy='dynamic')
     # grass_out = db.relationship('GrassOutput', backref='s1_scene',
@@ -28,6 +31,7 @@ class Metadata(db.Model):
     nodata = db.Column(db.Integer)
     band_min = db.Column(db.Float)
     band_max = db.Column(db.Float)
+    stats_mode = db.Column(db.String(6))
 
     def __repr__(self):
         return '<Metadata of scene {}>'.format(self.scene_id)
@@ -49,6 +53,20 @@ class Geometry(db.Model):
         return '<Geometry of scene {}>'.format(self.scene_id)
 
 
+class Dataset(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    generation = db.Column(db.Integer, default=0)
+    n_scenes = db.Column(db.Integer)
+    date_min = db.Column(db.DateTime)
+    date_max = db.Column(db.DateTime)
+    band_min = db.Column(db.Float)
+    band_max = db.Column(db.Float)
+    crs_histogram = db.Column(db.Text)  # JSON: EPSG code -> number of scenes
+
+    def __repr__(self):
+        return '<Dataset generation {}>'.format(self.generation)
+
+
 """
 class GrassOutput(db.Model):
     id = db.Column(db.Integer, primary_key=True)
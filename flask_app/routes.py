@@ -1,12 +1,31 @@
 from flask_app import app
-from config import Grass
-from sqlite_fun import db_main
-from grass_fun import grass_main, start_grass_session, create_plot
-from flask_app.tables import create_overview_table, create_meta_table
-from flask_app.models import Scene
-
-from flask import render_template, send_from_directory
+from config import Grass, Watcher
+from sqlite_fun import setup_db, ensure_summary, get_fingerprint, \
+    get_summary, parse_scene_filters
+from grass_fun import create_plot, create_composite, create_change_map, \
+    get_composite_layer, get_change_layer, \
+    create_empty_plot, get_timeseries_data, get_aggregate_timeseries, \
+    iter_batch_timeseries
+from flask_app import db
+from flask_app.tables import create_overview_table, create_meta_table, \
+    get_filter_options
+from flask_app.models import Scene, Metadata, Geometry
+from tile_fun import get_tile, get_raster_info
+from cache_fun import plot_cache
+from stream_fun import stream_csv, stream_parquet, parquet_available
+from ingest_fun import ingest_worker, job_worker
+from watch_fun import data_watcher
+from composite_fun import get_time_windows
+from metrics_fun import render_metrics
+
+from flask import render_template, send_file, abort, Response, request, \
+    jsonify, stream_with_context, url_for
+from werkzeug.security import safe_join
+from bokeh.resources import CDN
 import os
+import hashlib
+from datetime import datetime
+import numpy as np
 
 
 @app.before_first_request
@@ -16,80 +35,136 @@ def initialize():
     webapp is opened to either:
 
     - create the SQLite database and setup a GRASS project
-    - OR update both with new scenes if they already exist
+    - OR update both with new, changed or removed scenes if they already
+    exist
     - OR do nothing and start the web app, because has already been set up and
     there are no new scenes in the directory.
+
+    Both run in a background thread (see IngestWorker in ingest_fun.py), so
+    the webapp can be used with the previous dataset in the meantime. The
+    progress can be followed on /status. If Watcher.enabled is True (see
+    config.py), scenes that are added to the data directory later are
+    ingested as well (see watch_fun.py).
     """
 
-    ## Create (or update) SQLite database
-    scenes, epsg = db_main()
+    ## Only the database scheme and the summary of the dataset are set up
+    ## right away, so pages can query the database while scenes are added
+    setup_db()
+    ensure_summary()
 
-    ## Only execute grass_main() if (new) scenes were found. Scenes will be
-    ## imported to the GRASS database and avg_raster.tif will be recalculated.
-    ## grass_main() will also set up a GRASS project if none exist already.
+    ## Scenes will be added to (or removed from) the database and the GRASS
+    ## project and avg_raster.tif will be recalculated. grass_main() will
+    ## also set up a GRASS project if none exist already.
     ## Else, it is assumed a GRASS project already exists and a session is
     ## started.
-    if len(scenes) > 0:
-        grass_main(scenes, epsg)
-    else:
-        start_grass_session(crs=epsg)
+    ingest_worker.start()
+
+    ## Ingest new scenes as soon as they are added to the data directory
+    if Watcher.enabled:
+        data_watcher.start()
 
 
 @app.route('/')
 @app.route('/home')
 def index():
 
-    ## Query all scenes in the database
-    all_scenes = Scene.query.all()
+    ## Get number of scenes, first and last date and CRS of all scenes from
+    ## the summary of the dataset
+    summary = get_summary()
 
-    ## Get first and last date
-    date_min = all_scenes[0].date
-    date_max = all_scenes[len(all_scenes) - 1].date
+    ## State of the ingestion of new scenes (see IngestWorker)
+    ingest = ingest_worker.status()
+
+    ## No scenes have been added yet (e.g. the first ingestion is running)
+    if summary['n_scenes'] == 0:
+        return render_template('home.html', n_scenes=0, ingest=ingest)
 
     ## Reformat dates from datetime to strings
-    date_min = date_min.strftime("%Y-%m-%d")
-    date_max = date_max.strftime("%Y-%m-%d")
+    date_min = summary['date_min'].strftime("%Y-%m-%d")
+    date_max = summary['date_max'].strftime("%Y-%m-%d")
 
-    return render_template('home.html', n_scenes=len(all_scenes),
-                           date_min=date_min, date_max=date_max)
+    return render_template('home.html', n_scenes=summary['n_scenes'],
+                           date_min=date_min, date_max=date_max,
+                           crs=summary['crs'], ingest=ingest)
 
 
 @app.route('/overview')
 def overview():
 
-    ## Create table (html)
-    table = create_overview_table()
+    ## Get filters and page ('after' or 'before' the date of a scene) from
+    ## query parameters
+    try:
+        filters = parse_scene_filters(request.args)
+        after, before = [datetime.fromisoformat(request.args[k])
+                         if request.args.get(k) else None
+                         for k in ('after', 'before')]
+    except ValueError as e:
+        abort(400, str(e))
+
+    ## Create table (html) of the page
+    table, pages = create_overview_table(filters, after=after, before=before)
 
-    return render_template('table.html', table=table)
+    ## Links to the previous and next page keep the filters
+    args = {k: v for k, v in request.args.items()
+            if k not in ('after', 'before')}
+    prev_url = url_for('overview', before=pages['first'].isoformat(),
+                       **args) if pages['has_prev'] else None
+    next_url = url_for('overview', after=pages['last'].isoformat(),
+                       **args) if pages['has_next'] else None
+
+    return render_template('table.html', table=table, prev_url=prev_url,
+                           next_url=next_url, args=args,
+                           options=get_filter_options())
 
 
 @app.route('/meta/<scene_id>')
 def meta(scene_id):
 
-    ## Get scene by ID
-    s = Scene.query.filter_by(id=scene_id).\
-        first_or_404(f"A scene with the ID '{scene_id}' is currently "
-                     "not stored in the database.")
+    ## Get scene, metadata and geometry by ID with a single query
+    row = db.session.query(Scene, Metadata, Geometry). \
+        join(Metadata, Metadata.scene_id == Scene.id). \
+        join(Geometry, Geometry.scene_id == Scene.id). \
+        filter(Scene.id == scene_id).first()
+    if row is None:
+        abort(404, f"A scene with the ID '{scene_id}' is currently "
+                   "not stored in the database.")
+    s, m, g = row
 
     ## Create table (html)
-    table = create_meta_table(s)
+    table = create_meta_table(s, m, g)
 
     ## Dynamic title for the html page
     title = f"Metadata for scene #{scene_id}"
 
-    ## Get filepath to render raster on map
-    filepath = s.filepath
+    ## Get projection and bounds to render raster on map
+    epsg, bounds = get_raster_info(s.filepath)
 
     return render_template('table_meta.html', table=table, title=title,
-                           filepath=filepath)
+                           scene_id=s.id, bounds=bounds)
 
 
 @app.route('/map')
 def main_map():
 
     filepath = os.path.join(Grass.path_out, 'avg_raster.tif')
+    if not os.path.isfile(filepath):
+        abort(503, "The average raster hasn't been created yet. The "
+                   "progress of the ingestion can be followed on /status.")
+
+    ## Get projection (needed to extract timeseries) and bounds of the
+    ## average raster
+    epsg, bounds = get_raster_info(filepath)
+
+    ## With '/map?mode=json' the plot is only created once and its data is
+    ## updated with /api/timeseries. By default, a new plot is created
+    ## for each click with /plot.
+    if request.args.get('mode') == 'json':
+        plot_script, plot_div = create_empty_plot()
+        return render_template('map.html', epsg=epsg, bounds=bounds,
+                               plot_script=plot_script, plot_div=plot_div,
+                               bokeh_resources=CDN.render())
 
-    return render_template('map.html', filepath=filepath)
+    return render_template('map.html', epsg=epsg, bounds=bounds)
 
 
 @app.route('/serve/<path:filepath>')
@@ -98,14 +173,253 @@ def serve_file(filepath):
     path = os.path.dirname(filepath)
     filename = os.path.basename(filepath)
 
-    return send_from_directory(path, filename,
-                               as_attachment=True)
+    full_path = safe_join(path, filename)
+    if full_path is None or not os.path.isfile(full_path):
+        abort(404)
+    full_path = os.path.abspath(full_path)
+
+    ## Strong ETag derived from the fingerprint of the file (see
+    ## get_fingerprint() in sqlite_fun.py)
+    size, mtime, file_hash = get_fingerprint(full_path)
+    etag = hashlib.sha1(f"{size}-{mtime}-{file_hash}".encode()).hexdigest()
+
+    rv = send_file(full_path, as_attachment=True, add_etags=False,
+                   cache_timeout=0, conditional=False)
+    rv.set_etag(etag)
+    rv.last_modified = mtime
+    rv.cache_control.no_cache = True
+
+    ## Answer with '304 Not Modified' if the client has the current version
+    ## and with '206 Partial Content' for byte-range requests (e.g. to only
+    ## fetch the header and overviews of a cloud optimized GeoTIFF). Only
+    ## the requested range is read from the file. If X-Sendfile is used,
+    ## the web server handles ranges itself.
+    if not app.use_x_sendfile:
+        rv.headers['Accept-Ranges'] = 'bytes'
+
+    return rv.make_conditional(request,
+                               accept_ranges=not app.use_x_sendfile,
+                               complete_length=size)
+
+
+@app.route('/tiles/<string:layer>/<int:z>/<int:x>/<int:y>.png')
+def tiles(layer, z, x, y):
+
+    ## Get tile (rendered or from cache) of the average raster or a scene
+    tile = get_tile(layer, z, x, y)
+    if tile is None:
+        abort(404, f"The layer '{layer}' doesn't exist.")
+
+    return Response(tile, mimetype='image/png')
 
 
 @app.route('/plot/<string:lat>/<string:lng>/<string:proj>')
 def plot(lat, lng, proj):
 
+    ## Only use scenes matching the filters (date range, orbit,
+    ## polarisation, sensor) passed as query parameters
+    try:
+        filters = parse_scene_filters(request.args)
+    except ValueError as e:
+        abort(400, str(e))
+
     ## Create plot from passed latitude, longitude and projection
-    html_plot = create_plot(latitude=lat, longitude=lng, projection=proj)
+    html_plot = create_plot(latitude=lat, longitude=lng, projection=proj,
+                            filters=filters)
 
     return html_plot
+
+
+@app.route('/aggregate', methods=['POST'])
+def aggregate():
+
+    ## Get mean, median and count within the posted polygon (GeoJSON in
+    ## EPSG:4326) for all intersecting scenes
+    geojson = request.get_json(silent=True)
+    try:
+        data = get_aggregate_timeseries(geojson)
+    except ValueError as e:
+        abort(400, str(e))
+
+    return jsonify(data)
+
+
+@app.route('/batch', methods=['POST'])
+def batch():
+
+    ## Get points ([[latitude, longitude], ...] in EPSG:4326) and output
+    ## format ('csv' or 'parquet') from the posted JSON
+    body = request.get_json(silent=True) or {}
+    fmt = body.get('format', request.args.get('format', 'csv'))
+    try:
+        points = [(float(lat), float(lng)) for lat, lng in body['points']]
+    except (KeyError, TypeError, ValueError):
+        abort(400, "Expected JSON with 'points' as list of [latitude, "
+                   "longitude].")
+    if len(points) == 0:
+        abort(400, "No points were passed.")
+
+    lats = [p[0] for p in points]
+    lngs = [p[1] for p in points]
+    series = iter_batch_timeseries(lats, lngs)
+
+    ## Results are streamed scene by scene
+    if fmt == 'parquet':
+        if not parquet_available():
+            abort(400, "Parquet output requires pyarrow to be installed.")
+        return Response(stream_with_context(
+                            stream_parquet(lats, lngs, series)),
+                        mimetype='application/vnd.apache.parquet',
+                        headers={'Content-Disposition':
+                                 'attachment; filename=timeseries.parquet'})
+    if fmt == 'csv':
+        return Response(stream_with_context(stream_csv(lats, lngs, series)),
+                        mimetype='text/csv',
+                        headers={'Content-Disposition':
+                                 'attachment; filename=timeseries.csv'})
+
+    abort(400, f"Unknown format '{fmt}'.")
+
+
+@app.route('/api/timeseries')
+def api_timeseries():
+
+    ## Get latitude, longitude and projection from query parameters
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    proj = request.args.get('proj', type=str)
+    if lat is None or lng is None or proj is None:
+        abort(400, "The parameters 'lat', 'lng' and 'proj' are required.")
+    try:
+        filters = parse_scene_filters(request.args)
+    except ValueError as e:
+        abort(400, str(e))
+
+    data = get_timeseries_data(latitude=lat, longitude=lng, projection=proj,
+                               filters=filters)
+
+    ## With 'format=bin' the dates are returned as float64 (milliseconds
+    ## since 1970-01-01 UTC) followed by the values as float32 (NaN if no
+    ## value is available). The limits of the y-axis are sent as header.
+    if request.args.get('format') == 'bin':
+        values = [np.nan if v is None else v for v in data['values']]
+        body = np.asarray(data['dates'], dtype='<f8').tobytes() + \
+            np.asarray(values, dtype='<f4').tobytes()
+
+        rv = Response(body, mimetype='application/octet-stream')
+        rv.headers['X-Count'] = str(len(values))
+        rv.headers['X-Y-Range'] = f"{data['y_range'][0]},{data['y_range'][1]}"
+
+        return rv
+
+    return jsonify(data)
+
+
+@app.route('/composite', methods=['POST'])
+def composite():
+
+    ## Create a composite ('stat' is 'mean', 'median', 'std', 'min', 'max'
+    ## or a percentile like 'p90') of the scenes matching the filters passed
+    ## as query parameters. Composites are cached, so switching back to a
+    ## composite on the map doesn't compute it again. Composites that don't
+    ## exist yet are created in the background like change maps.
+    stat = request.values.get('stat', 'mean')
+    try:
+        filters = parse_scene_filters(request.values)
+        layer, exists = get_composite_layer(stat, filters)
+    except ValueError as e:
+        abort(400, str(e))
+
+    if exists:
+        return jsonify({'layer': layer,
+                        'tiles': f'/tiles/{layer}/{{z}}/{{x}}/{{y}}.png'})
+
+    job_worker.submit(layer, create_composite, stat, filters)
+
+    return jsonify({'layer': layer,
+                    'status': url_for('job_status', key=layer)}), 202
+
+
+@app.route('/change', methods=['POST'])
+def change():
+
+    ## Create a change map ('method' is 'log_ratio' or 'difference') between
+    ## the windows 'a_from'/'a_to' and 'b_from'/'b_to' (YYYY-MM-DD). Other
+    ## filters (orbit, polarisation, sensor) apply to both windows.
+    ## Change maps that don't exist yet are created in the background and
+    ## '202 Accepted' is returned with the url of the job's status.
+    method = request.values.get('method', 'log_ratio')
+    try:
+        filters = parse_scene_filters(request.values)
+        filters_a = dict(filters, **parse_scene_filters(
+            {'date_from': request.values.get('a_from'),
+             'date_to': request.values.get('a_to')}))
+        filters_b = dict(filters, **parse_scene_filters(
+            {'date_from': request.values.get('b_from'),
+             'date_to': request.values.get('b_to')}))
+        layer, exists = get_change_layer(filters_a, filters_b,
+                                         method=method)
+    except ValueError as e:
+        abort(400, str(e))
+
+    if exists:
+        return jsonify({'layer': layer,
+                        'tiles': f'/tiles/{layer}/{{z}}/{{x}}/{{y}}.png'})
+
+    job_worker.submit(layer, create_change_map, filters_a, filters_b,
+                      method=method)
+
+    return jsonify({'layer': layer,
+                    'status': url_for('job_status', key=layer)}), 202
+
+
+@app.route('/jobs/<string:key>')
+def job_status(key):
+
+    ## State of a job of the JobWorker (see ingest_fun.py). Jobs that are
+    ## done return the url of the tiles of the created layer.
+    status = job_worker.status(key)
+    if status is None:
+        abort(404)
+
+    if status['state'] == 'done':
+        layer = status['result']
+        status['tiles'] = f'/tiles/{layer}/{{z}}/{{x}}/{{y}}.png'
+
+    return jsonify(status)
+
+
+@app.route('/composites')
+def composites():
+
+    ## List time windows (monthly or seasonal) that contain scenes, which
+    ## can be passed to /composite as 'date_from' and 'date_to'
+    try:
+        windows = get_time_windows(request.args.get('period', 'month'))
+    except ValueError as e:
+        abort(400, str(e))
+
+    return jsonify(windows)
+
+
+@app.route('/metrics')
+def metrics():
+
+    ## Latency histograms of the stages and counters of scenes, bytes and
+    ## cache requests in the Prometheus text format
+    return Response(render_metrics(),
+                    content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@app.route('/status')
+def status():
+
+    ## State, progress and throughput of each stage of the ingestion
+    return jsonify(ingest_worker.status())
+
+
+@app.route('/cache')
+def cache_stats():
+
+    ## Hits, misses and size of the plot cache
+    return jsonify(plot_cache.stats())
@@ -1,12 +1,21 @@
 from flask_table import Table, Col, LinkCol
-from flask_app.models import Scene
+from flask_app import db
+from flask_app.models import Scene, Metadata
+from sqlite_fun import apply_scene_filters
 
 import os
 
+## Number of scenes listed on each page of the overview
+PAGE_SIZE = 100
+
 
 class OverviewTable(Table):
     classes = ['table table-striped']
     id = Col('ID')
+    date = Col('Date')
+    sensor = Col('Sensor')
+    orbit = Col('Orbit')
+    polarisation = Col('Polarisation')
     filename = Col('Filename')
     metadata = LinkCol('Metadata', 'meta', url_kwargs=dict(scene_id='id'))
 
@@ -17,49 +26,111 @@ class MetaTable(Table):
     val = Col('Value')
 
 
-def create_overview_table():
-
-    ## Query all scenes in the database
-    db_scenes = Scene.query.all()
+def create_overview_table(filters=None, after=None, before=None,
+                          page_size=PAGE_SIZE):
+    """Creates one page of the overview of all scenes, ordered by date.
+    Pages are selected by the date of the last (or first) scene of the
+    previous (or next) page, so only the scenes of the page are queried
+    with the index of Scene.date.
+
+    :param filters: Filters for the scenes (see parse_scene_filters() in
+        sqlite_fun.py). [dict]
+    :param after: Only list scenes acquired after this date (next page).
+        [datetime]
+    :param before: Only list scenes acquired before this date (previous
+        page). [datetime]
+    :param page_size: Number of scenes on the page. [int]
+
+    :return table: Table in html format. [str]
+    :return pages: Date of the first and last scene of the page and if
+        there are previous and next pages. [dict]
+    """
+
+    ## Only query the columns that are listed
+    query = db.session.query(Scene.id, Scene.date, Scene.sensor, Scene.orbit,
+                             Metadata.polarisation, Scene.filepath). \
+        join(Metadata, Metadata.scene_id == Scene.id)
+    query = apply_scene_filters(query, filters)
+
+    ## Get one more scene than needed to know if there is another page
+    if before is not None:
+        rows = query.filter(Scene.date < before). \
+            order_by(Scene.date.desc()).limit(page_size + 1).all()
+        has_more = len(rows) > page_size
+        rows = rows[:page_size][::-1]
+        has_prev, has_next = has_more, True
+    else:
+        if after is not None:
+            query = query.filter(Scene.date > after)
+        rows = query.order_by(Scene.date).limit(page_size + 1).all()
+        has_next = len(rows) > page_size
+        rows = rows[:page_size]
+        has_prev = after is not None
 
     ## Generate items to be listed
     items = []
-    for scene in db_scenes:
-        scene_info = {'id': scene.id,
-                      'filename': os.path.basename(scene.filepath)}
-
-        items.append(scene_info)
+    for scene_id, date, sensor, orbit, polarisation, filepath in rows:
+        items.append({'id': scene_id,
+                      'date': date.strftime("%Y-%m-%d %H:%M:%S"),
+                      'sensor': sensor,
+                      'orbit': orbit,
+                      'polarisation': polarisation,
+                      'filename': os.path.basename(filepath)})
 
     ## Populate the table
     table = OverviewTable(items)
 
+    pages = {'first': rows[0][1] if len(rows) > 0 else None,
+             'last': rows[-1][1] if len(rows) > 0 else None,
+             'has_prev': has_prev and len(rows) > 0,
+             'has_next': has_next and len(rows) > 0}
+
     ##  Return table as html
-    return table.__html__()
+    return table.__html__(), pages
+
+
+def get_filter_options():
+    """Gets the values that scenes can be filtered by on the overview.
+
+    :return: Sensors, orbits and polarisations in the database. [dict]
+    """
+    return {'sensor': [v for (v,) in db.session.query(Scene.sensor).
+                       distinct().order_by(Scene.sensor)],
+            'orbit': [v for (v,) in db.session.query(Scene.orbit).
+                      distinct().order_by(Scene.orbit)],
+            'polarisation': [v for (v,) in db.session.query(
+                Metadata.polarisation).distinct().
+                order_by(Metadata.polarisation)]}
+
 
+def create_meta_table(scene, meta, geo):
+    """Creates the table of the metadata of a scene.
 
-def create_meta_table(scene):
+    :param scene: Scene. [Scene]
+    :param meta: Metadata of the scene. [Metadata]
+    :param geo: Geometry of the scene. [Geometry]
 
-    ## Query metadata for the given scene
-    meta = scene.meta.all()
-    geo = scene.geo.all()
+    :return: Table in html format. [str]
+    """
 
     ## Generate items to be listed
     items = [dict(attr='Scene ID', val=scene.id),
              dict(attr='Date', val=scene.date),
              dict(attr='Sensor', val=scene.sensor),
              dict(attr='Orbit', val=scene.orbit),
-             dict(attr='Acquisition Mode', val=meta[0].acq_mode),
-             dict(attr='Polarisation', val=meta[0].polarisation),
-             dict(attr='Resolution (m)', val=meta[0].resolution),
-             dict(attr='Band Min', val=meta[0].band_min),
-             dict(attr='Band Max', val=meta[0].band_max),
-             dict(attr='Columns, Rows', val=f"{geo[0].columns}, "
-                                            f"{geo[0].rows}"),
-             dict(attr='EPSG', val=geo[0].epsg),
-             dict(attr='Bounds North', val=geo[0].bounds_north),
-             dict(attr='Bounds South', val=geo[0].bounds_south),
-             dict(attr='Bounds East', val=geo[0].bounds_east),
-             dict(attr='Bounds West', val=geo[0].bounds_west)]
+             dict(attr='Acquisition Mode', val=meta.acq_mode),
+             dict(attr='Polarisation', val=meta.polarisation),
+             dict(attr='Resolution (m)', val=meta.resolution),
+             dict(attr='Band Min', val=meta.band_min),
+             dict(attr='Band Max', val=meta.band_max),
+             dict(attr='Band Statistics', val=meta.stats_mode),
+             dict(attr='Columns, Rows', val=f"{geo.columns}, "
+                                            f"{geo.rows}"),
+             dict(attr='EPSG', val=geo.epsg),
+             dict(attr='Bounds North', val=geo.bounds_north),
+             dict(attr='Bounds South', val=geo.bounds_south),
+             dict(attr='Bounds East', val=geo.bounds_east),
+             dict(attr='Bounds West', val=geo.bounds_west)]
 
     ## Populate the table
     table = MetaTable(items)
@@ -0,0 +1,422 @@
+from config import Timeseries
+from metrics_fun import bytes_read
+
+from osgeo import gdal, ogr, osr
+from osgeo.gdalconst import GA_ReadOnly
+from collections import OrderedDict
+from contextlib import contextmanager
+import threading
+import numpy as np
+gdal.UseExceptions()
+
+## Limit the size of GDAL's block cache, which is shared by all open datasets
+gdal.SetCacheMax(Timeseries.block_cache * 1024 * 1024)
+
+
+class DatasetPool(object):
+    """Keeps a limited number of GDAL datasets open, so a scene doesn't
+    have to be opened again every time a value is read from it. Datasets
+    are keyed by their filepath (see Scene.filepath) and the least
+    recently used dataset is closed once the pool is full.
+
+    GDAL datasets must not be used by multiple threads at the same time,
+    so a dataset is checked out of the pool while it is read (see
+    checkout()). Threads that read the same file at once get their own
+    datasets, and 'lock' is only held to update the pool.
+    """
+
+    def __init__(self, max_size=None):
+        if max_size is None:
+            max_size = Timeseries.pool_size
+
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        ## Idle datasets of each file (most recently returned last)
+        self._datasets = OrderedDict()
+        ## Number of times each file was evicted, so datasets that were
+        ## checked out before are closed instead of returned to the pool
+        self._evictions = {}
+
+    def __len__(self):
+        with self.lock:
+            return sum(len(d) for d in self._datasets.values())
+
+    @contextmanager
+    def checkout(self, filepath):
+        """Takes an open dataset of the given file out of the pool while it
+        is used and returns it afterwards. The file is opened if the pool
+        has no idle dataset of it.
+
+        :param filepath: Full path of a raster file. [str]
+
+        :return: osgeo.gdal.Dataset
+        """
+        with self.lock:
+            idle = self._datasets.get(filepath)
+            data = idle.pop() if idle else None
+            if idle is not None and len(idle) == 0:
+                del self._datasets[filepath]
+            evictions = self._evictions.get(filepath, 0)
+
+        ## Files are opened outside of the lock, so other threads aren't
+        ## blocked in the meantime
+        if data is None:
+            data = gdal.Open(filepath, GA_ReadOnly)
+
+        try:
+            yield data
+        finally:
+            self._return(filepath, data, evictions)
+
+    def evict(self, filepath):
+        """Closes the datasets of the given file (e.g. because the file was
+        changed or removed).
+
+        :param filepath: Full path of a raster file. [str]
+        """
+        with self.lock:
+            self._datasets.pop(filepath, None)
+            self._evictions[filepath] = self._evictions.get(filepath, 0) + 1
+
+    def clear(self):
+        """Closes all idle datasets of the pool."""
+        with self.lock:
+            self._datasets.clear()
+
+    def _return(self, filepath, data, evictions):
+        with self.lock:
+            if self._evictions.get(filepath, 0) != evictions:
+                return
+
+            self._datasets.setdefault(filepath, []).append(data)
+            self._datasets.move_to_end(filepath)
+
+            ## Close least recently used datasets
+            n = sum(len(d) for d in self._datasets.values())
+            while n > self.max_size:
+                oldest = next(iter(self._datasets))
+                self._datasets[oldest].pop(0)
+                if len(self._datasets[oldest]) == 0:
+                    del self._datasets[oldest]
+                n -= 1
+
+
+## Pool that is shared by all requests of the webapp
+dataset_pool = DatasetPool()
+
+
+def get_srs(epsg):
+    """Creates a spatial reference with x/y (longitude/latitude) axis order.
+
+    :param epsg: EPSG code. [str or int]
+
+    :return: osgeo.osr.SpatialReference
+    """
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(int(epsg))
+    srs.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+
+    return srs
+
+
+def transform_point(x, y, source, target):
+    """Transforms a single coordinate between two projections.
+
+    :param x: X coordinate (or longitude). [float]
+    :param y: Y coordinate (or latitude). [float]
+    :param source: EPSG code of the coordinate. [str or int]
+    :param target: EPSG code to transform into. [str or int]
+
+    :return: Transformed coordinate (x, y). [tuple]
+    """
+    if source is None or target is None or str(source) == str(target):
+        return x, y
+
+    transform = osr.CoordinateTransformation(get_srs(source), get_srs(target))
+    x_out, y_out, _ = transform.TransformPoint(x, y)
+
+    return x_out, y_out
+
+
+def read_pixel(dataset, x, y, nodata=None):
+    """Reads the value of the pixel that contains the given coordinate.
+
+    :param dataset: osgeo.gdal.Dataset
+    :param x: X coordinate in the projection of the dataset. [float]
+    :param y: Y coordinate in the projection of the dataset. [float]
+    :param nodata: Nodata value of the dataset. If None, the nodata value
+        stored in the file is used. [float]
+
+    :return: Pixel value or nan if the coordinate is outside of the dataset
+        or the pixel is nodata. [float]
+    """
+    inv_transform = gdal.InvGeoTransform(dataset.GetGeoTransform())
+    px, py = gdal.ApplyGeoTransform(inv_transform, x, y)
+    col = int(np.floor(px))
+    row = int(np.floor(py))
+
+    if not (0 <= col < dataset.RasterXSize and 0 <= row < dataset.RasterYSize):
+        return np.nan
+
+    band = dataset.GetRasterBand(1)
+    value = float(band.ReadAsArray(col, row, 1, 1)[0, 0])
+    _count_bytes_read(band, col, row, 1, 1, read='pixel')
+
+    if nodata is None:
+        nodata = band.GetNoDataValue()
+    if nodata is not None and value == nodata:
+        return np.nan
+
+    return value
+
+
+def transform_points(xs, ys, source, target):
+    """Transforms multiple coordinates between two projections at once.
+
+    :param xs: X coordinates (or longitudes). [numpy.ndarray]
+    :param ys: Y coordinates (or latitudes). [numpy.ndarray]
+    :param source: EPSG code of the coordinates. [str or int]
+    :param target: EPSG code to transform into. [str or int]
+
+    :return: Transformed coordinates (xs, ys). [tuple of numpy.ndarray]
+    """
+    xs = np.asarray(xs, dtype=np.float64)
+    ys = np.asarray(ys, dtype=np.float64)
+    if source is None or target is None or str(source) == str(target):
+        return xs, ys
+
+    transform = osr.CoordinateTransformation(get_srs(source), get_srs(target))
+    points = np.array(transform.TransformPoints(
+        np.column_stack((xs, ys)).tolist()), dtype=np.float64)
+
+    return points[:, 0], points[:, 1]
+
+
+def read_points(dataset, xs, ys, nodata=None):
+    """Reads the values of the pixels that contain the given coordinates.
+    Points are grouped by the block of the raster they are located in, so
+    each block is only read once.
+
+    :param dataset: osgeo.gdal.Dataset
+    :param xs: X coordinates in the projection of the dataset.
+        [numpy.ndarray]
+    :param ys: Y coordinates in the projection of the dataset.
+        [numpy.ndarray]
+    :param nodata: Nodata value of the dataset. If None, the nodata value
+        stored in the file is used. [float]
+
+    :return: Pixel values (nan if a coordinate is outside of the dataset or
+        the pixel is nodata). [numpy.ndarray]
+    """
+    inv = gdal.InvGeoTransform(dataset.GetGeoTransform())
+    cols = np.floor(inv[0] + inv[1] * xs + inv[2] * ys).astype(np.int64)
+    rows = np.floor(inv[3] + inv[4] * xs + inv[5] * ys).astype(np.int64)
+
+    values = np.full(len(cols), np.nan)
+    inside = np.nonzero((cols >= 0) & (cols < dataset.RasterXSize)
+                        & (rows >= 0) & (rows < dataset.RasterYSize))[0]
+    if len(inside) == 0:
+        return values
+
+    band = dataset.GetRasterBand(1)
+    block_x, block_y = band.GetBlockSize()
+    n_blocks_x = -(-dataset.RasterXSize // block_x)
+
+    ## Sort points by block and read each block once
+    blocks = (rows[inside] // block_y) * n_blocks_x + cols[inside] // block_x
+    order = np.argsort(blocks, kind='stable')
+    block_ids, starts = np.unique(blocks[order], return_index=True)
+
+    for block_id, points in zip(block_ids,
+                                np.split(inside[order], starts[1:])):
+        block_row, block_col = divmod(int(block_id), n_blocks_x)
+        x_off = block_col * block_x
+        y_off = block_row * block_y
+        block = band.ReadAsArray(x_off, y_off,
+                                 min(block_x, dataset.RasterXSize - x_off),
+                                 min(block_y, dataset.RasterYSize - y_off))
+        values[points] = block[rows[points] - y_off, cols[points] - x_off]
+    bytes_read.inc(len(block_ids) * _get_block_bytes(band), read='points')
+
+    if nodata is None:
+        nodata = band.GetNoDataValue()
+    if nodata is not None:
+        values[values == nodata] = np.nan
+
+    return values
+
+
+def read_timeseries(scenes, x, y, epsg=None, pool=None):
+    """Reads the value of a single location from multiple scenes.
+
+    :param scenes: Scenes to read from. Each entry is a tuple of
+        (filepath, epsg, nodata) of a scene. [list]
+    :param x: X coordinate. [float]
+    :param y: Y coordinate. [float]
+    :param epsg: EPSG code of the coordinate. If None, the coordinate is
+        expected to be in the projection of each scene. [str or int]
+    :param pool: DatasetPool to read from. Defaults to the shared pool.
+
+    :return: List of extracted values (nan where no value is available).
+    """
+    if pool is None:
+        pool = dataset_pool
+
+    ## Transform the coordinate only once for each projection
+    coords = {}
+
+    values = []
+    for filepath, scene_epsg, nodata in scenes:
+        if scene_epsg not in coords:
+            coords[scene_epsg] = transform_point(x, y, epsg, scene_epsg)
+        scene_x, scene_y = coords[scene_epsg]
+
+        with pool.checkout(filepath) as data:
+            values.append(read_pixel(data, scene_x, scene_y, nodata))
+
+    return values
+
+
+def transform_geometry(geometry, source, target):
+    """Transforms a geometry between two projections.
+
+    :param geometry: osgeo.ogr.Geometry
+    :param source: EPSG code of the geometry. [str or int]
+    :param target: EPSG code to transform into. [str or int]
+
+    :return: Transformed copy of the geometry. [osgeo.ogr.Geometry]
+    """
+    geometry = geometry.Clone()
+    if str(source) != str(target):
+        geometry.Transform(osr.CoordinateTransformation(get_srs(source),
+                                                        get_srs(target)))
+
+    return geometry
+
+
+def read_polygon(dataset, geometry, nodata=None):
+    """Reads the values of all pixels within a polygon. Only the window of
+    the dataset that covers the polygon is read. Pixels are selected with a
+    mask of the rasterized polygon (pixels whose center is inside the
+    polygon, or all touched pixels if the polygon is smaller than a pixel).
+
+    :param dataset: osgeo.gdal.Dataset
+    :param geometry: Polygon in the projection of the dataset.
+        [osgeo.ogr.Geometry]
+    :param nodata: Nodata value of the dataset. If None, the nodata value
+        stored in the file is used. [float]
+
+    :return: Values of all valid pixels within the polygon.
+        [numpy.ndarray]
+    """
+    transform = dataset.GetGeoTransform()
+    inv_transform = gdal.InvGeoTransform(transform)
+
+    ## Get window of the dataset that covers the polygon
+    minx, maxx, miny, maxy = geometry.GetEnvelope()
+    px = [gdal.ApplyGeoTransform(inv_transform, x, y)
+          for x, y in ((minx, maxy), (maxx, miny))]
+    col_min = max(int(np.floor(min(p[0] for p in px))), 0)
+    col_max = min(int(np.ceil(max(p[0] for p in px))), dataset.RasterXSize)
+    row_min = max(int(np.floor(min(p[1] for p in px))), 0)
+    row_max = min(int(np.ceil(max(p[1] for p in px))), dataset.RasterYSize)
+
+    if col_max <= col_min or row_max <= row_min:
+        return np.empty(0)
+
+    cols = col_max - col_min
+    rows = row_max - row_min
+    band = dataset.GetRasterBand(1)
+    values = band.ReadAsArray(col_min, row_min, cols, rows).astype(np.float64)
+    _count_bytes_read(band, col_min, row_min, cols, rows, read='polygon')
+
+    ## Create mask of the polygon with the transform of the window
+    window_transform = list(transform)
+    window_transform[0], window_transform[3] = gdal.ApplyGeoTransform(
+        transform, col_min, row_min)
+    mask = _rasterize(geometry, window_transform, cols, rows)
+    if not mask.any():
+        mask = _rasterize(geometry, window_transform, cols, rows,
+                          all_touched=True)
+
+    if nodata is None:
+        nodata = band.GetNoDataValue()
+    valid = mask & np.isfinite(values)
+    if nodata is not None:
+        valid &= values != nodata
+
+    return values[valid]
+
+
+def aggregate_timeseries(scenes, geometry, epsg, pool=None):
+    """Calculates mean, median and number of valid pixels within a polygon
+    for multiple scenes. Each scene is read once (see read_polygon()).
+
+    :param scenes: Scenes to read from. Each entry is a tuple of
+        (filepath, epsg, nodata) of a scene. [list]
+    :param geometry: Polygon. [osgeo.ogr.Geometry]
+    :param epsg: EPSG code of the polygon. [str or int]
+    :param pool: DatasetPool to read from. Defaults to the shared pool.
+
+    :return: List of (mean, median, count) of each scene (mean and median
+        are nan if the polygon doesn't contain valid pixels).
+    """
+    if pool is None:
+        pool = dataset_pool
+
+    ## Transform the polygon only once for each projection
+    geometries = {}
+
+    stats = []
+    for filepath, scene_epsg, nodata in scenes:
+        if scene_epsg not in geometries:
+            geometries[scene_epsg] = transform_geometry(geometry, epsg,
+                                                        scene_epsg)
+
+        with pool.checkout(filepath) as data:
+            values = read_polygon(data, geometries[scene_epsg], nodata)
+
+        if values.size == 0:
+            stats.append((np.nan, np.nan, 0))
+        else:
+            stats.append((float(values.mean()), float(np.median(values)),
+                          int(values.size)))
+
+    return stats
+
+
+def _get_block_bytes(band):
+    ## Size of a block of the band in bytes
+    block_x, block_y = band.GetBlockSize()
+
+    return block_x * block_y * gdal.GetDataTypeSize(band.DataType) // 8
+
+
+def _count_bytes_read(band, x_off, y_off, cols, rows, read):
+    ## Adds the size of all blocks that cover a window of the band to the
+    ## bytes read (see bytes_read in metrics_fun.py)
+    block_x, block_y = band.GetBlockSize()
+    n_x = (x_off + cols - 1) // block_x - x_off // block_x + 1
+    n_y = (y_off + rows - 1) // block_y - y_off // block_y + 1
+    bytes_read.inc(n_x * n_y * _get_block_bytes(band), read=read)
+
+
+def _rasterize(geometry, transform, cols, rows, all_touched=False):
+    """Rasterizes a geometry onto a grid and returns it as boolean mask."""
+    mem = gdal.GetDriverByName('MEM').Create('', cols, rows, 1, gdal.GDT_Byte)
+    mem.SetGeoTransform(transform)
+
+    source = ogr.GetDriverByName('Memory').CreateDataSource('')
+    layer = source.CreateLayer('polygon')
+    feature = ogr.Feature(layer.GetLayerDefn())
+    feature.SetGeometry(geometry)
+    layer.CreateFeature(feature)
+
+    options = ['ALL_TOUCHED=TRUE'] if all_touched else []
+    gdal.RasterizeLayer(mem, [1], layer, burn_values=[1], options=options)
+    mask = mem.GetRasterBand(1).ReadAsArray().astype(bool)
+
+    mem = None
+    source = None
+
+    return mask
@@ -1,5 +1,18 @@
-from config import Grass
-from flask_app.models import Scene, Metadata
+from config import Grass, Timeseries, Cube, Ingest, Composite
+from flask_app import db
+from flask_app.models import Scene, Metadata, Geometry
+from gdal_fun import dataset_pool, read_timeseries, read_points, \
+    transform_point, transform_points, aggregate_timeseries, \
+    transform_geometry
+from spatial_fun import query_spatial_index
+from cube_fun import cube_exists, update_cube, publish_cube, read_cube
+from tile_fun import tile_cache
+from cache_fun import plot_cache, make_key
+from sqlite_fun import get_generation, get_summary, apply_scene_filters
+from progress_fun import IngestProgress
+from metrics_fun import timed, measure
+from composite_fun import create_composite_raster, create_change_raster, \
+    get_reducer, CHANGE_METHODS
 
 from grass_session import Session, get_grass_gisbase
 import grass.script as gscript
@@ -8,42 +21,158 @@ from progress.bar import Bar
 import os
 import sys
 import re
+import json
+import time
+import shutil
+import threading
+import hashlib
 import numpy as np
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from osgeo import ogr, osr
 from bokeh.plotting import figure
+from bokeh.models import ColumnDataSource
 from bokeh.resources import CDN
-from bokeh.embed import file_html
-
-
-def grass_main(scenes, epsg):
-    """This workflow will be triggered every time new scenes are added to the
-    database. If it's triggered for the first time, a GRASS project will be
-    set up first using the most common CRS / EPSG code of the dataset in a
-    subdirectory of the provided data directory.
-    A GRASS session is then started and each scene imported to the GRASS
-    project.
-    At the end an average raster will be calculated of all scenes currently
-    imported in the GRASS project and exported for visualization in the webapp.
-
-    :param scenes: List of scenes that was created while running db_main().
-        Each scene is listed as the full path.
+from bokeh.embed import file_html, components
+from datetime import datetime
+
+## Names of the accumulators in GRASS (see update_accumulators())
+ACC_MAPS = {'sum': 'acc_sum',
+            'sumsq': 'acc_sumsq',
+            'count': 'acc_count',
+            'min': 'acc_min',
+            'max': 'acc_max'}
+
+## Expressions to derive statistics from the accumulators
+ACC_STATS = {'mean': "{sum} / {count}",
+             'std': "sqrt(max({sumsq} / {count} - "
+                    "({sum} / {count}) * ({sum} / {count}), 0))",
+             'min': "{min}",
+             'max': "{max}"}
+
+## Methods of r.series used for each statistic if only part of the scenes
+## are used (see create_stat_raster())
+SERIES_METHODS = {'mean': 'average',
+                  'std': 'stddev',
+                  'min': 'minimum',
+                  'max': 'maximum'}
+
+## Number of scenes that are added to the accumulators per r.mapcalc call
+ACC_BATCH = 50
+
+## Locks of the composites that are currently computed (see
+## create_composite())
+_composite_locks = {}
+_composite_locks_lock = threading.Lock()
+
+
+def grass_main(added, changed, removed, epsg, progress=None, scenes=None,
+               publish=True):
+    """This workflow will be triggered every time scenes are added to,
+    changed in or removed from the database. If it's triggered for the first
+    time, a GRASS project will be set up first using the most common CRS /
+    EPSG code of the dataset in a subdirectory of the provided data directory.
+    A GRASS session is then started, removed scenes are removed from the
+    GRASS project and added or changed scenes are (re-)imported.
+    The scenes are also written to the datacube (see cube_fun.py), which is
+    used to extract timeseries.
+    At the end the accumulators (see update_accumulators()) are updated with
+    the changes and an average raster of all scenes currently imported in the
+    GRASS project is derived from them and exported for visualization in the
+    webapp.
+
+    :param added: Scenes that were added while running db_main(). Each scene
+        is listed as the full path. [set]
+    :param changed: Scenes that were changed. Also created while running
+        db_main(). [set]
+    :param removed: Scenes that were removed. Also created while running
+        db_main(). [set]
     :param epsg: Most common CRS in the dataset. Also created while running
-        db_main().
+        db_main(). If None, the existing GRASS project is used.
+    :param progress: Keeps track of the progress of each stage (see
+        IngestProgress in progress_fun.py). [IngestProgress]
+    :param scenes: Filepath, date and nodata value of all scenes of the
+        dataset once the changes are applied (see get_staged_scenes() in
+        sqlite_fun.py). Defaults to the scenes in the database. [list]
+    :param publish: If False, removed scenes are kept in the GRASS project
+        and the new average raster and datacube aren't used yet, so requests
+        keep using the previous dataset until the changes are published in
+        the database. They need to be published with publish_grass_changes()
+        afterwards (see IngestWorker in ingest_fun.py). [bool]
+
+    :return: Outputs that still need to be published (only if publish is
+        False). [dict]
     """
+    if progress is None:
+        progress = IngestProgress()
+    if scenes is None:
+        scenes = db.session.query(Scene.filepath, Scene.date,
+                                  Metadata.nodata). \
+            join(Metadata, Metadata.scene_id == Scene.id). \
+            order_by(Scene.date).all()
+    filepaths = [filepath for (filepath, date, nodata) in scenes]
 
     ## Setup GRASS project if it hasn't been done already
-    location_orig = os.path.join(Grass.path, f'Grass_db_{epsg}')
-    if not os.path.isdir(location_orig):
-        print(f"~~ Setting up GRASS project 'Grass_db_{epsg}'...")
-        setup_grass(crs=epsg)
+    if epsg is not None:
+        location_orig = os.path.join(Grass.path, f'Grass_db_{epsg}')
+        if not os.path.isdir(location_orig):
+            print(f"~~ Setting up GRASS project 'Grass_db_{epsg}'...")
+            setup_grass(crs=epsg)
 
-    ## Start GRASS session and import scenes
+    ## Start GRASS session
     start_grass_session(crs=epsg)
-    import_to_grass(scenes)
+
+    ## Subtract removed and changed scenes from the accumulators while they
+    ## are still available in GRASS. Then remove old scenes and import new
+    ## scenes and add them to the accumulators.
+    ## Linked scenes (see import_to_grass()) always read the current version
+    ## of a file, so their old values can't be subtracted. The accumulators
+    ## are rebuilt from all scenes instead.
+    if Ingest.grass_import == 'link' and len(removed) + len(changed) > 0:
+        _remove_accumulators()
+    update_accumulators(removed=removed | changed, progress=progress,
+                        scenes=filepaths)
+    if publish and len(removed) > 0:
+        remove_from_grass(removed)
+    if len(added) + len(changed) > 0:
+        import_to_grass(sorted(added | changed), progress=progress,
+                        all_scenes=filepaths)
+    update_accumulators(added=added | changed, progress=progress,
+                        scenes=filepaths)
+
+    ## Update the datacube
+    pending = {'cube': None, 'rasters': []}
+    if Cube.enabled:
+        pending['cube'] = update_cube(get_common_grid(filepaths),
+                                      changed=changed, progress=progress,
+                                      scenes=scenes, publish=publish)
 
     ## Create average raster
-    create_avg_raster()
+    pending['rasters'].append(create_avg_raster(progress=progress,
+                                                publish=publish,
+                                                scenes=scenes))
+
+    if not publish:
+        return pending
+
+
+def publish_grass_changes(pending, removed):
+    """Replaces the average raster and the index of the datacube with the
+    outputs of grass_main() and removes scenes from the GRASS project that
+    can't be requested anymore. This is called once the changes have been
+    published in the database (see IngestWorker in ingest_fun.py).
+
+    :param pending: Outputs of grass_main() that haven't been published
+        yet. [dict]
+    :param removed: Scenes that were removed (see db_main() in
+        sqlite_fun.py). [set]
+    """
+    if pending['cube'] is not None:
+        publish_cube(pending['cube'])
+    for tmp_path, out_path, filename in pending['rasters']:
+        _publish_stat_raster(tmp_path, out_path, filename)
+    if len(removed) > 0:
+        remove_from_grass(removed)
 
 
 def setup_grass(crs):
@@ -79,6 +208,23 @@ def setup_grass(crs):
     return print(f"GRASS project '{name}' was successfully created.")
 
 
+def grass_project_exists(crs=None):
+    """Checks if a GRASS project has been set up in Grass.path (see
+    setup_grass()).
+
+    :param crs: EPSG code of the project (see start_grass_session()). If
+        None, any project counts. [str]
+
+    :return: True if the project exists. [bool]
+    """
+    if not os.path.isdir(Grass.path):
+        return False
+    if crs is None:
+        return any(re.search('GRASS_db_', x) for x in os.listdir(Grass.path))
+
+    return os.path.isdir(os.path.join(Grass.path, f'GRASS_db_{crs}'))
+
+
 def start_grass_session(crs=None):
     """Starts a GRASS session, provided it has been setup before (see
     setup_grass()). This will only search for GRASS projects located in
@@ -116,21 +262,53 @@ def start_grass_session(crs=None):
     print(f"~~ Current GRASS GIS environment: \n {gscript.gisenv()}")
 
 
-def import_to_grass(scenes):
+@timed('import_to_grass')
+def import_to_grass(scenes, mode=None, workers=None, progress=None,
+                    all_scenes=None):
     """Import of multiple scenes into the currently active GRASS session.
 
     :param scenes: List of scenes that should be imported. Each entry in
         the list is a full path (e.g.
         'D:\\GEO450_data\\S1A__IW___A_20150320T182611_147_VV_grd_mli_norm_geo_db
         .tif')
+    :param mode: 'copy' imports each scene with r.in.gdal, which copies the
+        data into the GRASS database. 'link' only registers each scene with
+        r.external, so no data is copied. 'parallel' runs multiple
+        r.in.gdal imports at once (see _import_parallel()). Defaults to
+        Ingest.grass_import (see config.py). [str]
+    :param workers: Number of parallel imports if mode is 'parallel'.
+        Defaults to Ingest.grass_workers (see config.py). [int]
+    :param progress: See grass_main(). [IngestProgress]
+    :param all_scenes: All scenes of the dataset, which the default region
+        is extended to if mode is 'parallel'. Defaults to the scenes in the
+        database. [list]
 
     :returns: Newly imported scenes in the GRASS session.
     """
+    if mode is None:
+        mode = Ingest.grass_import
+    if workers is None:
+        workers = Ingest.grass_workers
+    if progress is None:
+        progress = IngestProgress()
+
+    if mode not in ('copy', 'link', 'parallel'):
+        raise ValueError(f"Unknown import mode '{mode}'. Use 'copy', 'link' "
+                         f"or 'parallel'.")
 
     print(f"~~ {len(scenes)} scenes will be imported to the current "
           f"GRASS project. Depending on the size of each file, this might "
           f"take a few minutes...")
 
+    progress.start('import', total=len(scenes))
+
+    if mode == 'parallel' and workers > 1 and len(scenes) > 1:
+        _import_parallel(scenes, workers, progress, all_scenes)
+        progress.finish()
+        return
+
+    module = 'r.external' if mode == 'link' else 'r.in.gdal'
+
     bar = Bar('Importing', max=len(scenes))
     for scene in scenes:
         ## Define filename
@@ -140,59 +318,675 @@ def import_to_grass(scenes):
         ## Run GRASS Import module
         ## (Flag 'e': Extend region extents based on new dataset. Also updates
         ## the default region if in the PERMANENT mapset)
-        gscript.run_command("r.in.gdal", input=scene, output=scene_name,
-                            flags="e", quiet=True)
+        gscript.run_command(module, input=scene, output=scene_name,
+                            flags="e", quiet=True, overwrite=True)
         bar.next()
+        progress.advance(nbytes=os.path.getsize(scene))
     bar.finish()
+    progress.finish()
 
 
-def create_avg_raster():
-    """Important part of the main GRASS workflow. An average
-    raster of all scenes in the database is created to display on the main map
-    of the webapp. This file will be updated if new scenes have been added
-    to the database.
+def _import_parallel(scenes, workers, progress, all_scenes=None):
+    """Imports scenes with multiple r.in.gdal processes at once. Each worker
+    imports its share of the scenes into its own temporary mapset, because
+    GRASS modules of the same mapset shouldn't run in parallel. Afterwards
+    the scenes are copied into the PERMANENT mapset and the temporary
+    mapsets are removed.
 
-    :returns: 'avg_raster.tif' as a cloud optimized GeoTIFF
+    :param scenes: List of scenes that should be imported. Each entry in
+        the list is a full path.
+    :param workers: Number of parallel imports. [int]
+    :param progress: See grass_main(). [IngestProgress]
+    :param all_scenes: See import_to_grass(). [list]
+    """
+    env = gscript.gisenv()
+    location_dir = os.path.join(env['GISDBASE'], env['LOCATION_NAME'])
+
+    workers = min(workers, len(scenes))
+    batches = [scenes[i::workers] for i in range(workers)]
+    mapsets = [f'tmp_import_{i}' for i in range(workers)]
+
+    def work(i):
+        ## Create temporary mapset (a directory with the region of the
+        ## project is all GRASS needs) and a GISRC file pointing to it
+        mapset_dir = os.path.join(location_dir, mapsets[i])
+        if not os.path.isdir(mapset_dir):
+            os.makedirs(mapset_dir)
+        shutil.copy(os.path.join(location_dir, 'PERMANENT', 'DEFAULT_WIND'),
+                    os.path.join(mapset_dir, 'WIND'))
+
+        gisrc = os.path.join(mapset_dir, 'gisrc')
+        with open(gisrc, 'w') as f:
+            f.write(f"GISDBASE: {env['GISDBASE']}\n"
+                    f"LOCATION_NAME: {env['LOCATION_NAME']}\n"
+                    f"MAPSET: {mapsets[i]}\n"
+                    f"GUI: text\n")
+        worker_env = os.environ.copy()
+        worker_env['GISRC'] = gisrc
+
+        start = time.time()
+        for n, scene in enumerate(batches[i]):
+            gscript.run_command("r.in.gdal", input=scene,
+                                output=_get_map_name(scene), quiet=True,
+                                overwrite=True, env=worker_env)
+            progress.advance(nbytes=os.path.getsize(scene))
+            print(f"~~ [Worker {i + 1}/{workers}] {n + 1}/{len(batches[i])} "
+                  f"imported: {os.path.basename(scene)}")
+
+        print(f"~~ [Worker {i + 1}/{workers}] Finished {len(batches[i])} "
+              f"scenes in {time.time() - start:.1f} s")
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(work, range(workers)))
+
+    ## Copy scenes into the PERMANENT mapset and remove temporary mapsets
+    for mapset, batch in zip(mapsets, batches):
+        for scene in batch:
+            name = _get_map_name(scene)
+            gscript.run_command('g.copy', raster=f'{name}@{mapset},{name}',
+                                overwrite=True, quiet=True)
+        shutil.rmtree(os.path.join(location_dir, mapset))
+
+    ## Extend the default region to all scenes (like flag 'e' of r.in.gdal)
+    ## (Flag 's': Save as default region)
+    if all_scenes is None:
+        all_scenes = [s.filepath for s in Scene.query.all()]
+    names = [_get_map_name(s) for s in all_scenes]
+    gscript.run_command('g.region', raster=names, flags='s')
+
+
+def remove_from_grass(scenes):
+    """Removes multiple scenes from the currently active GRASS session.
+
+    :param scenes: List of scenes that should be removed. Each entry in
+        the list is a full path.
     """
 
-    ## Define filename and path of the output
-    filename = 'avg_raster'
-    out_path = os.path.join(Grass.path_out, f'{filename}.tif')
+    ## List basename of all scenes
+    names = []
+    for scene in scenes:
+        base = os.path.basename(scene)
+        names.append(base[:-len(Path(base).suffix)])
+
+    print(f"~~ {len(names)} scenes will be removed from the current "
+          f"GRASS project.")
+
+    gscript.run_command('g.remove', type='raster', name=names, flags='f',
+                        quiet=True)
 
-    ## Get all scenes currently stored in the database
-    all_scenes = Scene.query.all()
 
-    print(f"~~ Creating average raster from {len(all_scenes)} scenes:")
+def get_common_grid(filepaths=None):
+    """Computes the extent of all scenes in the database and returns it as
+    the common grid of the GRASS project. The computational region isn't
+    changed (flag 'u' of g.region), because it's shared with modules that
+    run at the same time (e.g. r.mapcalc during an ingestion).
+
+    :param filepaths: Use the extent of these scenes instead (e.g. the
+        scenes of an ingestion that isn't published yet, see grass_main()).
+        [list]
+
+    :return: Projection (EPSG code), geotransform, rows and columns of the
+        common grid. [dict]
+    """
+    if filepaths is None:
+        filepaths = [s.filepath for s in Scene.query.all()]
 
     ## List basename of all scenes
-    scenes = []
-    for s in all_scenes:
-        base = os.path.basename(s.filepath)
-        scenes.append(base[:-len(Path(base).suffix)])
+    scenes = [_get_map_name(f) for f in filepaths]
+
+    ## Compute the region without setting it
+    region = {k: float(v) for k, v in gscript.parse_command(
+        'g.region', raster=scenes, flags='gu').items()}
+
+    ## The EPSG code is part of the project name (see setup_grass())
+    epsg = gscript.gisenv()['LOCATION_NAME'].split('_')[-1]
+
+    return {'epsg': epsg,
+            'transform': [region['w'], region['ewres'], 0.0,
+                          region['n'], 0.0, -region['nsres']],
+            'rows': int(region['rows']),
+            'cols': int(region['cols'])}
+
+
+def update_accumulators(added=(), removed=(), progress=None, scenes=None):
+    """Updates the accumulators of the GRASS project, which store the sum,
+    sum of squares, count, minimum and maximum of all imported scenes for
+    each pixel. Only the added and removed scenes are processed, so the
+    statistics of the whole dataset don't have to be recomputed every time
+    new scenes are added (see create_stat_raster()).
+    Minimum and maximum can't be updated when scenes are removed. They are
+    marked as outdated instead and are recomputed the next time they're
+    needed.
+
+    :param added: Scenes that were imported to GRASS and should be added to
+        the accumulators. Each entry is a full path. [list or set]
+    :param removed: Scenes that should be subtracted from the accumulators.
+        They still need to be available in GRASS. [list or set]
+    :param progress: See grass_main(). [IngestProgress]
+    :param scenes: All scenes of the dataset, which the accumulators are
+        rebuilt from if necessary. Defaults to the scenes in the database.
+        [list]
+    """
+    if progress is None:
+        progress = IngestProgress()
+
+    ## The accumulators can't be updated if they don't exist or the list of
+    ## scenes they include is missing. They are rebuilt from all scenes in
+    ## the database once new scenes have been imported.
+    state = _load_acc_state()
+    if state is None:
+        if len(added) == 0:
+            return
+        print("~~ Accumulators don't exist yet and will be created from all "
+              "scenes in the database.")
+        _remove_accumulators()
+        state = {'scenes': [], 'minmax_outdated': False}
+        added = scenes if scenes is not None else \
+            [s.filepath for s in Scene.query.all()]
+        removed = []
+
+    ## Only add scenes that aren't included yet and only remove scenes that
+    ## are included
+    included = set(state['scenes'])
+    added = sorted(set(_get_map_name(s) for s in added) - included)
+    removed = sorted(set(_get_map_name(s) for s in removed) & included)
+
+    if len(added) + len(removed) == 0:
+        return
+
+    print(f"~~ Updating accumulators: {len(added)} scenes will be added and "
+          f"{len(removed)} removed...")
+    progress.start('accumulate', total=len(added) + len(removed))
+
+    for i in range(0, len(removed), ACC_BATCH):
+        _update_accumulators(removed[i:i + ACC_BATCH], subtract=True,
+                             first=False)
+        included -= set(removed[i:i + ACC_BATCH])
+        state['minmax_outdated'] = True
+        progress.advance(len(removed[i:i + ACC_BATCH]))
+
+    for i in range(0, len(added), ACC_BATCH):
+        _update_accumulators(added[i:i + ACC_BATCH], subtract=False,
+                             first=len(included) == 0)
+        included |= set(added[i:i + ACC_BATCH])
+        progress.advance(len(added[i:i + ACC_BATCH]))
+
+    state['scenes'] = sorted(included)
+    _save_acc_state(state)
+    progress.finish()
+
+
+def create_stat_raster(stat='mean', filename=None, progress=None,
+                       filters=None, publish=True, scenes=None):
+    """Derives a statistic of all scenes from the accumulators (see
+    update_accumulators()) and exports it for visualization in the webapp.
+    If filters are given, the statistic is computed with r.series from the
+    matching scenes only. If Composite.engine is 'numpy', the statistic is
+    computed with create_composite_raster() in composite_fun.py instead.
+
+    :param stat: 'mean', 'std', 'min' or 'max' (also 'median' and
+        percentiles like 'p90' with the 'numpy' engine). [str]
+    :param filename: Name of the output (without suffix). Defaults to
+        '{stat}_raster'. [str]
+    :param progress: See grass_main(). [IngestProgress]
+    :param filters: Only use scenes matching these filters (see
+        parse_scene_filters() in sqlite_fun.py). [dict]
+    :param publish: If False, the output is only written to a temporary
+        file and replaces '{filename}.tif' once it's published with
+        _publish_stat_raster() (see publish_grass_changes()). [bool]
+    :param scenes: All scenes of the dataset if they differ from the
+        database (see grass_main()). Only needed with the 'numpy' engine,
+        the accumulators always contain the scenes of the dataset. [list]
+
+    :returns: '{filename}.tif' as a cloud optimized GeoTIFF. If publish is
+        False, the temporary file, the output and the filename are returned
+        instead. [tuple]
+    """
+    if progress is None:
+        progress = IngestProgress()
+
+    ## Define filename and path of the output. The output is written to a
+    ## temporary file first, so the webapp keeps serving the previous
+    ## version until the new one is complete.
+    if filename is None:
+        filename = f'{stat}_raster'
+    out_path = os.path.join(Grass.path_out, f'{filename}.tif')
+    tmp_path = os.path.join(Grass.path_out, f'{filename}.tmp.tif')
 
-    ## Set computational region
-    gscript.run_command('g.region', raster=scenes)
+    if Composite.engine == 'numpy':
+        if scenes is not None:
+            grid = get_common_grid([f for (f, date, nodata) in scenes])
+            scenes = [(f, nodata) for (f, date, nodata) in scenes]
+        else:
+            grid = get_common_grid()
+        create_composite_raster(stat, tmp_path, grid, filters=filters,
+                                progress=progress, scenes=scenes)
+        if not publish:
+            return tmp_path, out_path, filename
+        _publish_stat_raster(tmp_path, out_path, filename)
+        return
+
+    if stat not in ACC_STATS:
+        raise ValueError(f"Unknown statistic '{stat}'. Use one of "
+                         f"{list(ACC_STATS.keys())}.")
+
+    ## The statistic is computed in a region of its own, so the region of
+    ## an ingestion running at the same time isn't changed
+    env = _get_region_env(filename)
+    try:
+        if filters:
+            _create_filtered_stat(stat, filename, filters, env)
+        else:
+            _create_acc_stat(stat, filename, progress, env)
+        _export_stat_raster(filename, tmp_path, env=env)
+    finally:
+        gscript.run_command('g.remove', type='region', name=filename,
+                            flags='f', quiet=True)
 
-    ## Use r.series to create aggregation of all scenes
-    gscript.run_command('r.series', input=scenes,
-                        output=filename, method='average',
-                        overwrite=True)
+    progress.advance()
+    progress.finish()
+
+    if not publish:
+        return tmp_path, out_path, filename
+    _publish_stat_raster(tmp_path, out_path, filename)
+
+
+def get_composite_layer(stat='mean', filters=None):
+    """Gets the name of the layer of a composite (see create_composite())
+    and whether it has been created already.
+
+    :param stat: See create_composite(). [str]
+    :param filters: See create_composite(). [dict]
+
+    :return: Name of the layer [str] and True if it exists. [bool]
+    """
+    if not filters and stat == 'mean':
+        return 'avg', os.path.isfile(os.path.join(Grass.path_out,
+                                                  'avg_raster.tif'))
+
+    ## Unknown statistics are rejected before the composite is created
+    if stat not in ACC_STATS:
+        get_reducer(stat)
+
+    prefix, layer = _get_layer_name(stat, [filters])
+
+    return layer, os.path.isfile(os.path.join(Grass.path_out,
+                                              f'{layer}_raster.tif'))
+
+
+def create_composite(stat='mean', filters=None):
+    """Creates a composite (statistic) of the scenes matching the filters,
+    which can be displayed as layer of the map (see get_tile() in
+    tile_fun.py). Composites of filtered scenes (e.g. of a time window, see
+    get_time_windows() in composite_fun.py) are cached on disk by the
+    filters and the contributing scenes, so they are only computed again if
+    a scene of the window was added, changed or removed. This takes a
+    while, so it is run by the JobWorker (see ingest_fun.py) instead of the
+    request.
+
+    :param stat: 'mean', 'std', 'min' or 'max'. 'median' and percentiles
+        like 'p90' are always computed with create_composite_raster() in
+        composite_fun.py. [str]
+    :param filters: Only use scenes matching these filters (see
+        parse_scene_filters() in sqlite_fun.py). [dict]
+
+    :return: Name of the layer. [str]
+    """
+
+    ## The average of all scenes is kept up to date by grass_main(). Other
+    ## statistics of all scenes are cached like filtered composites, so they
+    ## are created again once the scenes have changed.
+    if not filters and stat == 'mean':
+        if not os.path.exists(os.path.join(Grass.path_out,
+                                           'avg_raster.tif')):
+            create_avg_raster()
+        return 'avg'
+
+    prefix, layer = _get_layer_name(stat, [filters])
+    out_path = os.path.join(Grass.path_out, f'{layer}_raster.tif')
+
+    with _get_composite_lock(prefix):
+        if os.path.isfile(out_path):
+            return layer
+
+        if stat in ACC_STATS and Composite.engine == 'grass':
+            create_stat_raster(stat, filename=f'{layer}_raster',
+                               filters=filters)
+        else:
+            create_composite_raster(stat, out_path, get_common_grid(),
+                                    filters=filters)
+        _remove_outdated_layers(prefix, layer)
+
+    return layer
+
+
+def get_change_layer(filters_a, filters_b, method='log_ratio'):
+    """Gets the name of the layer of a change map (see create_change_map())
+    and whether it has been created already.
+
+    :param filters_a: See create_change_map(). [dict]
+    :param filters_b: See create_change_map(). [dict]
+    :param method: See create_change_map(). [str]
+
+    :return: Name of the layer [str] and True if it exists. [bool]
+    """
+    if method not in CHANGE_METHODS:
+        raise ValueError(f"Unknown method '{method}'. Use one of "
+                         f"{list(CHANGE_METHODS)}.")
+
+    prefix, layer = _get_layer_name(f'change_{method}',
+                                    [filters_a, filters_b])
+
+    return layer, os.path.isfile(os.path.join(Grass.path_out,
+                                              f'{layer}_raster.tif'))
+
+
+def create_change_map(filters_a, filters_b, method='log_ratio'):
+    """Creates a change map between two sets of scenes (e.g. two time
+    windows, see get_time_windows() in composite_fun.py), which can be
+    displayed as layer of the map. Change maps are cached like composites
+    (see create_composite()). This takes a while, so it is run by the
+    JobWorker (see ingest_fun.py) instead of the request.
+
+    :param filters_a: Filters of the scenes before the change (see
+        parse_scene_filters() in sqlite_fun.py). [dict]
+    :param filters_b: Filters of the scenes after the change. [dict]
+    :param method: 'log_ratio' or 'difference' (see create_change_raster()
+        in composite_fun.py). [str]
+
+    :return: Name of the layer. [str]
+    """
+    prefix, layer = _get_layer_name(f'change_{method}',
+                                    [filters_a, filters_b])
+    out_path = os.path.join(Grass.path_out, f'{layer}_raster.tif')
+
+    with _get_composite_lock(prefix):
+        if os.path.isfile(out_path):
+            return layer
+
+        create_change_raster(filters_a, filters_b, out_path,
+                             get_common_grid(), method=method)
+        _remove_outdated_layers(prefix, layer)
+
+    return layer
+
+
+def _get_layer_name(name, filter_sets):
+    """Creates the name of a cached layer (see create_composite()). It
+    consists of a prefix identifying the product and its filters and a hash
+    of the fingerprints of the contributing scenes.
+
+    :param name: Name of the product (e.g. the statistic). [str]
+    :param filter_sets: Filters of each set of scenes used. [list]
+
+    :return: Prefix and name of the layer. [tuple]
+    """
+    keys = []
+    fingerprints = []
+    query = db.session.query(Scene.filepath, Scene.file_size,
+                             Scene.file_mtime, Scene.file_hash)
+    for filters in filter_sets:
+        scenes = apply_scene_filters(query, filters). \
+            order_by(Scene.filepath).all()
+        if len(scenes) == 0:
+            raise ValueError("No scenes match the filters.")
+        fingerprints.append([tuple(s) for s in scenes])
+        keys.append("&".join(f"{k}={v}"
+                             for k, v in sorted((filters or {}).items())))
+
+    key = "|".join(keys)
+    prefix = f"{name}_{hashlib.sha1(key.encode()).hexdigest()[:10]}"
+    scene_hash = hashlib.sha1(
+        json.dumps(fingerprints).encode()).hexdigest()[:10]
+
+    return prefix, f"{prefix}_{scene_hash}"
+
+
+def _remove_outdated_layers(prefix, layer):
+    ## Remove the output of the previous set of scenes
+    for f in os.listdir(Grass.path_out):
+        if f.startswith(f'{prefix}_') and f.endswith('_raster.tif') \
+                and f != f'{layer}_raster.tif':
+            os.remove(os.path.join(Grass.path_out, f))
+            tile_cache.invalidate(f[:-len('_raster.tif')])
+
+
+def _get_composite_lock(prefix):
+    ## Composites with the same statistic and filters are only computed once
+    ## at a time
+    with _composite_locks_lock:
+        return _composite_locks.setdefault(prefix, threading.Lock())
+
+
+def _get_region_env(name):
+    """Creates an environment for GRASS modules that use the saved region
+    'name' instead of the computational region of the mapset
+    (WIND_OVERRIDE). The region is initialized with the current region.
+
+    :param name: Name of the saved region. [str]
+
+    :return: Environment to pass to gscript.run_command(). [dict]
+    """
+    gscript.run_command('g.region', save=name, flags='u', overwrite=True,
+                        quiet=True)
+    env = os.environ.copy()
+    env['WIND_OVERRIDE'] = name
+
+    return env
+
+
+def _create_acc_stat(stat, filename, progress, env=None):
+    """Derives a statistic of all scenes from the accumulators (see
+    create_stat_raster()).
+
+    :param env: Environment of the GRASS modules (see _get_region_env()).
+        [dict]
+    """
+    state = _load_acc_state()
+    if state is None:
+        raise ImportError("The accumulators haven't been created yet. Run "
+                          "update_accumulators() first.")
+
+    print(f"~~ Creating {stat} raster from {len(state['scenes'])} scenes:")
+    progress.start(stat, total=1)
+
+    ## Recompute minimum and maximum if scenes were removed
+    if stat in ('min', 'max') and state['minmax_outdated']:
+        gscript.run_command('g.region', raster=state['scenes'], env=env)
+        gscript.run_command('r.series', input=state['scenes'],
+                            output=f"{ACC_MAPS['min']},{ACC_MAPS['max']}",
+                            method='minimum,maximum', overwrite=True,
+                            env=env)
+        state['minmax_outdated'] = False
+        _save_acc_state(state)
+
+    ## Set region and derive the statistic
+    gscript.run_command('g.region', raster=ACC_MAPS['count'], env=env)
+    gscript.mapcalc(f"{filename} = if({ACC_MAPS['count']} > 0, "
+                    f"{ACC_STATS[stat]}, null())".format(**ACC_MAPS),
+                    overwrite=True, quiet=True, env=env)
+
+
+def _create_filtered_stat(stat, filename, filters, env=None):
+    """Computes a statistic of the scenes matching the filters with
+    r.series (see create_stat_raster()).
+
+    :param env: Environment of the GRASS modules (see _get_region_env()).
+        [dict]
+    """
+    scenes = [_get_map_name(f) for (f,) in apply_scene_filters(
+        db.session.query(Scene.filepath), filters).order_by(Scene.date)]
+    if len(scenes) == 0:
+        raise ValueError("No scenes match the filters.")
+
+    print(f"~~ Creating {stat} raster from {len(scenes)} filtered scenes:")
+
+    ## Names of the scenes are passed as file to not exceed the maximum
+    ## length of the command line
+    list_path = os.path.join(Grass.path_out, f'{filename}_scenes.txt')
+    with open(list_path, 'w') as f:
+        f.write("\n".join(scenes))
+
+    gscript.run_command('g.region', raster=scenes, env=env)
+    gscript.run_command('r.series', file=list_path, output=filename,
+                        method=SERIES_METHODS[stat], overwrite=True,
+                        quiet=True, env=env)
+    os.remove(list_path)
+
+
+def _export_stat_raster(filename, out_path, env=None):
+    """Rescales a raster to 1-255, applies the viridis color table and
+    exports it as GeoTIFF (see create_stat_raster()). The GeoTIFF is written
+    to a temporary file and used with _publish_stat_raster().
+
+    :param env: Environment of the GRASS modules (see _get_region_env()).
+        [dict]
+    """
 
     ## Rescale to range from 1 to 255 (0 is going to be used for nodata values)
     gscript.run_command('r.rescale', input=filename,
                         output=f'{filename}_255',
-                        to='1,255', overwrite=True)
+                        to='1,255', overwrite=True, env=env)
 
     ## Modify color table
     ## (Flag 'e': Histogram equalization)
     gscript.run_command('r.colors', map=f'{filename}_255',
-                        color='viridis', flags='e')
+                        color='viridis', flags='e', env=env)
 
     gscript.run_command("r.out.gdal",
                         input=f'{filename}_255',
                         output=out_path, format='GTiff',
                         createopt="TILED=YES,COMPRESS=DEFLATE",
-                        overviews=5, quiet=False, nodata=0, overwrite=True)
+                        overviews=5, quiet=False, nodata=0, overwrite=True,
+                        env=env)
+
+
+def _publish_stat_raster(tmp_path, out_path, filename):
+    """Replaces the previous output of create_stat_raster() with the new
+    one at once and removes its outdated tiles.
+    """
+    os.replace(tmp_path, out_path)
+
+    ## Statistics of a previous export are outdated
+    if os.path.isfile(tmp_path + '.aux.xml'):
+        os.replace(tmp_path + '.aux.xml', out_path + '.aux.xml')
+    elif os.path.isfile(out_path + '.aux.xml'):
+        os.remove(out_path + '.aux.xml')
+
+    ## Remove outdated tiles of the raster (see tile_fun.py)
+    if filename.endswith('_raster'):
+        tile_cache.invalidate(filename[:-len('_raster')])
+
+
+@timed('create_avg_raster')
+def create_avg_raster(progress=None, publish=True, scenes=None):
+    """Important part of the main GRASS workflow. An average
+    raster of all scenes in the database is created to display on the main map
+    of the webapp. This file will be updated if new scenes have been added
+    to the database. The average is derived from the accumulators (see
+    update_accumulators()), so only the scenes that were added or removed
+    since the last update have to be processed.
+
+    :param progress: See grass_main(). [IngestProgress]
+    :param publish: See create_stat_raster(). [bool]
+    :param scenes: See create_stat_raster(). [list]
+
+    :returns: 'avg_raster.tif' as a cloud optimized GeoTIFF (see
+        create_stat_raster())
+    """
+
+    return create_stat_raster(stat='mean', filename='avg_raster',
+                              progress=progress, publish=publish,
+                              scenes=scenes)
+
+
+def _update_accumulators(maps, subtract, first):
+    """Adds a batch of scenes to (or subtracts them from) the accumulators
+    with a single r.mapcalc call.
+
+    :param maps: Names of the scenes in GRASS. [list]
+    :param subtract: If True, the scenes are subtracted. [bool]
+    :param first: If True, the accumulators don't exist yet. [bool]
+    """
+
+    ## The region needs to cover the accumulators and all scenes of the
+    ## batch (new scenes might extend it). Pixels of the accumulators
+    ## outside of their previous extent are NULL.
+    if first:
+        gscript.run_command('g.region', raster=maps)
+    else:
+        gscript.run_command('g.region', raster=[ACC_MAPS['sum']] + maps)
+
+    def acc(name):
+        if first:
+            return ["0"]
+        return [f"if(isnull({ACC_MAPS[name]}), 0, {ACC_MAPS[name]})"]
+
+    sign = " - " if subtract else " + "
+    values = [f"if(isnull({m}), 0, double({m}))" for m in maps]
+    squares = [f"if(isnull({m}), 0, double({m}) * {m})" for m in maps]
+    counts = [f"if(isnull({m}), 0, 1)" for m in maps]
+
+    exp = [f"{ACC_MAPS['sum']}_tmp = " + sign.join(acc('sum') + values),
+           f"{ACC_MAPS['sumsq']}_tmp = " + sign.join(acc('sumsq') + squares),
+           f"{ACC_MAPS['count']}_tmp = " + sign.join(acc('count') + counts)]
+
+    ## Minimum and maximum are only updated when scenes are added
+    ## (nmin/nmax ignore NULL values)
+    if not subtract:
+        old = [] if first else [ACC_MAPS['min']]
+        exp.append(f"{ACC_MAPS['min']}_tmp = nmin({', '.join(old + maps)})")
+        old = [] if first else [ACC_MAPS['max']]
+        exp.append(f"{ACC_MAPS['max']}_tmp = nmax({', '.join(old + maps)})")
+
+    gscript.mapcalc("\n".join(exp), overwrite=True, quiet=True)
+
+    ## Replace accumulators with the updated versions
+    names = ['sum', 'sumsq', 'count'] + ([] if subtract else ['min', 'max'])
+    for name in names:
+        gscript.run_command('g.rename',
+                            raster=f"{ACC_MAPS[name]}_tmp,{ACC_MAPS[name]}",
+                            overwrite=True, quiet=True)
+
+
+def _remove_accumulators():
+    for name in ACC_MAPS.values():
+        if gscript.find_file(name, element='cell')['name']:
+            gscript.run_command('g.remove', type='raster', name=name,
+                                flags='f', quiet=True)
+
+
+def _load_acc_state():
+    """Loads the list of scenes included in the accumulators. Returns None
+    if it doesn't exist or the accumulators are missing.
+    """
+    path = _get_acc_state_path()
+    if not os.path.isfile(path):
+        return None
+    if not gscript.find_file(ACC_MAPS['sum'], element='cell')['name']:
+        return None
+
+    with open(path) as f:
+        return json.load(f)
+
+
+def _save_acc_state(state):
+    with open(_get_acc_state_path(), 'w') as f:
+        json.dump(state, f)
+
+
+def _get_acc_state_path():
+    ## Stored in the directory of the current mapset, so each GRASS project
+    ## has its own file
+    env = gscript.gisenv()
+    return os.path.join(env['GISDBASE'], env['LOCATION_NAME'],
+                        env['MAPSET'], 'accumulators.json')
+
+
+def _get_map_name(scene):
+    """Gets the name of a scene in GRASS from its full path."""
+    base = os.path.basename(scene)
+    return base[:-len(Path(base).suffix)]
 
 
 def export_cog(scene):
@@ -229,6 +1023,7 @@ def export_cog(scene):
     return out_path
 
 
+@timed('transform_coord')
 def transform_coord(lat, lng, proj):
     """Transforms leaflet map coordinates from WGS84/EPSG:4326 into the
     the projection of the GRASS project.
@@ -262,19 +1057,109 @@ def transform_coord(lat, lng, proj):
     return coord_out
 
 
-def get_timeseries(coordinate):
-    """Uses the r.what module in GRASS GIS to extract a timeseries for a
-    given coordinate.
+@timed('get_timeseries')
+def get_timeseries(coordinate, projection=None, engine=None, filters=None):
+    """Extracts a timeseries for a given coordinate from all scenes in the
+    database.
 
     :param coordinate: Output of transform_coord(). Location to generate
         timeseries for. Must be in the same projection as the GRASS project.
         [str]
+    :param projection: Projection / EPSG code of the coordinate. Only used
+        by the 'gdal' engine to read scenes in a different projection.
+        [str or int]
+    :param engine: Either 'cube' (read from the datacube, see cube_fun.py),
+        'gdal' (read values in-process, see gdal_fun.py) or 'grass' (use
+        r.what). Defaults to 'cube' if the datacube exists and
+        Timeseries.engine (see config.py) otherwise. If reading with GDAL
+        fails, GRASS is used as a fallback. [str]
+    :param filters: Only use scenes matching these filters (see
+        parse_scene_filters() in sqlite_fun.py). [dict]
+
+    :return values_list: List of extracted values.
+    :return dates_list: List of dates associated with values_list.
+    """
+    if engine is None:
+        engine = 'cube' if cube_exists() else Timeseries.engine
+
+    if engine == 'cube':
+        x, y = [float(c) for c in coordinate.split(",")]
+        filepaths = None
+        if filters:
+            filepaths = set(f for (f,) in apply_scene_filters(
+                db.session.query(Scene.filepath), filters))
+        return read_cube(x, y, epsg=projection, filepaths=filepaths)
+
+    if engine == 'gdal':
+        try:
+            return _get_timeseries_gdal(coordinate, projection, filters)
+        except RuntimeError as e:
+            print(f"~~ Could not extract the timeseries with GDAL ({e}). "
+                  f"Falling back to GRASS GIS.")
+
+    return _get_timeseries_grass(coordinate, filters)
+
+
+def _get_timeseries_gdal(coordinate, projection=None, filters=None):
+    """Reads a timeseries for a given coordinate directly from the GeoTIFF
+    files of all scenes in the database. Opened files are kept in a pool
+    (see DatasetPool in gdal_fun.py), so subsequent queries don't need to
+    open them again. Only scenes that cover the coordinate according to the
+    spatial index (see spatial_fun.py) are read, the value of all other
+    scenes is nan.
+
+    :param coordinate: Output of transform_coord(). [str]
+    :param projection: Projection / EPSG code of the coordinate.
+        [str or int]
+    :param filters: See get_timeseries(). [dict]
+
+    :return values_list: List of extracted values.
+    :return dates_list: List of dates associated with values_list.
+    """
+    x, y = [float(c) for c in coordinate.split(",")]
+
+    ## Get ID, filepath, date, EPSG and nodata value of all scenes in
+    ## database
+    query = db.session.query(Scene.id, Scene.filepath, Scene.date,
+                             Geometry.epsg, Metadata.nodata). \
+        join(Geometry, Geometry.scene_id == Scene.id). \
+        join(Metadata, Metadata.scene_id == Scene.id)
+    query = apply_scene_filters(query, filters).order_by(Scene.id).all()
+
+    ## Get scenes that cover the coordinate
+    if projection is not None:
+        lng, lat = transform_point(x, y, projection, 4326)
+        covering = query_spatial_index(lng, lat, lng, lat)
+    else:
+        covering = set(row[0] for row in query)
+
+    scenes = [(filepath, epsg, None if nodata is None else float(nodata))
+              for (scene_id, filepath, date, epsg, nodata) in query
+              if scene_id in covering]
+    values = iter(read_timeseries(scenes, x, y, epsg=projection))
+
+    values_list = [next(values) if scene_id in covering else np.nan
+                   for (scene_id, filepath, date, epsg, nodata) in query]
+    dates_list = [date for (scene_id, filepath, date, epsg, nodata) in query]
+
+    return values_list, dates_list
+
+
+def _get_timeseries_grass(coordinate, filters=None):
+    """Uses the r.what module in GRASS GIS to extract a timeseries for a
+    given coordinate.
+
+    :param coordinate: Output of transform_coord(). [str]
+    :param filters: See get_timeseries(). [dict]
 
     :return values_list: List of extracted values.
     :return dates_list: List of dates associated with values_list.
     """
     ## Get all scenes in database
-    all_scenes = Scene.query.all()
+    all_scenes = apply_scene_filters(Scene.query, filters). \
+        order_by(Scene.id).all()
+    if len(all_scenes) == 0:
+        return [], []
 
     ## List basename of all scenes
     scenes = []
@@ -297,24 +1182,250 @@ def get_timeseries(coordinate):
     values_list = [np.nan if x == 'nan' else float(x) for x in values_list]
 
     ## Get list of dates from database for the x-axis
-    dates_list = [date for (date,) in Scene.query.with_entities(
-        Scene.date).all()]
+    dates_list = [s.date for s in all_scenes]
 
     return values_list, dates_list
 
 
-def create_plot(latitude, longitude, projection):
+def get_y_range():
+    """Gets the overall minimum and maximum values of all scenes in the
+    database from the summary of the dataset (see get_summary() in
+    sqlite_fun.py), which are used as limits of the y-axis.
+
+    :return: Minimum and maximum value. [tuple]
+    """
+    summary = get_summary()
+
+    return summary['band_min'], summary['band_max']
+
+
+def get_timeseries_data(latitude, longitude, projection, filters=None):
+    """Uses get_timeseries() to extract a timeseries for a given location
+    and returns it in a compact format, which can be sent to the client
+    without creating a plot (see /api/timeseries in routes.py).
+
+    :param latitude: Latitude coordinate. [str or float]
+    :param longitude: Longitude coordinate. [str or float]
+    :param projection: Projection / EPSG code of the GRASS project.
+        [str or int]
+    :param filters: Only use scenes matching these filters (see
+        parse_scene_filters() in sqlite_fun.py). [dict]
+
+    :return: Dates (milliseconds since 1970-01-01 UTC), values (None if no
+        value is available) and limits of the y-axis. [dict]
+    """
+
+    ## Transform coordinates
+    coord = transform_coord(lat=latitude, lng=longitude, proj=projection)
+
+    ## Extract values from all available scenes
+    y_values, x_dates = get_timeseries(coord, projection=projection,
+                                       filters=filters)
+
+    epoch = datetime(1970, 1, 1)
+    dates = [int((d - epoch).total_seconds() * 1000) for d in x_dates]
+    values = [None if np.isnan(v) else round(float(v), 4) for v in y_values]
+
+    return {'dates': dates,
+            'values': values,
+            'y_range': list(get_y_range())}
+
+
+def iter_batch_timeseries(latitudes, longitudes):
+    """Extracts the timeseries of many locations at once. Coordinates are
+    transformed once for each projection and each scene is read once for all
+    locations (see read_points() in gdal_fun.py). Scenes that don't
+    intersect the bounding box of all locations (see spatial_fun.py) are not
+    read at all. Values are returned scene by scene, so the timeseries of
+    all locations never have to be kept in memory at the same time.
+
+    :param latitudes: Latitude coordinates in EPSG:4326. [list]
+    :param longitudes: Longitude coordinates in EPSG:4326. [list]
+
+    :return: Generator of (date, values) for each scene, where values are
+        the values of all locations (nan where no value is available).
+        [tuple]
+    """
+    lats = np.asarray(latitudes, dtype=np.float64)
+    lngs = np.asarray(longitudes, dtype=np.float64)
+
+    ## Get ID, date, filepath, EPSG and nodata value of all scenes in
+    ## database
+    query = db.session.query(Scene.id, Scene.date, Scene.filepath,
+                             Geometry.epsg, Metadata.nodata). \
+        join(Geometry, Geometry.scene_id == Scene.id). \
+        join(Metadata, Metadata.scene_id == Scene.id). \
+        order_by(Scene.date).all()
+
+    ## Get scenes that intersect the bounding box of all locations
+    covering = query_spatial_index(lngs.min(), lats.min(), lngs.max(),
+                                   lats.max())
+
+    ## Transform the coordinates only once for each projection
+    coords = {}
+
+    for scene_id, date, filepath, epsg, nodata in query:
+        if scene_id not in covering:
+            yield date, np.full(len(lats), np.nan)
+            continue
+
+        if epsg not in coords:
+            coords[epsg] = transform_points(lngs, lats, 4326, epsg)
+        xs, ys = coords[epsg]
+
+        with dataset_pool.checkout(filepath) as data:
+            values = read_points(data, xs, ys,
+                                 None if nodata is None else float(nodata))
+
+        yield date, values
+
+
+def get_aggregate_timeseries(geojson):
+    """Calculates mean, median and number of valid pixels within a polygon
+    (or bounding box) for all scenes in the database that intersect it.
+    Scenes are selected with the spatial index and their bounds in the
+    database (see Geometry), so scenes that don't intersect the polygon
+    are never opened.
+
+    :param geojson: GeoJSON geometry, feature or feature collection in
+        EPSG:4326. A bounding box can also be passed as
+        {"bbox": [west, south, east, north]}. [dict]
+
+    :return: Dates (milliseconds since 1970-01-01 UTC) and mean, median
+        (None if no valid pixels are available) and count of each
+        intersecting scene. [dict]
+    """
+    geometry = _parse_geojson(geojson)
+
+    ## Select candidates with the spatial index (see spatial_fun.py)
+    minx, maxx, miny, maxy = geometry.GetEnvelope()
+    ids = sorted(query_spatial_index(minx, miny, maxx, maxy))
+
+    ## Check the bounds of each candidate with the bounds of the polygon in
+    ## the projection of the scene
+    envelopes = {}
+    scenes = []
+    for i in range(0, len(ids), 500):
+        query = db.session.query(Scene.date, Scene.filepath, Geometry.epsg,
+                                 Metadata.nodata, Geometry.bounds_west,
+                                 Geometry.bounds_south, Geometry.bounds_east,
+                                 Geometry.bounds_north). \
+            join(Geometry, Geometry.scene_id == Scene.id). \
+            join(Metadata, Metadata.scene_id == Scene.id). \
+            filter(Scene.id.in_(ids[i:i + 500]))
+
+        for date, filepath, epsg, nodata, west, south, east, north in query:
+            if epsg not in envelopes:
+                envelopes[epsg] = transform_geometry(geometry, 4326,
+                                                     epsg).GetEnvelope()
+            e_minx, e_maxx, e_miny, e_maxy = envelopes[epsg]
+            if west <= e_maxx and east >= e_minx and south <= e_maxy and \
+                    north >= e_miny:
+                scenes.append((date, filepath, epsg, nodata))
+
+    scenes.sort(key=lambda s: s[0])
+    stats = aggregate_timeseries(
+        [(filepath, epsg, None if nodata is None else float(nodata))
+         for (date, filepath, epsg, nodata) in scenes],
+        geometry, 4326)
+
+    epoch = datetime(1970, 1, 1)
+
+    return {'dates': [int((s[0] - epoch).total_seconds() * 1000)
+                      for s in scenes],
+            'mean': [None if np.isnan(m) else round(m, 4)
+                     for (m, _, _) in stats],
+            'median': [None if np.isnan(m) else round(m, 4)
+                       for (_, m, _) in stats],
+            'count': [c for (_, _, c) in stats]}
+
+
+def _parse_geojson(geojson):
+    """Creates a single polygon from GeoJSON (see
+    get_aggregate_timeseries()). Raises ValueError if it can't be parsed.
+    """
+    if not isinstance(geojson, dict):
+        raise ValueError("Expected a GeoJSON object.")
+
+    if geojson.get('type') is None and 'bbox' in geojson:
+        west, south, east, north = [float(b) for b in geojson['bbox']]
+        wkt = f"POLYGON (({west} {south}, {east} {south}, {east} {north}, " \
+              f"{west} {north}, {west} {south}))"
+        return ogr.CreateGeometryFromWkt(wkt)
+
+    if geojson.get('type') == 'FeatureCollection':
+        geometries = [_parse_geojson(f) for f in geojson.get('features', [])]
+        if len(geometries) == 0:
+            raise ValueError("The feature collection is empty.")
+        geometry = geometries[0]
+        for g in geometries[1:]:
+            geometry = geometry.Union(g)
+        return geometry
+
+    if geojson.get('type') == 'Feature':
+        geojson = geojson.get('geometry') or {}
+
+    if geojson.get('type') not in ('Polygon', 'MultiPolygon'):
+        raise ValueError("Only polygons, multipolygons and bounding boxes "
+                         "are supported.")
+
+    try:
+        geometry = ogr.CreateGeometryFromJson(json.dumps(geojson))
+    except RuntimeError:
+        geometry = None
+    if geometry is None or not geometry.IsValid():
+        raise ValueError("The geometry is not valid.")
+
+    return geometry
+
+
+def create_empty_plot():
+    """Creates a timeseries plot without any data, which is embedded in the
+    map page once. When the map is clicked, only the data of the plot is
+    updated with the response of /api/timeseries (see map.html), so the
+    plot doesn't have to be created again.
+
+    :return script: Script of the plot (see bokeh.embed.components). [str]
+    :return div: Div of the plot. [str]
+    """
+
+    ## Data of the plot ('date' in milliseconds since 1970-01-01 UTC)
+    source = ColumnDataSource(data={'date': [], 'value': []},
+                              name='timeseries')
+
+    ## Create plot
+    p = figure(plot_width=550, plot_height=500,
+               x_axis_label='Time',
+               y_axis_label='Backscatter (dB)',
+               x_axis_type='datetime',
+               y_range=get_y_range(),
+               title="Click on the map to extract a timeseries",
+               name='timeseries_plot')
+
+    p.line('date', 'value', source=source, line_width=2)
+    p.dot('date', 'value', source=source, size=15, color='darkblue')
+
+    script, div = components(p)
+
+    return script, div
+
+
+def create_plot(latitude, longitude, projection, filters=None):
     """Uses get_timeseries() to extract a timeseries for a given location by
     querying all raster layers currently available in the database / GRASS
     project. Limits of the y-axis are always set to the overall minimum and
     maximum values of all available rasters to make the generated plots of a
     given session comparable. The plot is automatically exported in
-    html, so it can directly be embedded in the webapp.
+    html, so it can directly be embedded in the webapp. Plots are cached
+    for each pixel (see cache_fun.py), so clicking the same pixel again
+    returns the cached plot.
 
     :param latitude: Latitude coordinate. [str or float]
     :param longitude: Longitude coordinate. [str or float]
     :param projection: Projection / EPSG code of the GRASS project.
         [str or int]
+    :param filters: Only use scenes matching these filters (see
+        parse_scene_filters() in sqlite_fun.py). [dict]
 
     :returns: Plot in html format.
     """
@@ -322,12 +1433,18 @@ def create_plot(latitude, longitude, projection):
     ## Transform coordinates
     coord = transform_coord(lat=latitude, lng=longitude, proj=projection)
 
+    ## Return cached plot if the pixel has been requested before
+    key = make_key(coord, get_generation(), filters)
+    html = plot_cache.get(key)
+    if html is not None:
+        return html
+
     ## Extract values from all available scenes
-    y_values, x_dates = get_timeseries(coord)
+    y_values, x_dates = get_timeseries(coord, projection=projection,
+                                       filters=filters)
 
     ## Set y min and max based on all scenes in database
-    y_min = min(Metadata.query.with_entities(Metadata.band_min).all()).band_min
-    y_max = max(Metadata.query.with_entities(Metadata.band_max).all()).band_max
+    y_min, y_max = get_y_range()
 
     ## Create plot
     p = figure(plot_width=550, plot_height=500,
@@ -344,7 +1461,9 @@ def create_plot(latitude, longitude, projection):
     p.line(x_dates, y_values, line_width=2)
     p.dot(x_dates, y_values, size=15, color='darkblue')
 
-    html = file_html(p, CDN)
+    with measure('bokeh_render'):
+        html = file_html(p, CDN)
+    plot_cache.put(key, html)
 
     return html
 
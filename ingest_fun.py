@@ -0,0 +1,244 @@
+from flask_app import app, db
+from sqlite_fun import stage_db_changes, has_changes, get_staged_scenes, \
+    publish_db_changes
+from grass_fun import grass_main, publish_grass_changes, \
+    grass_project_exists, start_grass_session
+from progress_fun import IngestProgress
+
+from collections import OrderedDict
+from datetime import datetime
+import queue
+import threading
+import traceback
+
+## Number of finished jobs whose status is kept (see JobWorker)
+MAX_FINISHED_JOBS = 100
+
+
+class IngestWorker(object):
+    """Runs the ingestion of new, changed and removed scenes (db_main() and
+    grass_main()) in a background thread, so the webapp can answer requests
+    in the meantime. The changes of the database are only staged in memory
+    (see stage_db_changes() in sqlite_fun.py) while grass_main() applies
+    them, so no write transaction of the database is held during the import.
+    Once grass_main() is done, the changes are written to the database in a
+    single short transaction, and only then the new average raster and the
+    new index of the datacube replace the previous ones. Pages keep showing
+    the previous dataset until the ingestion has finished and never pair
+    new outputs with the previous scenes.
+
+    A job is either 'idle' (never started), 'running', 'done' or 'failed'.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.state = 'idle'
+        self.progress = None
+        self.result = None
+        self.error = None
+        self.started = None
+        self.finished = None
+        self._thread = None
+
+    def start(self, scenes=None):
+        """Starts a new ingestion unless one is running already.
+
+        :param scenes: Only ingest these files (see db_main() in
+            sqlite_fun.py). If None, the whole data directory is compared
+            with the database. [list]
+
+        :return: True if a new ingestion was started. [bool]
+        """
+        with self.lock:
+            if self.state == 'running':
+                return False
+
+            self.state = 'running'
+            self.progress = IngestProgress()
+            self.result = None
+            self.error = None
+            self.started = datetime.utcnow()
+            self.finished = None
+
+            self._thread = threading.Thread(target=self._run, args=(scenes,),
+                                            daemon=True, name='ingest')
+            self._thread.start()
+
+            return True
+
+    def join(self, timeout=None):
+        """Waits until the current ingestion has finished."""
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def status(self):
+        """Returns state and progress of the current (or last) ingestion.
+        [dict]
+        """
+        with self.lock:
+            status = {'state': self.state,
+                      'started': _isoformat(self.started),
+                      'finished': _isoformat(self.finished),
+                      'result': self.result,
+                      'error': self.error}
+            progress = self.progress
+
+        status.update(progress.to_dict() if progress is not None
+                      else {'stage': None, 'stages': {}})
+
+        return status
+
+    def _run(self, scenes):
+        progress = self.progress
+        try:
+            with app.app_context():
+                try:
+                    changes = stage_db_changes(scenes=scenes,
+                                               progress=progress)
+                    added, changed, removed, epsg = (
+                        changes['added'], changes['changed'],
+                        changes['removed'], changes['epsg'])
+
+                    ## Only execute grass_main() if scenes were added,
+                    ## changed or removed (see initialize() in routes.py)
+                    if has_changes(changes):
+                        ## The read transaction is closed, so nothing of
+                        ## the database is held while GRASS is running
+                        staged_scenes = get_staged_scenes(changes)
+                        db.session.close()
+                        pending = grass_main(added, changed, removed, epsg,
+                                             progress=progress,
+                                             scenes=staged_scenes,
+                                             publish=False)
+
+                        ## Publish the new dataset (together with its new
+                        ## generation, see update_summary()), then the new
+                        ## outputs of grass_main(), and remove scenes from
+                        ## GRASS that can't be requested anymore
+                        publish_db_changes(changes, progress=progress)
+                        publish_grass_changes(pending, removed)
+                    elif grass_project_exists(crs=epsg):
+                        ## Nothing has changed (or all new scenes were
+                        ## rejected). Without a GRASS project (e.g. an empty
+                        ## data directory on the first start) there is no
+                        ## session to start yet.
+                        start_grass_session(crs=epsg)
+                except Exception:
+                    db.session.rollback()
+                    raise
+                finally:
+                    db.session.remove()
+
+        except Exception as e:
+            traceback.print_exc()
+            with self.lock:
+                self.state = 'failed'
+                self.error = f"{type(e).__name__}: {e}"
+                self.finished = datetime.utcnow()
+            progress.finish()
+            return
+
+        with self.lock:
+            self.state = 'done'
+            self.result = {'added': len(added),
+                           'changed': len(changed),
+                           'removed': len(removed)}
+            self.finished = datetime.utcnow()
+
+
+## Worker that is shared by all requests of the webapp
+ingest_worker = IngestWorker()
+
+
+class JobWorker(object):
+    """Runs jobs that take too long to answer a request with (e.g. change
+    maps, see create_change_map() in grass_fun.py) one after another in a
+    background thread. Jobs are identified by a key (e.g. the name of the
+    layer they create), so a job that is queued or running already isn't
+    submitted again.
+
+    A job is either 'queued', 'running', 'done' or 'failed'.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self._jobs = OrderedDict()
+        self._queue = queue.Queue()
+        self._thread = None
+
+    def submit(self, key, function, *args, **kwargs):
+        """Queues a job unless a job with the same key is queued or running.
+
+        :param key: Key of the job. [str]
+        :param function: Function that is called with args and kwargs inside
+            the application context. Its return value is the result of the
+            job.
+
+        :return: Status of the job (see status()). [dict]
+        """
+        with self.lock:
+            job = self._jobs.get(key)
+            if job is None or job['state'] in ('done', 'failed'):
+                self._jobs.pop(key, None)
+                self._jobs[key] = {'state': 'queued', 'result': None,
+                                   'error': None,
+                                   'submitted': datetime.utcnow()}
+                self._queue.put((key, function, args, kwargs))
+                self._forget_finished()
+
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                daemon=True, name='jobs')
+                self._thread.start()
+
+        return self.status(key)
+
+    def status(self, key):
+        """Returns state and result of a job or None if the job is unknown.
+        [dict]
+        """
+        with self.lock:
+            job = self._jobs.get(key)
+            if job is None:
+                return None
+
+            return {'state': job['state'],
+                    'result': job['result'],
+                    'error': job['error'],
+                    'submitted': _isoformat(job['submitted'])}
+
+    def _run(self):
+        while True:
+            key, function, args, kwargs = self._queue.get()
+            with self.lock:
+                self._jobs[key]['state'] = 'running'
+
+            try:
+                with app.app_context():
+                    try:
+                        result = function(*args, **kwargs)
+                    finally:
+                        db.session.remove()
+            except Exception as e:
+                traceback.print_exc()
+                with self.lock:
+                    self._jobs[key].update(state='failed',
+                                           error=f"{type(e).__name__}: {e}")
+                continue
+
+            with self.lock:
+                self._jobs[key].update(state='done', result=result)
+
+    def _forget_finished(self):
+        finished = [k for k, job in self._jobs.items()
+                    if job['state'] in ('done', 'failed')]
+        for k in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del self._jobs[k]
+
+
+## Worker that is shared by all requests of the webapp
+job_worker = JobWorker()
+
+
+def _isoformat(date):
+    return None if date is None else date.isoformat()
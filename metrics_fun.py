@@ -0,0 +1,174 @@
+from contextlib import contextmanager
+from functools import wraps
+from collections import OrderedDict
+import time
+import threading
+
+## Upper bounds of the buckets of latency histograms in seconds. Stages of
+## the ingestion take up to minutes, queries only milliseconds.
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30, 60, 120, 300, 600)
+
+
+class Counter(object):
+    """Value that only increases (e.g. number of ingested scenes), kept
+    separately for each combination of labels.
+    """
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+        self.lock = threading.Lock()
+        self._values = OrderedDict()
+
+    def inc(self, n=1, **labels):
+        """Increases the counter.
+
+        :param n: Amount to add. [int or float]
+        :param labels: Labels of the value (e.g. stage='extract').
+        """
+        key = _label_key(labels)
+        with self.lock:
+            self._values[key] = self._values.get(key, 0) + n
+
+    def render(self):
+        """Returns the counter in the Prometheus text format. [list]"""
+        lines = [f"# HELP {self.name} {self.description}",
+                 f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in self._values.items():
+                lines.append(f"{self.name}{_format_labels(key)} {value}")
+
+        return lines
+
+
+class Histogram(object):
+    """Distribution of observed values (e.g. durations) in buckets, kept
+    separately for each combination of labels.
+    """
+
+    def __init__(self, name, description, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(sorted(buckets))
+        self.lock = threading.Lock()
+        self._values = OrderedDict()
+
+    def observe(self, value, **labels):
+        """Adds a value to the histogram.
+
+        :param value: Observed value (e.g. duration in seconds). [float]
+        :param labels: Labels of the value (e.g. stage='extract').
+        """
+        key = _label_key(labels)
+        with self.lock:
+            h = self._values.get(key)
+            if h is None:
+                h = {'buckets': [0] * len(self.buckets), 'sum': 0.0,
+                     'count': 0}
+                self._values[key] = h
+
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    h['buckets'][i] += 1
+            h['sum'] += value
+            h['count'] += 1
+
+    def render(self):
+        """Returns the histogram in the Prometheus text format. [list]"""
+        lines = [f"# HELP {self.name} {self.description}",
+                 f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, h in self._values.items():
+                for bound, count in zip(self.buckets, h['buckets']):
+                    labels = _format_labels(key + (('le', repr(bound)),))
+                    lines.append(f"{self.name}_bucket{labels} {count}")
+                labels = _format_labels(key + (('le', '+Inf'),))
+                lines.append(f"{self.name}_bucket{labels} {h['count']}")
+                lines.append(f"{self.name}_sum{_format_labels(key)} "
+                             f"{h['sum']}")
+                lines.append(f"{self.name}_count{_format_labels(key)} "
+                             f"{h['count']}")
+
+        return lines
+
+
+## Metrics that are shared by all requests and the ingestion of the webapp
+stage_seconds = Histogram('s1grass_stage_duration_seconds',
+                          "Duration of the stages of the ingestion and of "
+                          "queries.")
+scenes_ingested = Counter('s1grass_scenes_ingested_total',
+                          "Scenes added to the database.")
+scenes_rejected = Counter('s1grass_scenes_rejected_total',
+                          "Scenes that information couldn't be extracted "
+                          "from.")
+## Blocks are the smallest unit GDAL reads from a file, so the size of all
+## blocks a query covers is counted (see gdal_fun.py)
+bytes_read = Counter('s1grass_block_bytes_read_total',
+                     "Bytes of the raster blocks read from scenes by "
+                     "queries (including blocks served from GDAL's block "
+                     "cache).")
+cache_requests = Counter('s1grass_cache_requests_total',
+                         "Requests of cached plots and tiles by result "
+                         "(hit or miss).")
+
+METRICS = [stage_seconds, scenes_ingested, scenes_rejected, bytes_read,
+           cache_requests]
+
+
+@contextmanager
+def measure(stage):
+    """Measures the duration of a block of code and adds it to the
+    histogram of its stage (also if an exception is raised).
+
+    :param stage: Name of the stage. [str]
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, stage=stage)
+
+
+def timed(stage):
+    """Decorator that measures the duration of each call of a function (see
+    measure()).
+
+    :param stage: Name of the stage. [str]
+    """
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with measure(stage):
+                return function(*args, **kwargs)
+        return wrapper
+
+    return decorator
+
+
+def render_metrics():
+    """Returns all metrics in the Prometheus text format (see /metrics in
+    routes.py).
+
+    :return: Metrics. [str]
+    """
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+
+    return "\n".join(lines) + "\n"
+
+
+def _label_key(labels):
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key):
+    if len(key) == 0:
+        return ""
+    values = ",".join(
+        '{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"')
+                         .replace('\n', '\\n'))
+        for k, v in key)
+
+    return "{" + values + "}"
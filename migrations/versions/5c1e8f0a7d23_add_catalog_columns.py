@@ -0,0 +1,80 @@
+"""add catalog columns
+
+Revision ID: 5c1e8f0a7d23
+Revises: 2fcc11747789
+Create Date: 2026-10-17 23:41:12.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5c1e8f0a7d23'
+down_revision = '2fcc11747789'
+branch_labels = None
+depends_on = None
+
+
+## Databases that were created with a local migration (see setup_db() in
+## sqlite_fun.py) may already contain some of the columns, so only missing
+## ones are added
+def _get_columns(table):
+    inspector = sa.inspect(op.get_bind())
+    return set(c['name'] for c in inspector.get_columns(table))
+
+
+def upgrade():
+    ## Fingerprints of the files (see get_fingerprint() in sqlite_fun.py).
+    ## They are empty for existing scenes and filled in with the next
+    ## comparison of the data directory (see create_filename_list()).
+    columns = _get_columns('scene')
+    with op.batch_alter_table('scene') as batch_op:
+        if 'file_size' not in columns:
+            batch_op.add_column(sa.Column('file_size', sa.BigInteger(),
+                                          nullable=True))
+        if 'file_mtime' not in columns:
+            batch_op.add_column(sa.Column('file_mtime', sa.Float(),
+                                          nullable=True))
+        if 'file_hash' not in columns:
+            batch_op.add_column(sa.Column('file_hash', sa.String(length=40),
+                                          nullable=True))
+
+    ## How the min/max of each scene was determined (see _get_band_stats()
+    ## in sqlite_fun.py). Scenes of earlier versions were always added with
+    ## approximate statistics.
+    columns = _get_columns('metadata')
+    with op.batch_alter_table('metadata') as batch_op:
+        if 'stats_mode' not in columns:
+            batch_op.add_column(sa.Column('stats_mode', sa.String(length=6),
+                                          nullable=True))
+    op.execute("UPDATE metadata SET stats_mode = 'approx' "
+               "WHERE stats_mode IS NULL")
+
+    ## Summary and generation of the dataset (see update_summary() in
+    ## sqlite_fun.py). The row is created when the webapp is started (see
+    ## ensure_summary()).
+    if 'dataset' not in sa.inspect(op.get_bind()).get_table_names():
+        op.create_table('dataset',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('generation', sa.Integer(), nullable=True),
+        sa.Column('n_scenes', sa.Integer(), nullable=True),
+        sa.Column('date_min', sa.DateTime(), nullable=True),
+        sa.Column('date_max', sa.DateTime(), nullable=True),
+        sa.Column('band_min', sa.Float(), nullable=True),
+        sa.Column('band_max', sa.Float(), nullable=True),
+        sa.Column('crs_histogram', sa.Text(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+
+def downgrade():
+    op.drop_table('dataset')
+
+    with op.batch_alter_table('metadata') as batch_op:
+        batch_op.drop_column('stats_mode')
+
+    with op.batch_alter_table('scene') as batch_op:
+        batch_op.drop_column('file_hash')
+        batch_op.drop_column('file_mtime')
+        batch_op.drop_column('file_size')
@@ -0,0 +1,85 @@
+from collections import OrderedDict
+import time
+import threading
+
+
+class IngestProgress(object):
+    """Keeps track of the progress of each stage of an ingestion (e.g.
+    'extract' or 'import'). Functions of the ingestion accept an instance as
+    'progress' parameter, call start() at the beginning of a stage and
+    advance() for each processed scene. The progress can be read from
+    other threads with to_dict() (see /status in routes.py).
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.stage = None
+        self._stages = OrderedDict()
+
+    def start(self, stage, total=None):
+        """Starts a stage. If the stage was started before, its total is
+        extended and the progress is kept.
+
+        :param stage: Name of the stage. [str]
+        :param total: Number of scenes that will be processed or None if
+            unknown. [int]
+        """
+        with self.lock:
+            self._finish_current()
+
+            s = self._stages.get(stage)
+            if s is None:
+                s = {'done': 0, 'total': total, 'bytes': 0,
+                     'seconds': 0.0}
+                self._stages[stage] = s
+            elif total is not None:
+                s['total'] = (s['total'] or 0) + total
+
+            s['started'] = time.time()
+            self.stage = stage
+
+    def advance(self, n=1, nbytes=0):
+        """Adds processed scenes to the current stage.
+
+        :param n: Number of processed scenes. [int]
+        :param nbytes: File size of the processed scenes in bytes. [int]
+        """
+        with self.lock:
+            s = self._stages.get(self.stage)
+            if s is None:
+                return
+            s['done'] += n
+            s['bytes'] += nbytes
+
+    def finish(self):
+        """Finishes the current stage."""
+        with self.lock:
+            self._finish_current()
+            self.stage = None
+
+    def to_dict(self):
+        """Returns the progress and throughput of each stage. [dict]"""
+        with self.lock:
+            stages = OrderedDict()
+            for name, s in self._stages.items():
+                seconds = s['seconds']
+                if name == self.stage:
+                    seconds += time.time() - s['started']
+
+                stages[name] = {
+                    'done': s['done'],
+                    'total': s['total'],
+                    'seconds': round(seconds, 2),
+                    'scenes_per_second':
+                        round(s['done'] / seconds, 2) if seconds > 0 else None,
+                    'mb_per_second':
+                        round(s['bytes'] / 1024 ** 2 / seconds, 2)
+                        if seconds > 0 else None}
+
+            return {'stage': self.stage, 'stages': stages}
+
+    def _finish_current(self):
+        s = self._stages.get(self.stage)
+        if s is not None and s.get('started') is not None:
+            s['seconds'] += time.time() - s['started']
+            s['started'] = None
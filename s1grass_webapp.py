@@ -1,9 +1,10 @@
 from flask_app import app, db
-from flask_app.models import Scene, Metadata, Geometry
+from flask_app.models import Scene, Metadata, Geometry, Dataset
 
 @app.shell_context_processor
 def make_shell_context():
     return {'db': db,
             'Scene': Scene,
             'Metadata': Metadata,
-            'Geometry': Geometry}
+            'Geometry': Geometry,
+            'Dataset': Dataset}
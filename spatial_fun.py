@@ -0,0 +1,184 @@
+from flask_app import db
+from flask_app.models import Geometry
+from gdal_fun import transform_points
+
+from sqlalchemy.exc import OperationalError
+import threading
+import numpy as np
+
+## Bounds of all scenes in EPSG:4326 are stored in an R*Tree virtual table of
+## the SQLite database. If the SQLite library doesn't support R*Trees, the
+## bounds are kept in memory instead.
+RTREE_TABLE = 'scene_rtree'
+
+## Number of points on each edge of the bounds that are transformed to
+## EPSG:4326 (edges of projected bounds are curved in EPSG:4326)
+EDGE_POINTS = 21
+
+_rtree = {'available': None}
+_memory = {'ids': None, 'bounds': None}
+_memory_lock = threading.Lock()
+
+
+def setup_spatial_index():
+    """Creates the R*Tree table if it doesn't exist already.
+
+    :return: True if the R*Tree is available, False if the bounds are kept
+        in memory instead. [bool]
+    """
+    if _rtree['available'] is None:
+        try:
+            db.session.execute(
+                f"CREATE VIRTUAL TABLE IF NOT EXISTS {RTREE_TABLE} "
+                f"USING rtree(id, min_x, max_x, min_y, max_y)")
+            db.session.commit()
+            _rtree['available'] = True
+        except OperationalError:
+            db.session.rollback()
+            print("~~ SQLite doesn't support R*Trees. The bounds of all "
+                  "scenes will be kept in memory instead.")
+            _rtree['available'] = False
+
+    return _rtree['available']
+
+
+def sync_spatial_index():
+    """Rebuilds the spatial index from the Geometry table if it doesn't
+    contain the same number of scenes (e.g. because the scenes were added
+    before the index existed).
+    """
+    if not setup_spatial_index():
+        _clear_memory()
+        return
+
+    n_index = db.session.execute(
+        f"SELECT COUNT(*) FROM {RTREE_TABLE}").scalar()
+    n_scenes = Geometry.query.count()
+    if n_index == n_scenes:
+        return
+
+    print(f"~~ Rebuilding the spatial index of {n_scenes} scenes...")
+    db.session.execute(f"DELETE FROM {RTREE_TABLE}")
+    add_to_spatial_index(db.session.query(
+        Geometry.scene_id, Geometry.epsg, Geometry.bounds_west,
+        Geometry.bounds_south, Geometry.bounds_east,
+        Geometry.bounds_north).all())
+    db.session.commit()
+
+
+def add_to_spatial_index(scenes):
+    """Adds scenes to the spatial index. Nothing is committed, so this can
+    be part of the transaction that adds the scenes (see add_data_to_db()
+    in sqlite_fun.py).
+
+    :param scenes: Each entry is a tuple of (scene ID, EPSG code, west,
+        south, east, north) with the bounds in the projection of the scene.
+        [list]
+    """
+    if not setup_spatial_index():
+        _clear_memory()
+        return
+
+    rows = [dict(id=scene_id, min_x=b[0], max_x=b[2], min_y=b[1],
+                 max_y=b[3])
+            for scene_id, b in zip([s[0] for s in scenes],
+                                   _get_bounds_4326(scenes))]
+    if len(rows) > 0:
+        db.session.execute(
+            f"INSERT OR REPLACE INTO {RTREE_TABLE} (id, min_x, max_x, "
+            f"min_y, max_y) VALUES (:id, :min_x, :max_x, :min_y, :max_y)",
+            rows)
+
+
+def remove_from_spatial_index(ids):
+    """Removes scenes from the spatial index. Nothing is committed (see
+    remove_data_from_db() in sqlite_fun.py).
+
+    :param ids: IDs of the scenes. [list]
+    """
+    if not setup_spatial_index():
+        _clear_memory()
+        return
+
+    if len(ids) > 0:
+        db.session.execute(
+            f"DELETE FROM {RTREE_TABLE} WHERE id IN "
+            f"({', '.join(str(int(i)) for i in ids)})")
+
+
+def query_spatial_index(west, south, east, north):
+    """Gets the IDs of all scenes whose bounds intersect a bounding box. A
+    point can be queried with the same coordinates for west/east and
+    south/north.
+
+    :param west: Minimum longitude. [float]
+    :param south: Minimum latitude. [float]
+    :param east: Maximum longitude. [float]
+    :param north: Maximum latitude. [float]
+
+    :return: IDs of the intersecting scenes. [set]
+    """
+    if setup_spatial_index():
+        query = db.session.execute(
+            f"SELECT id FROM {RTREE_TABLE} WHERE min_x <= :east AND "
+            f"max_x >= :west AND min_y <= :north AND max_y >= :south",
+            {'west': west, 'south': south, 'east': east, 'north': north})
+        return set(scene_id for (scene_id,) in query)
+
+    ids, bounds = _load_memory()
+    hit = ((bounds[:, 0] <= east) & (bounds[:, 2] >= west)
+           & (bounds[:, 1] <= north) & (bounds[:, 3] >= south))
+
+    return set(ids[hit].tolist())
+
+
+def _get_bounds_4326(scenes):
+    """Transforms the bounds of scenes to EPSG:4326. Each edge is densified,
+    so the transformed bounds contain the whole scene. The bounds of all
+    scenes with the same projection are transformed at once.
+
+    :return: List of (west, south, east, north) of each scene.
+    """
+    t = np.linspace(0, 1, EDGE_POINTS)
+    bounds = np.zeros((len(scenes), 4))
+
+    epsg_codes = [s[1] for s in scenes]
+    for epsg in set(epsg_codes):
+        index = [i for i, e in enumerate(epsg_codes) if e == epsg]
+        w, s, e, n = np.array([scenes[i][2:6] for i in index],
+                              dtype=np.float64).T[:, :, None]
+
+        ## Points along the south, east, north and west edge of each scene
+        xs = np.concatenate([w + t * (e - w), e + 0 * t,
+                             w + t * (e - w), w + 0 * t], axis=1)
+        ys = np.concatenate([s + 0 * t, s + t * (n - s),
+                             n + 0 * t, s + t * (n - s)], axis=1)
+
+        lngs, lats = transform_points(xs.ravel(), ys.ravel(), epsg, 4326)
+        lngs = lngs.reshape(xs.shape)
+        lats = lats.reshape(ys.shape)
+        bounds[index] = np.column_stack([lngs.min(axis=1), lats.min(axis=1),
+                                         lngs.max(axis=1), lats.max(axis=1)])
+
+    return [tuple(b) for b in bounds.tolist()]
+
+
+def _load_memory():
+    with _memory_lock:
+        if _memory['ids'] is None:
+            scenes = db.session.query(
+                Geometry.scene_id, Geometry.epsg, Geometry.bounds_west,
+                Geometry.bounds_south, Geometry.bounds_east,
+                Geometry.bounds_north).all()
+            _memory['ids'] = np.array([s[0] for s in scenes], dtype=np.int64)
+            _memory['bounds'] = np.array(_get_bounds_4326(scenes),
+                                         dtype=np.float64).reshape(-1, 4)
+
+        return _memory['ids'], _memory['bounds']
+
+
+def _clear_memory():
+    ## The bounds are loaded again with the next query
+    with _memory_lock:
+        _memory['ids'] = None
+        _memory['bounds'] = None
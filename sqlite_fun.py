@@ -1,166 +1,388 @@
-from config import Data, Database
-from flask_app import db
-from flask_app.models import Scene, Metadata, Geometry
+from config import Data, Database, Ingest
+from flask_app import db, migrate
+from flask_app.models import Scene, Metadata, Geometry, Dataset
+from gdal_fun import dataset_pool
+from tile_fun import tile_cache, get_scene_key
+from progress_fun import IngestProgress
+from metrics_fun import timed, scenes_ingested, scenes_rejected
+from spatial_fun import sync_spatial_index, add_to_spatial_index, \
+    remove_from_spatial_index
 
 from osgeo import gdal, osr
 from osgeo.gdalconst import GA_ReadOnly
+from sqlalchemy import func, inspect
+from flask_migrate import upgrade, stamp
+from alembic.migration import MigrationContext
+from alembic.script import ScriptDirectory
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 import os
+import multiprocessing
 import re
 import shutil
+import json
+import hashlib
 import dateutil.parser
+from datetime import datetime, timedelta
 gdal.UseExceptions()
 
+## Number of bytes at the start of a file that are hashed for its fingerprint
+HEADER_BYTES = 65536
 
-def db_main():
+## Migrations of the database scheme (see setup_db()) and the revision of
+## the scheme of the first release
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'migrations')
+BASE_REVISION = '2fcc11747789'
+
+
+def db_main(scenes=None, progress=None):
     """This workflow first uses flask-migrate to initialize the SQLite database
-    scheme and sets up the database. It will then search the provided data
-    directory for files in GeoTIFF format. Information will be extracted
-    from all scenes that haven't been imported to the database yet and added to
-    the database. The most common CRS in the dataset will also be determined,
-    which is used in grass_main() (see grass_fun.py).
+    scheme and sets up the database (see setup_db()). It will then search
+    the provided data directory for files in GeoTIFF format and compare them
+    to the scenes stored in the database (see create_filename_list()).
+    Information will be extracted from all scenes that were added or changed
+    (see stage_db_changes()). Scenes that were removed or changed are then
+    deleted from the database and the extracted information is added in the
+    same transaction, so the database never contains only part of the
+    changes (see publish_db_changes()). The summary of the dataset (see
+    update_summary()) and its generation are updated in this transaction as
+    well.
+    The most common CRS of
+    these scenes will also be determined, which is used in grass_main() (see
+    grass_fun.py).
+
+    :param scenes: Only compare these files with the database (e.g. files
+        that were noticed by the watcher, see watch_fun.py). If None, the
+        whole data directory is compared. [list]
+    :param progress: Keeps track of the progress of each stage (see
+        IngestProgress in progress_fun.py). [IngestProgress]
+
+    :return added: Scenes that were added to the database. [set]
+    :return changed: Scenes that were changed and updated in the
+        database. [set]
+    :return removed: Scenes that were removed from the database. [set]
+    :return epsg: Most common EPSG code of added and changed scenes or None
+        if there are none. [str]
     """
+    changes = stage_db_changes(scenes=scenes, progress=progress)
+    if has_changes(changes):
+        publish_db_changes(changes, progress=progress)
 
-    ## Initialize database if it hasn't been done already.
-    if not os.path.isdir("./migrations"):
-        os.system('flask db init')
+    return (changes['added'], changes['changed'], changes['removed'],
+            changes['epsg'])
 
-    ## Setup database scheme if it hasn't been done already.
-    file = os.path.join(Database.path, "s1_webapp.db")
-    if not os.path.isfile(file):
-        os.system('flask db migrate')
-        os.system('flask db upgrade')
-        print("~~~~")
 
-    ## Create a list of files that haven't been stored in the database yet.
-    ## Either this will just list all files because nothing has been
-    ## added to the db yet or it will update the db with new files.
-    scenes_list = create_filename_list()
+def stage_db_changes(scenes=None, progress=None):
+    """Compares the data directory with the database and extracts the
+    information of all added and changed scenes (see db_main()). The changes
+    are only kept in memory, so the ingestion doesn't hold a write
+    transaction of the database while the scenes are imported to GRASS
+    (see IngestWorker in ingest_fun.py). They are written with
+    publish_db_changes().
 
-    if len(scenes_list) == 0:
-        print(f"~~ The database is up-to-date. No new files were found in "
-              f"{Data.path}")
-        epsg = None
+    :param scenes: See db_main(). [list]
+    :param progress: See db_main(). [IngestProgress]
 
-        return scenes_list, epsg
+    :return: Added, changed and removed scenes ('added', 'changed',
+        'removed'), most common EPSG code of added and changed scenes or
+        None ('epsg') and the extracted information of added and changed
+        scenes ('info', see create_data_dict()). [dict]
+    """
 
-    else:
+    if progress is None:
+        progress = IngestProgress()
+
+    setup_db()
+
+    ## Make sure the spatial index contains all scenes of the database (see
+    ## spatial_fun.py)
+    sync_spatial_index()
+
+    ## Compare the files in the data directory with the scenes stored in the
+    ## database. Either this will just list all files as added because
+    ## nothing has been added to the db yet or it will only list the
+    ## differences.
+    progress.start('scan')
+    added, changed, removed = create_filename_list(scenes=scenes)
+    changes = {'added': added, 'changed': changed, 'removed': removed,
+               'epsg': None, 'info': {}}
+    progress.finish()
+
+    if not has_changes(changes):
+        print(f"~~ The database is up-to-date. No new, changed or removed "
+              f"files were found in {Data.path}")
+
+        return changes
+
+    scenes_list = sorted(added | changed)
+    if len(scenes_list) > 0:
         ## Create dictionary with all necessary information.
-        data_dict, common_epsg = create_data_dict(scenes=scenes_list)
+        data_dict, epsg = create_data_dict(scenes=scenes_list,
+                                           progress=progress)
 
-        ## Create new list of scenes in case any were rejected while running
-        ## create_data_dict()
-        scenes_list_new = list(data_dict.keys())
+        ## Update sets of scenes in case any were rejected while running
+        ## create_data_dict(). Changed scenes that were rejected are removed
+        ## from the database.
+        rejected = set(scenes_list) - set(data_dict.keys())
+        changes = {'added': added - rejected,
+                   'changed': changed - rejected,
+                   'removed': removed | (changed & rejected),
+                   'epsg': epsg, 'info': data_dict}
 
-        ## Add extracted information to database.
-        add_data_to_db(data_dict)
+        ## Nothing needs to be updated if all new scenes were rejected
+        if not has_changes(changes):
+            print(f"~~ No scenes left to update after rejecting "
+                  f"{len(rejected)} files.")
 
-        print(
-            f"~~ {len(scenes_list_new)} new files have been added to the "
-            f"SQLite database and will now be imported to GRASS.")
+            return changes
 
-        epsg = common_epsg
+    print(f"~~ Found {len(changes['added'])} new, "
+          f"{len(changes['changed'])} changed and "
+          f"{len(changes['removed'])} removed files.")
 
-        return scenes_list_new, epsg
+    return changes
 
 
-def create_filename_list(path=None):
-    """Creates a list of files that haven't been stored in the database yet.
-    The list will be used in 'create_data_dict()' to extract all necessary
-    information from those files.
+def has_changes(changes):
+    """Checks if scenes were added, changed or removed (see
+    stage_db_changes()).
 
-    :param path: Full path of a raster file
-        (e.g. "D:\\data_dir\\filename.tif").
+    :return: True if there are any changes. [bool]
+    """
+    return len(changes['added']) + len(changes['changed']) + \
+        len(changes['removed']) > 0
 
-    :return: Scenes that haven't been stored in the database yet. [list]
+
+def publish_db_changes(changes, progress=None):
+    """Writes the changes of stage_db_changes() to the database in a single
+    short transaction, so other requests see the new dataset at once.
+    Afterwards, scenes that were removed or changed are closed if they were
+    opened to extract timeseries and their cached tiles are removed.
+
+    :param changes: See stage_db_changes(). [dict]
+    :param progress: See db_main(). [IngestProgress]
     """
+    changed, removed = changes['changed'], changes['removed']
 
-    ## Define path to data directory
-    if path is None:
-        path = Data.path
+    ## Keys of the cached tiles are determined before the scenes are removed
+    outdated = list(removed | changed)
+    tile_keys = []
+    for i in range(0, len(outdated), 500):
+        tile_keys.extend(get_scene_key(s) for s in Scene.query.filter(
+            Scene.filepath.in_(outdated[i:i + 500])))
 
-    ## Search for GeoTIFF files using regular expression
-    scenes = [os.path.join(path, f) for f in os.listdir(path) if
-              re.search(r'.*\.tif', f)]
+    ## Remove scenes that were removed or changed from the database (changed
+    ## scenes are added again below). Nothing is committed until the
+    ## extracted information is added and the summary is updated as well.
+    if len(removed) + len(changed) > 0:
+        remove_data_from_db(removed | changed, commit=False)
 
-    if len(scenes) == 0:
-        raise ImportError("No files in GeoTIFF format were found in the "
-                          "directory: ", path)
+    ## Add extracted information to database.
+    if len(changes['info']) > 0:
+        add_data_to_db(changes['info'], progress=progress, commit=False)
 
-    ## Scenes already in database
-    db_scenes = Scene.query.all()
+    update_summary(bump_generation=True)
+    db.session.commit()
+
+    print(f"~~ SQLite database was updated: {len(changes['added'])} new, "
+          f"{len(changed)} changed and {len(removed)} removed files.")
+
+    for scene in removed | changed:
+        dataset_pool.evict(scene)
+    for key in tile_keys:
+        tile_cache.invalidate(key)
+    sync_spatial_index()
 
-    ## Only return scenes that are not in the database yet!
-    ## If no scenes in database, then all found scenes can be returned.
-    ## Else scenes that are already in the database need to be sorted out
-    ## first.
-    if len(db_scenes) == 0:
-        return scenes
-    else:
-        scenes_new = []
-        for scene in scenes:
-            if any(scene in db_scene.filepath for db_scene in db_scenes):
-                continue
-            else:
-                scenes_new.append(scene)
 
-        return scenes_new
+def get_staged_scenes(changes):
+    """Lists all scenes of the dataset as they will be once the changes of
+    stage_db_changes() are published, so they can be applied to GRASS
+    before the database is changed (see grass_main() in grass_fun.py).
+
+    :param changes: See stage_db_changes(). [dict]
+
+    :return: Filepath, date and nodata value of each scene, sorted by
+        date. [list]
+    """
+    outdated = changes['removed'] | changes['changed']
+    query = db.session.query(Scene.filepath, Scene.date, Metadata.nodata). \
+        join(Metadata, Metadata.scene_id == Scene.id)
+    scenes = [(filepath, date, nodata) for (filepath, date, nodata) in query
+              if filepath not in outdated]
+    scenes.extend((filepath, info['date'], info['nodata_val'])
+                  for filepath, info in changes['info'].items())
+
+    return sorted(scenes, key=lambda s: s[1])
+
+
+def setup_db():
+    """Uses flask-migrate to create the SQLite database scheme or to upgrade
+    it to the latest migration (see the directory 'migrations'). This runs
+    every time the webapp is started, so existing databases get new columns
+    and tables as well.
+    """
+    config = migrate.get_config(MIGRATIONS_DIR)
+    revisions = set(r.revision for r in
+                    ScriptDirectory.from_config(config).walk_revisions())
+    with db.engine.connect() as connection:
+        tables = inspect(connection).get_table_names()
+        current = MigrationContext.configure(connection). \
+            get_current_revision()
+
+    ## Databases of earlier versions were set up with a migration that was
+    ## generated locally. They are marked as having the scheme of the first
+    ## release, so only the changes since then are applied.
+    if 'scene' in tables and current not in revisions:
+        with db.engine.begin() as connection:
+            connection.execute("DELETE FROM alembic_version")
+        stamp(directory=MIGRATIONS_DIR, revision=BASE_REVISION)
+
+    upgrade(directory=MIGRATIONS_DIR)
+
+
+@timed('create_filename_list')
+def create_filename_list(path=None, scenes=None):
+    """Compares the GeoTIFF files in the data directory with the scenes stored
+    in the database, based on the fingerprint of each file (see
+    get_fingerprint()). Added and changed files will be used in
+    'create_data_dict()' to extract all necessary information from those
+    files.
+
+    :param path: Full path of the data directory
+        (e.g. "D:\\data_dir"). Defaults to Data.path (see config.py).
+    :param scenes: Only compare these files (full paths) instead of all files
+        in the data directory. Files that don't exist anymore are listed as
+        removed if they are stored in the database. [list]
+
+    :return added: Files that haven't been stored in the database yet. [set]
+    :return changed: Files that are stored in the database, but have been
+        modified since. [set]
+    :return removed: Scenes stored in the database whose file doesn't exist
+        anymore. [set]
+    """
 
+    ## Define path to data directory
+    if path is None:
+        path = Data.path
 
-def create_data_dict(scenes=None):
+    ## Fingerprints of scenes already in database
+    query = db.session.query(Scene.filepath, Scene.file_size,
+                             Scene.file_mtime, Scene.file_hash)
+
+    if scenes is not None:
+        ## Only compare the given files (queried in batches to stay below
+        ## SQLite's limit of variables per statement)
+        candidates = sorted(set(scenes))
+        rows = []
+        for i in range(0, len(candidates), 500):
+            rows.extend(query.filter(
+                Scene.filepath.in_(candidates[i:i + 500])))
+        scenes = set(s for s in candidates if os.path.isfile(s) and
+                     re.search(r'.*\.tif', os.path.basename(s)))
+    else:
+        ## Search for GeoTIFF files using regular expression
+        scenes = set(os.path.join(path, f) for f in os.listdir(path) if
+                     re.search(r'.*\.tif', f))
+
+        if len(scenes) == 0:
+            raise ImportError("No files in GeoTIFF format were found in the "
+                              "directory: ", path)
+        rows = query.all()
+
+    db_scenes = {filepath: (size, mtime, file_hash)
+                 for (filepath, size, mtime, file_hash) in rows}
+
+    added = scenes - db_scenes.keys()
+    removed = set(db_scenes.keys()) - scenes
+
+    ## Compare fingerprints of all files that are in the database already.
+    ## Scenes that were added before fingerprints were stored get their
+    ## fingerprint now.
+    changed = set()
+    missing = {}
+    for scene in scenes & db_scenes.keys():
+        if db_scenes[scene][0] is None:
+            missing[scene] = get_fingerprint(scene)
+        elif not _same_fingerprint(get_fingerprint(scene),
+                                   db_scenes[scene]):
+            changed.add(scene)
+
+    if len(missing) > 0:
+        _update_fingerprints(missing)
+
+    return added, changed, removed
+
+
+@timed('create_data_dict')
+def create_data_dict(scenes=None, workers=None, stats_mode=None,
+                     progress=None):
     """Creates a dictionary with information about each valid file in the
     data directory. The extracted information is then used to fill the
-    SQLite database.
+    SQLite database. The files are processed by multiple worker processes
+    (see _extract_scene_info()), the results are gathered in the order of
+    'scenes'.
 
     :param scenes: List of scenes created with get_filename_list().
+    :param workers: Number of worker processes. Defaults to Ingest.workers
+        (see config.py). If 1, all files are processed in the current
+        process. [int]
+    :param stats_mode: How the min/max of each scene is determined. See
+        _get_band_stats() for all options. Defaults to Ingest.stats_mode
+        (see config.py). [str]
+    :param progress: See db_main(). [IngestProgress]
 
     :return data_dict: Extracted information [dict]
-    :return common_epsg: Most common EPSG code for the dataset [int]
+    :return common_epsg: Most common EPSG code for the dataset or None if
+        all scenes were rejected [int]
     """
+    if workers is None:
+        workers = Ingest.workers
+    workers = max(1, min(workers, len(scenes)))
+
+    if stats_mode is None:
+        stats_mode = Ingest.stats_mode
+    if stats_mode not in ('exact', 'approx', 'stored'):
+        raise ValueError(f"Unknown statistics mode '{stats_mode}'. Use "
+                         f"'exact', 'approx' or 'stored'.")
+
+    if progress is None:
+        progress = IngestProgress()
+    progress.start('extract', total=len(scenes))
+
+    ## Extract information from each scene
+    results = []
+    if workers > 1:
+        chunksize = max(1, len(scenes) // (workers * 4))
+        ## The worker processes are spawned instead of forked, so they
+        ## don't inherit locks held by other threads of the webapp (e.g. of
+        ## GDAL or the database, see create_change_raster() in
+        ## composite_fun.py)
+        with ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context('spawn')) as executor:
+            for info in executor.map(_extract_scene_info, scenes,
+                                     repeat(stats_mode),
+                                     chunksize=chunksize):
+                results.append(info)
+                progress.advance(nbytes=_get_info_size(info))
+    else:
+        for scene in scenes:
+            info = _extract_scene_info(scene, stats_mode)
+            results.append(info)
+            progress.advance(nbytes=_get_info_size(info))
+
+    progress.finish()
 
-    ## Loop over each scene, extract information and store in dict. Also
-    ## store EPSG code of each scene in a separate list.
+    ## Store information of each scene in dict. Also store EPSG code of each
+    ## scene in a separate list. Scenes that information couldn't be
+    ## extracted from are rejected.
     any_reject = False  # will be set to True if any scenes are rejected
     num_reject = 0  # will be counted up, if any scenes are rejected
     data_dict = {}
     epsg_list = []
-    for scene in scenes:
-        data = gdal.Open(scene, GA_ReadOnly)
-        band = data.GetRasterBand(1)
-
-        try:
-            band_min, band_max = band.ComputeRasterMinMax(True)
-
-            ## Get information that is stored in the filename itself (#pyroSAR)
-            file_info = _get_filename_info(scene)
-
-            ## Get extent and resolution
-            bounds = _get_extent_resolution(data)
-
-            ## Get EPSG and append to list
-            epsg = _get_epsg(scene)
-            epsg_list.append(epsg)
-
-            data_dict[scene] = {"sensor": file_info[0],
-                                "orbit": file_info[2],
-                                "date": file_info[4],
-                                "acquisition_mode": file_info[1],
-                                "polarisation": file_info[3],
-                                "columns": data.RasterXSize,
-                                "rows": data.RasterYSize,
-                                "epsg": epsg,
-                                "bounds_south": bounds[0],
-                                "bounds_north": bounds[2],
-                                "bounds_west": bounds[3],
-                                "bounds_east": bounds[1],
-                                "resolution": int(bounds[4]),
-                                "nodata_val": int(band.GetNoDataValue()),
-                                "band_min": band_min,
-                                "band_max": band_max}
-
-        except RuntimeError:
-            ## File was opened in GDAL. Overwrite with 'None' to close.
-            data = None
-
+    for scene, info in zip(scenes, results):
+        if info is None:
             ## Create subdirectory for rejected files
             reject_dir = os.path.join(Data.path, 'reject')
             if not os.path.exists(reject_dir):
@@ -171,12 +393,18 @@ def create_data_dict(scenes=None):
             shutil.move(olddir, newdir)
 
             num_reject += 1
+            scenes_rejected.inc()
             any_reject = True
 
             continue
 
-    ## Get most common epsg from epsg_list
-    common_epsg = max(set(epsg_list), key=epsg_list.count)
+        data_dict[scene] = info
+        epsg_list.append(info['epsg'])
+
+    ## Get most common epsg from epsg_list (None if all scenes were
+    ## rejected)
+    common_epsg = max(set(epsg_list), key=epsg_list.count) \
+        if len(epsg_list) > 0 else None
 
     ## Print number of scenes that were rejected (if any were rejected)
     if any_reject:
@@ -187,41 +415,363 @@ def create_data_dict(scenes=None):
     return data_dict, common_epsg
 
 
-def add_data_to_db(info_dict):
+def _extract_scene_info(scene, stats_mode):
+    """Extracts all necessary information from a single scene. This runs in
+    the worker processes of create_data_dict(), so the file is opened only
+    once and nothing is written to the database or the data directory here.
+
+    :param scene: Full path of a raster file
+        (e.g. "D:\\data_dir\\filename.tif").
+    :param stats_mode: See _get_band_stats(). [str]
+
+    :return: Extracted information or None if the file couldn't be read
+        with GDAL. [dict]
+    """
+    try:
+        data = gdal.Open(scene, GA_ReadOnly)
+        band = data.GetRasterBand(1)
+
+        band_min, band_max, stats_mode = _get_band_stats(band, stats_mode)
+
+        ## Get information that is stored in the filename itself (#pyroSAR)
+        file_info = _get_filename_info(scene)
+
+        ## Get extent and resolution
+        bounds = _get_extent_resolution(data)
+
+        ## Get EPSG
+        epsg = _get_epsg(data)
+
+        info = {"sensor": file_info[0],
+                "orbit": file_info[2],
+                "date": file_info[4],
+                "acquisition_mode": file_info[1],
+                "polarisation": file_info[3],
+                "columns": data.RasterXSize,
+                "rows": data.RasterYSize,
+                "epsg": epsg,
+                "bounds_south": bounds[0],
+                "bounds_north": bounds[2],
+                "bounds_west": bounds[3],
+                "bounds_east": bounds[1],
+                "resolution": int(bounds[4]),
+                "nodata_val": int(band.GetNoDataValue()),
+                "band_min": band_min,
+                "band_max": band_max,
+                "stats_mode": stats_mode,
+                "fingerprint": get_fingerprint(scene)}
+
+    except RuntimeError:
+        return None
+
+    finally:
+        ## Close file
+        band = None
+        data = None
+
+    return info
+
+
+@timed('add_data_to_db')
+def add_data_to_db(info_dict, batch_size=None, progress=None, commit=True):
     """Adds information that was extracted using 'create_data_dict()' to the
-    database.
+    database. Rows are inserted in batches with one executemany statement
+    per table and batch. All batches are committed in a single transaction.
 
     :param info_dict: Information to be added to the database. [dict]
+    :param batch_size: Number of scenes inserted per batch. Defaults to
+        Ingest.batch_size (see config.py). [int]
+    :param progress: See db_main(). [IngestProgress]
+    :param commit: If False, the changes are committed later (e.g. together
+        with removed scenes in publish_db_changes()). [bool]
     """
     info = info_dict
+    scenes = list(info.keys())
+
+    if batch_size is None:
+        batch_size = Ingest.batch_size
+    if progress is None:
+        progress = IngestProgress()
+    progress.start('database', total=len(scenes))
+
+    ## Keep more pages in memory and temporary tables out of the disk while
+    ## loading (only affects the current connection)
+    db.session.execute("PRAGMA cache_size = -65536")
+    db.session.execute("PRAGMA temp_store = MEMORY")
+
+    for i in range(0, len(scenes), batch_size):
+        batch = scenes[i:i + batch_size]
+
+        db.session.execute(Scene.__table__.insert(), [
+            dict(sensor=info[scene]['sensor'],
+                 orbit=info[scene]['orbit'],
+                 date=info[scene]['date'],
+                 filepath=scene,
+                 file_size=info[scene]['fingerprint'][0],
+                 file_mtime=info[scene]['fingerprint'][1],
+                 file_hash=info[scene]['fingerprint'][2])
+            for scene in batch])
+
+        ## Get IDs of the inserted scenes
+        ids = dict(db.session.query(Scene.filepath, Scene.id).filter(
+            Scene.filepath.in_(batch)))
+
+        db.session.execute(Metadata.__table__.insert(), [
+            dict(scene_id=ids[scene],
+                 acq_mode=info[scene]['acquisition_mode'],
+                 polarisation=info[scene]['polarisation'],
+                 resolution=info[scene]['resolution'],
+                 nodata=info[scene]['nodata_val'],
+                 band_min=info[scene]['band_min'],
+                 band_max=info[scene]['band_max'],
+                 stats_mode=info[scene]['stats_mode'])
+            for scene in batch])
+
+        db.session.execute(Geometry.__table__.insert(), [
+            dict(scene_id=ids[scene],
+                 columns=info[scene]['columns'],
+                 rows=info[scene]['rows'],
+                 epsg=info[scene]['epsg'],
+                 bounds_south=info[scene]['bounds_south'],
+                 bounds_north=info[scene]['bounds_north'],
+                 bounds_west=info[scene]['bounds_west'],
+                 bounds_east=info[scene]['bounds_east'])
+            for scene in batch])
+
+        ## Bounds are also added to the spatial index (see spatial_fun.py)
+        add_to_spatial_index([
+            (ids[scene], info[scene]['epsg'], info[scene]['bounds_west'],
+             info[scene]['bounds_south'], info[scene]['bounds_east'],
+             info[scene]['bounds_north'])
+            for scene in batch])
+
+        progress.advance(len(batch))
+
+    if commit:
+        db.session.commit()
+    scenes_ingested.inc(len(scenes))
+    progress.finish()
 
-    for scene in info.keys():
-        s = Scene(sensor=info[scene]['sensor'],
-                  orbit=info[scene]['orbit'],
-                  date=info[scene]['date'],
-                  filepath=scene)
-        m = Metadata(acq_mode=info[scene]['acquisition_mode'],
-                     polarisation=info[scene]['polarisation'],
-                     resolution=info[scene]['resolution'],
-                     nodata=info[scene]['nodata_val'],
-                     band_min=info[scene]['band_min'],
-                     band_max=info[scene]['band_max'],
-                     s1_scene=s)
-        g = Geometry(columns=info[scene]['columns'],
-                     rows=info[scene]['rows'],
-                     epsg=info[scene]['epsg'],
-                     bounds_south=info[scene]['bounds_south'],
-                     bounds_north=info[scene]['bounds_north'],
-                     bounds_west=info[scene]['bounds_west'],
-                     bounds_east=info[scene]['bounds_east'],
-                     s1_scene=s)
-
-        db.session.add(s)
-        db.session.add(m)
-        db.session.add(g)
+
+def remove_data_from_db(scenes, commit=True):
+    """Removes scenes and their metadata and geometry from the database.
+
+    :param scenes: Full paths of the scenes to be removed. [list or set]
+    :param commit: If False, the changes are committed later (e.g. together
+        with new scenes in add_data_to_db()). [bool]
+    """
+    scenes = list(scenes)
+
+    ## Scenes are removed in batches to stay below SQLite's limit of
+    ## variables per statement
+    batch = 500
+    for i in range(0, len(scenes), batch):
+        ids = [scene_id for (scene_id,) in db.session.query(Scene.id).filter(
+            Scene.filepath.in_(scenes[i:i + batch]))]
+
+        Metadata.query.filter(Metadata.scene_id.in_(ids)). \
+            delete(synchronize_session=False)
+        Geometry.query.filter(Geometry.scene_id.in_(ids)). \
+            delete(synchronize_session=False)
+        Scene.query.filter(Scene.id.in_(ids)). \
+            delete(synchronize_session=False)
+        remove_from_spatial_index(ids)
+
+    if commit:
         db.session.commit()
 
 
+def update_summary(bump_generation=False):
+    """Updates the summary of the dataset (number of scenes, first and last
+    date, overall minimum and maximum value and number of scenes per CRS),
+    which is stored in a single row (see Dataset), so pages don't need to
+    query all scenes. Nothing is committed, so the summary can be updated
+    in the same transaction as the scenes (see publish_db_changes()).
+
+    :param bump_generation: Also increase the generation of the dataset, so
+        results that were cached for the previous generation (e.g. plots,
+        see cache_fun.py) aren't used anymore. [bool]
+
+    :return: Updated summary. [Dataset]
+    """
+    d = Dataset.query.get(1)
+    if d is None:
+        d = Dataset(id=1, generation=0)
+        db.session.add(d)
+
+    if bump_generation:
+        d.generation = (d.generation or 0) + 1
+
+    d.n_scenes, d.date_min, d.date_max = db.session.query(
+        func.count(Scene.id), func.min(Scene.date), func.max(Scene.date)).one()
+    d.band_min, d.band_max = db.session.query(
+        func.min(Metadata.band_min), func.max(Metadata.band_max)).one()
+    d.crs_histogram = json.dumps(dict(db.session.query(
+        Geometry.epsg, func.count(Geometry.id)).group_by(Geometry.epsg)))
+
+    return d
+
+
+def ensure_summary():
+    """Creates the summary of the dataset (see update_summary()) if it
+    doesn't exist yet, e.g. because the scenes were added by an earlier
+    version. This is called once when the webapp is started (see
+    initialize() in routes.py), before scenes are ingested, so requests
+    never have to write to the database.
+    """
+    d = Dataset.query.get(1)
+    if d is None or d.n_scenes is None:
+        update_summary()
+        db.session.commit()
+
+
+def get_summary():
+    """Gets the summary of the dataset (see update_summary()). If it hasn't
+    been created yet (see ensure_summary()), an empty summary is returned.
+
+    :return: Number of scenes ('n_scenes'), first and last date ('date_min',
+        'date_max'), overall minimum and maximum value ('band_min',
+        'band_max'), number of scenes per EPSG code ('crs') and generation
+        ('generation') of the dataset. [dict]
+    """
+    d = Dataset.query.get(1)
+    if d is None or d.n_scenes is None:
+        return {'n_scenes': 0, 'date_min': None, 'date_max': None,
+                'band_min': None, 'band_max': None, 'crs': {},
+                'generation': get_generation()}
+
+    return {'n_scenes': d.n_scenes,
+            'date_min': d.date_min,
+            'date_max': d.date_max,
+            'band_min': d.band_min,
+            'band_max': d.band_max,
+            'crs': json.loads(d.crs_histogram or '{}'),
+            'generation': d.generation}
+
+
+def parse_scene_filters(args):
+    """Reads filters for scenes from the query parameters of a request
+    (see apply_scene_filters()).
+
+    :param args: Query parameters (e.g. request.args). Supported are
+        'date_from' and 'date_to' (YYYY-MM-DD), 'orbit' ('ascending' or
+        'descending'), 'polarisation' (e.g. 'VV') and 'sensor' (e.g.
+        'S1A'). [dict]
+
+    :return: Filters that were set. Raises ValueError if a date can't be
+        parsed. [dict]
+    """
+    filters = {}
+    for key in ('date_from', 'date_to'):
+        if args.get(key):
+            try:
+                filters[key] = datetime.strptime(args[key], "%Y-%m-%d")
+            except ValueError:
+                raise ValueError(f"'{key}' must be a date in the format "
+                                 f"YYYY-MM-DD.")
+    for key in ('orbit', 'polarisation', 'sensor'):
+        if args.get(key):
+            filters[key] = args[key]
+
+    return filters
+
+
+def apply_scene_filters(query, filters):
+    """Restricts a query of scenes to scenes matching the given filters. The
+    indexed columns Scene.date, Scene.orbit, Scene.sensor and
+    Metadata.polarisation are used.
+
+    :param query: Query including the Scene table. [sqlalchemy.orm.Query]
+    :param filters: Output of parse_scene_filters(). [dict]
+
+    :return: Filtered query. [sqlalchemy.orm.Query]
+    """
+    if filters is None:
+        return query
+
+    if 'date_from' in filters:
+        query = query.filter(Scene.date >= filters['date_from'])
+    if 'date_to' in filters:
+        ## Include all scenes of the last day
+        query = query.filter(Scene.date < filters['date_to'] +
+                             timedelta(days=1))
+    if 'orbit' in filters:
+        query = query.filter(Scene.orbit == filters['orbit'])
+    if 'sensor' in filters:
+        query = query.filter(Scene.sensor == filters['sensor'])
+    if 'polarisation' in filters:
+        query = query.filter(Scene.id.in_(
+            db.session.query(Metadata.scene_id).filter(
+                Metadata.polarisation == filters['polarisation'])))
+
+    return query
+
+
+def get_generation():
+    """Gets the generation of the dataset, which is increased every time
+    scenes are added, changed or removed (see update_summary()).
+
+    :return: Generation of the dataset. [int]
+    """
+    d = Dataset.query.get(1)
+
+    return 0 if d is None else d.generation
+
+
+def get_fingerprint(path):
+    """Gets the fingerprint of a file, which is used to notice if a file has
+    been modified since it was added to the database.
+
+    :param path: Full path of a raster file
+        (e.g. "D:\\data_dir\\filename.tif").
+
+    :return: Size in bytes, modification time and (if Ingest.header_hash is
+        True, see config.py) SHA-1 hash of the first bytes of the file,
+        which contain the header of a GeoTIFF. [tuple]
+    """
+    stat = os.stat(path)
+
+    file_hash = None
+    if Ingest.header_hash:
+        with open(path, 'rb') as f:
+            file_hash = hashlib.sha1(f.read(HEADER_BYTES)).hexdigest()
+
+    return stat.st_size, stat.st_mtime, file_hash
+
+
+def _get_info_size(info):
+    """Gets the file size of a scene from the output of
+    _extract_scene_info() (0 if the scene was rejected).
+    """
+    return 0 if info is None else info['fingerprint'][0]
+
+
+def _update_fingerprints(fingerprints):
+    """Stores the fingerprints of scenes that are already in the database.
+
+    :param fingerprints: Fingerprint (see get_fingerprint()) of each
+        scene. [dict]
+    """
+    for scene, (size, mtime, file_hash) in fingerprints.items():
+        Scene.query.filter_by(filepath=scene). \
+            update({'file_size': size, 'file_mtime': mtime,
+                    'file_hash': file_hash}, synchronize_session=False)
+
+    db.session.commit()
+
+
+def _same_fingerprint(fp_a, fp_b):
+    """Compares two fingerprints (see get_fingerprint()). Hashes are only
+    compared if both fingerprints include one.
+    """
+    if fp_a[0] != fp_b[0] or fp_a[1] != fp_b[1]:
+        return False
+    if fp_a[2] is not None and fp_b[2] is not None:
+        return fp_a[2] == fp_b[2]
+
+    return True
+
+
 def _get_filename_info(path):
     """Gets information about a raster file based on pyroSAR's file naming
     scheme: https://pyrosar.readthedocs.io/en/latest/general/filenaming.html
@@ -279,17 +829,42 @@ def _get_extent_resolution(dataset):
     return [lrx, lry, ulx, uly, xres, yres]
 
 
-def _get_epsg(path):
-    """Gets EPSG code from a raster file using GDAL.
+def _get_band_stats(band, mode):
+    """Gets the minimum and maximum value of a raster band.
 
-    :param path: Full path of a raster file
-        (e.g. "D:\\data_dir\\filename.tif").
+    :param band: osgeo.gdal.Band
+    :param mode: 'exact' reads all pixels of the band. 'approx' uses an
+        overview of the band or a sample of its pixels. 'stored' reuses
+        statistics stored in the file or its .aux.xml file, so no pixels have
+        to be read. If no statistics are stored, 'approx' is used. Scenes
+        added by earlier versions always used 'approx'. [str]
+
+    :return: Minimum, maximum and the mode that was used. [tuple]
+    """
+
+    if mode == 'stored':
+        band_min = band.GetMetadataItem('STATISTICS_MINIMUM')
+        band_max = band.GetMetadataItem('STATISTICS_MAXIMUM')
+
+        if band_min is not None and band_max is not None:
+            return float(band_min), float(band_max), mode
+
+        mode = 'approx'
+
+    band_min, band_max = band.ComputeRasterMinMax(mode == 'approx')
+
+    return band_min, band_max, mode
+
+
+def _get_epsg(dataset):
+    """Gets EPSG code from a loaded raster file.
+
+    :param dataset: osgeo.gdal.Dataset
 
     :return: EPSG code. [str]
     """
 
-    data = gdal.Open(path, GA_ReadOnly)
-    proj = osr.SpatialReference(wkt=data.GetProjection())
+    proj = osr.SpatialReference(wkt=dataset.GetProjection())
     epsg = str(proj.GetAttrValue('AUTHORITY', 1))
 
     return epsg
@@ -0,0 +1,121 @@
+import io
+import csv
+import numpy as np
+
+## pyarrow is optional and only needed for Parquet output
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+
+def parquet_available():
+    """Checks if Parquet output is available (requires pyarrow).
+
+    :return: True if pyarrow is installed. [bool]
+    """
+    return pq is not None
+
+
+def stream_csv(latitudes, longitudes, series):
+    """Writes timeseries of multiple locations as CSV. Each scene is
+    written as soon as its values are available, so the output can be
+    streamed to the client.
+
+    :param latitudes: Latitude coordinates of the locations. [list]
+    :param longitudes: Longitude coordinates of the locations. [list]
+    :param series: Output of iter_batch_timeseries() in grass_fun.py.
+        [generator]
+
+    :return: Generator of CSV lines. [str]
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    writer.writerow(['point', 'latitude', 'longitude', 'date', 'value'])
+    yield _drain(buffer)
+
+    for date, values in series:
+        date = date.isoformat()
+        for i, value in enumerate(values):
+            writer.writerow([i, latitudes[i], longitudes[i], date,
+                             '' if np.isnan(value) else round(float(value), 4)])
+        yield _drain(buffer)
+
+
+def stream_parquet(latitudes, longitudes, series):
+    """Writes timeseries of multiple locations as Parquet. Each scene is
+    written as a separate row group as soon as its values are available,
+    so the output can be streamed to the client.
+
+    :param latitudes: Latitude coordinates of the locations. [list]
+    :param longitudes: Longitude coordinates of the locations. [list]
+    :param series: Output of iter_batch_timeseries() in grass_fun.py.
+        [generator]
+
+    :return: Generator of Parquet data. [bytes]
+    """
+    if pq is None:
+        raise ImportError("pyarrow is required for Parquet output.")
+
+    schema = pa.schema([('point', pa.int32()),
+                        ('latitude', pa.float64()),
+                        ('longitude', pa.float64()),
+                        ('date', pa.timestamp('ms')),
+                        ('value', pa.float32())])
+
+    points = pa.array(np.arange(len(latitudes), dtype=np.int32))
+    lats = pa.array(np.asarray(latitudes, dtype=np.float64))
+    lngs = pa.array(np.asarray(longitudes, dtype=np.float64))
+
+    sink = _StreamSink()
+    writer = pq.ParquetWriter(sink, schema)
+
+    for date, values in series:
+        dates = pa.array([date] * len(values), type=pa.timestamp('ms'))
+        values = pa.array(np.asarray(values, dtype=np.float32),
+                          from_pandas=True)
+        writer.write_table(pa.Table.from_arrays(
+            [points, lats, lngs, dates, values], schema=schema))
+        yield sink.drain()
+
+    writer.close()
+    yield sink.drain()
+
+
+def _drain(buffer):
+    data = buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate()
+
+    return data
+
+
+class _StreamSink(io.RawIOBase):
+    """Writable file object that keeps written data until it is drained,
+    so the ParquetWriter can write to it while the output is streamed.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        data = bytes(data)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
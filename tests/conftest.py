@@ -0,0 +1,13 @@
+"""Shared setup of the tests. config.py reads the data directory when it's
+imported, so it's set to an empty temporary directory before any module of
+the webapp is imported (see S1GRASS_DATA_DIR in config.py).
+"""
+
+import os
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+os.environ.setdefault('S1GRASS_DATA_DIR', tempfile.mkdtemp())
@@ -0,0 +1,58 @@
+"""Tests of the ingestion of scenes (see IngestWorker in ingest_fun.py).
+They need GDAL and GRASS GIS like the webapp itself and are skipped if
+either is missing.
+"""
+
+import os
+import pytest
+
+pytest.importorskip('osgeo')
+pytest.importorskip('grass.script')
+
+from config import Data, Grass, Ingest
+from flask_app import app
+from ingest_fun import IngestWorker
+from sqlite_fun import db_main
+
+
+@pytest.fixture
+def rejected_scene(monkeypatch):
+    ## A file with the name of a GeoTIFF that GDAL can't read, so it's
+    ## rejected by create_data_dict()
+    monkeypatch.setattr(Ingest, 'workers', 1)
+    path = os.path.join(Data.path, 'S1A__IW___A_20180101T000000_147_VV_'
+                                   'grd_mli_norm_geo_db.tif')
+    with open(path, 'w') as f:
+        f.write("not a GeoTIFF")
+
+    yield path
+
+    reject_path = os.path.join(Data.path, 'reject', os.path.basename(path))
+    for p in (path, reject_path):
+        if os.path.isfile(p):
+            os.remove(p)
+
+
+def test_db_main_all_rejected(rejected_scene):
+    with app.app_context():
+        added, changed, removed, epsg = db_main()
+
+    assert (added, changed, removed, epsg) == (set(), set(), set(), None)
+    assert not os.path.isfile(rejected_scene)
+    assert os.path.isfile(os.path.join(Data.path, 'reject',
+                                       os.path.basename(rejected_scene)))
+
+
+def test_ingest_all_rejected_without_grass_project(rejected_scene):
+    ## Without any GRASS project, the worker must not try to start a GRASS
+    ## session (see grass_project_exists() in grass_fun.py)
+    assert not any(f.startswith('GRASS_db_') for f in os.listdir(Grass.path))
+
+    worker = IngestWorker()
+    assert worker.start()
+    worker.join(timeout=300)
+
+    status = worker.status()
+    assert status['state'] == 'done', status['error']
+    assert status['result'] == {'added': 0, 'changed': 0, 'removed': 0}
+    assert not any(f.startswith('GRASS_db_') for f in os.listdir(Grass.path))
@@ -0,0 +1,380 @@
+from config import Grass, Tiles
+from flask_app.models import Scene
+from metrics_fun import cache_requests
+
+from osgeo import gdal, osr
+from bokeh.palettes import Viridis256
+import os
+import re
+import uuid
+import hashlib
+import shutil
+import threading
+import numpy as np
+gdal.UseExceptions()
+
+## Tiles are rendered in Web Mercator (EPSG:3857) like the basemap
+TILE_SIZE = 256
+MERCATOR_EXTENT = 20037508.342789244
+
+## Colormap as lookup table (value 0-255 -> RGBA)
+VIRIDIS = np.array([[int(c[i:i + 2], 16) for i in (1, 3, 5)] + [255]
+                    for c in Viridis256], dtype=np.uint8)
+
+
+class TileCache(object):
+    """Stores rendered tiles on disk (see Tiles.path in config.py). Tiles
+    are stored per layer, so all tiles of a layer can be removed at once
+    when the raster of the layer changes. Once the cache exceeds its size
+    limit, the least recently used tiles are removed.
+    """
+
+    def __init__(self, path=None, max_size=None):
+        if path is None:
+            path = Tiles.path
+        if max_size is None:
+            max_size = Tiles.max_size * 1024 * 1024
+
+        self.path = path
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self._size = None
+
+    def get(self, layer, z, x, y):
+        """Returns a cached tile or None if it isn't cached."""
+        path = self._get_path(layer, z, x, y)
+        try:
+            with open(path, 'rb') as f:
+                tile = f.read()
+        except OSError:
+            cache_requests.inc(cache='tile', result='miss')
+            return None
+
+        ## Used tiles are removed last (see _evict())
+        os.utime(path)
+        cache_requests.inc(cache='tile', result='hit')
+
+        return tile
+
+    def put(self, layer, z, x, y, tile):
+        """Stores a tile in the cache."""
+        path = self._get_path(layer, z, x, y)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        ## Write to a temporary file first, so incomplete tiles are never read
+        tmp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+        with open(tmp_path, 'wb') as f:
+            f.write(tile)
+        os.replace(tmp_path, path)
+
+        with self.lock:
+            if self._size is None:
+                self._size = self._get_size()
+            else:
+                self._size += len(tile)
+
+            if self._size > self.max_size:
+                self._evict()
+
+    def invalidate(self, layer):
+        """Removes all cached tiles of a layer."""
+        with self.lock:
+            shutil.rmtree(os.path.join(self.path, str(layer)),
+                          ignore_errors=True)
+            self._size = None
+
+    def _get_path(self, layer, z, x, y):
+        return os.path.join(self.path, str(layer), str(z), str(x),
+                            f'{y}.png')
+
+    def _get_files(self):
+        files = []
+        for root, dirs, filenames in os.walk(self.path):
+            for f in filenames:
+                path = os.path.join(root, f)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+
+    def _get_size(self):
+        return sum(size for (mtime, size, path) in self._get_files())
+
+    def _evict(self):
+        ## Remove least recently used tiles until the cache only uses 80% of
+        ## its size limit
+        files = sorted(self._get_files())
+        size = sum(size for (mtime, size, path) in files)
+        for mtime, file_size, path in files:
+            if size <= 0.8 * self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            size -= file_size
+        self._size = size
+
+
+## Cache that is shared by all requests of the webapp
+tile_cache = TileCache()
+
+
+def get_tile(layer, z, x, y):
+    """Returns a tile of a layer as PNG. Tiles are rendered once and then
+    served from the cache (see TileCache).
+
+    :param layer: 'avg' for avg_raster.tif (or 'mean', 'std', 'min', 'max' for
+        the other rasters created with create_stat_raster() in grass_fun.py,
+        or the name of a composite or change map) or the ID of a scene in
+        the database. [str]
+    :param z: Zoom level. [int]
+    :param x: Column of the tile. [int]
+    :param y: Row of the tile. [int]
+
+    :return: Tile in PNG format or None if the layer doesn't exist. [bytes]
+    """
+    ## The key is part of the path of cached tiles, so the layer is checked
+    ## first
+    key = get_layer_key(layer)
+    if key is None:
+        return None
+
+    tile = tile_cache.get(key, z, x, y)
+    if tile is not None:
+        return tile
+
+    source = get_layer_source(layer)
+    if source is None:
+        return None
+
+    path, value_range = source
+    tile = render_tile(path, z, x, y, value_range=value_range)
+    tile_cache.put(key, z, x, y, tile)
+
+    return tile
+
+
+def get_layer_key(layer):
+    """Gets the key that the tiles of a layer are cached by (see
+    TileCache). Checks if the layer is the ID of a scene in the database or
+    the name of a raster in the output directory (see get_tile()).
+
+    :param layer: See get_tile(). [str]
+
+    :return: Key of the layer or None if it doesn't exist. [str]
+    """
+    layer = str(layer)
+    if layer.isdigit():
+        s = Scene.query.get(int(layer))
+        if s is None:
+            return None
+        return get_scene_key(s)
+
+    ## Names of layers only consist of letters, digits and underscores (see
+    ## _get_layer_name() in grass_fun.py)
+    if not re.fullmatch(r'[A-Za-z0-9_]+', layer):
+        return None
+
+    if not os.path.isfile(os.path.join(Grass.path_out, f'{layer}_raster.tif')):
+        return None
+
+    return layer
+
+
+def get_scene_key(scene):
+    """Gets the key that the tiles of a scene are cached by. SQLite reuses
+    the IDs of removed scenes and a changed file keeps its ID, so the key
+    contains the fingerprint of the file as well (see get_fingerprint() in
+    sqlite_fun.py).
+
+    :param scene: Scene of the database. [Scene]
+
+    :return: Key of the scene. [str]
+    """
+    fingerprint = f'{scene.file_size}_{scene.file_mtime}_{scene.file_hash}'
+
+    return f'{scene.id}_{hashlib.sha1(fingerprint.encode()).hexdigest()[:10]}'
+
+
+def get_layer_source(layer):
+    """Gets the raster file of a layer and the range of values used to
+    color it.
+
+    :param layer: See get_tile(). [str]
+
+    :return: Path and value range (None if the raster has a color table)
+        or None if the layer doesn't exist. [tuple]
+    """
+    if str(layer).isdigit():
+        ## Layer is a scene
+        s = Scene.query.get(int(layer))
+        if s is None:
+            return None
+        meta = s.meta.first()
+
+        return s.filepath, (meta.band_min, meta.band_max)
+
+    path = os.path.join(Grass.path_out, f'{layer}_raster.tif')
+    if not os.path.isfile(path):
+        return None
+
+    ## Rasters without color table (e.g. change maps, see
+    ## create_change_raster() in composite_fun.py) store their value range
+    data = gdal.Open(path)
+    value_range = data.GetRasterBand(1).GetMetadataItem('VALUE_RANGE')
+    data = None
+    if value_range is not None:
+        return path, tuple(float(v) for v in value_range.split(','))
+
+    return path, None
+
+
+def render_tile(path, z, x, y, value_range=None):
+    """Renders a tile of a raster file. Only the part of the raster that
+    covers the tile is read (using overviews on lower zoom levels).
+
+    :param path: Full path of the raster file. [str]
+    :param z: Zoom level. [int]
+    :param x: Column of the tile. [int]
+    :param y: Row of the tile. [int]
+    :param value_range: Minimum and maximum value that are mapped onto the
+        colormap. If None, the color table of the raster file is used.
+        [tuple]
+
+    :return: Tile in PNG format. [bytes]
+    """
+    bounds = get_tile_bounds(z, x, y)
+
+    ## Warp the part of the raster that covers the tile to Web Mercator
+    if value_range is None:
+        data = gdal.Warp('', path, format='MEM', outputBounds=bounds,
+                         width=TILE_SIZE, height=TILE_SIZE,
+                         dstSRS='EPSG:3857', resampleAlg='near',
+                         dstNodata=0)
+        band = data.GetRasterBand(1)
+        values = band.ReadAsArray()
+        lut = _get_color_table(band)
+        rgba = lut[values.astype(np.uint8)]
+        rgba[values == 0, 3] = 0
+    else:
+        data = gdal.Warp('', path, format='MEM', outputBounds=bounds,
+                         width=TILE_SIZE, height=TILE_SIZE,
+                         dstSRS='EPSG:3857', resampleAlg='near',
+                         outputType=gdal.GDT_Float32, dstNodata=np.nan)
+        values = data.GetRasterBand(1).ReadAsArray()
+        rgba = colorize(values, value_range)
+
+    data = None
+
+    return encode_png(rgba)
+
+
+def colorize(values, value_range, lut=VIRIDIS):
+    """Maps values onto a colormap. NaN values are transparent.
+
+    :param values: 2D array of values. [numpy.ndarray]
+    :param value_range: Minimum and maximum value of the colormap. [tuple]
+    :param lut: Colormap as array of RGBA values. [numpy.ndarray]
+
+    :return: 3D array (rows, columns, RGBA). [numpy.ndarray]
+    """
+    v_min, v_max = value_range
+    scale = (len(lut) - 1) / max(v_max - v_min, 1e-12)
+
+    valid = np.isfinite(values)
+    index = np.zeros(values.shape, dtype=np.intp)
+    index[valid] = np.clip((values[valid] - v_min) * scale, 0, len(lut) - 1)
+
+    rgba = lut[index]
+    rgba[~valid, 3] = 0
+
+    return rgba
+
+
+def encode_png(rgba):
+    """Encodes an RGBA array as PNG using GDAL.
+
+    :param rgba: 3D array (rows, columns, RGBA). [numpy.ndarray]
+
+    :return: Image in PNG format. [bytes]
+    """
+    rows, cols = rgba.shape[:2]
+    mem = gdal.GetDriverByName('MEM').Create('', cols, rows, 4, gdal.GDT_Byte)
+    for i in range(4):
+        mem.GetRasterBand(i + 1).WriteArray(rgba[:, :, i])
+
+    path = f'/vsimem/{uuid.uuid4().hex}.png'
+    gdal.GetDriverByName('PNG').CreateCopy(path, mem)
+    mem = None
+
+    f = gdal.VSIFOpenL(path, 'rb')
+    gdal.VSIFSeekL(f, 0, 2)
+    size = gdal.VSIFTellL(f)
+    gdal.VSIFSeekL(f, 0, 0)
+    png = gdal.VSIFReadL(1, size, f)
+    gdal.VSIFCloseL(f)
+    gdal.Unlink(path)
+
+    return png
+
+
+def get_tile_bounds(z, x, y):
+    """Gets the bounds of a tile in Web Mercator.
+
+    :return: minx, miny, maxx, maxy. [tuple]
+    """
+    size = 2 * MERCATOR_EXTENT / 2 ** z
+    minx = -MERCATOR_EXTENT + x * size
+    maxy = MERCATOR_EXTENT - y * size
+
+    return minx, maxy - size, minx + size, maxy
+
+
+def get_raster_info(path):
+    """Gets EPSG code and bounds of a raster file for displaying it on a
+    Leaflet map.
+
+    :param path: Full path of the raster file. [str]
+
+    :return epsg: EPSG code of the raster. [str]
+    :return bounds: [[south, west], [north, east]] in EPSG:4326. [list]
+    """
+    data = gdal.Open(path)
+    ulx, xres, _, uly, _, yres = data.GetGeoTransform()
+    lrx = ulx + data.RasterXSize * xres
+    lry = uly + data.RasterYSize * yres
+
+    source = osr.SpatialReference(wkt=data.GetProjection())
+    source.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    epsg = str(source.GetAttrValue('AUTHORITY', 1))
+    data = None
+
+    target = osr.SpatialReference()
+    target.ImportFromEPSG(4326)
+    target.SetAxisMappingStrategy(osr.OAMS_TRADITIONAL_GIS_ORDER)
+    transform = osr.CoordinateTransformation(source, target)
+
+    corners = [transform.TransformPoint(cx, cy)[:2]
+               for cx in (ulx, lrx) for cy in (uly, lry)]
+    lngs = [c[0] for c in corners]
+    lats = [c[1] for c in corners]
+
+    return epsg, [[min(lats), min(lngs)], [max(lats), max(lngs)]]
+
+
+def _get_color_table(band):
+    """Gets the color table of a raster band as lookup table. Falls back to
+    viridis if the band doesn't have a color table.
+    """
+    ct = band.GetColorTable()
+    if ct is None:
+        return VIRIDIS.copy()
+
+    lut = np.zeros((256, 4), dtype=np.uint8)
+    for i in range(min(ct.GetCount(), 256)):
+        lut[i] = ct.GetColorEntry(i)
+
+    return lut
@@ -0,0 +1,182 @@
+from config import Data, Watcher
+from ingest_fun import ingest_worker
+
+import os
+import re
+import time
+import threading
+
+## watchdog is optional. Without it, the data directory is polled.
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:
+    Observer = None
+    FileSystemEventHandler = object
+
+
+class DataWatcher(object):
+    """Watches the data directory for new, changed or removed GeoTIFF files
+    and ingests them (see IngestWorker in ingest_fun.py) without restarting
+    the webapp. Bursts of changes are collected until no new changes were
+    noticed for 'debounce' seconds. Files are only ingested once their size
+    and modification time haven't changed between two checks, so files
+    that are still being copied are ingested later.
+    """
+
+    def __init__(self, path=None, debounce=None, poll_interval=None,
+                 worker=None):
+        if path is None:
+            path = Data.path
+        if debounce is None:
+            debounce = Watcher.debounce
+        if poll_interval is None:
+            poll_interval = Watcher.poll_interval
+        if worker is None:
+            worker = ingest_worker
+
+        self.path = path
+        self.debounce = debounce
+        self.poll_interval = poll_interval
+        self.worker = worker
+        self.lock = threading.Lock()
+        self._pending = {}  # file -> (size, mtime) at the last check
+        self._last_change = 0
+        self._known = None
+        self._observer = None
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self):
+        """Starts watching the data directory. Uses inotify (or the native
+        API of the OS) if watchdog is installed, polling otherwise.
+        """
+        if self._thread is not None:
+            return
+
+        if Observer is not None:
+            self._observer = Observer()
+            self._observer.schedule(_EventHandler(self), self.path,
+                                    recursive=False)
+            self._observer.start()
+            print(f"~~ Watching {self.path} for new scenes (watchdog)")
+        else:
+            self._known = self._scan()
+            print(f"~~ Watching {self.path} for new scenes (polling every "
+                  f"{self.poll_interval} s)")
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name='watcher')
+        self._thread.start()
+
+    def stop(self):
+        """Stops watching the data directory."""
+        self._stop.set()
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+            self._observer = None
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def notify(self, path):
+        """Registers a changed file, which will be ingested once it's
+        complete.
+
+        :param path: Full path of the file. [str]
+        """
+        if not _is_scene(path):
+            return
+
+        with self.lock:
+            self._pending.setdefault(os.path.abspath(path), None)
+            self._last_change = time.time()
+
+    def _run(self):
+        ## Pending files are checked every second (or with every scan of the
+        ## data directory if it is polled)
+        interval = 1 if self._observer is not None else self.poll_interval
+
+        while not self._stop.wait(interval):
+            if self._observer is None:
+                self._poll()
+            self._check()
+
+    def _poll(self):
+        current = self._scan()
+        for path in set(current) | set(self._known):
+            if current.get(path) != self._known.get(path):
+                self.notify(path)
+        self._known = current
+
+    def _scan(self):
+        files = {}
+        for f in os.listdir(self.path):
+            path = os.path.join(self.path, f)
+            if _is_scene(path):
+                files[path] = _get_stat(path)
+        return files
+
+    def _check(self):
+        with self.lock:
+            if len(self._pending) == 0:
+                return
+            if time.time() - self._last_change < self.debounce:
+                return
+
+            ## Files are complete if they haven't changed since the last
+            ## check (removed files are always complete)
+            ready = []
+            for path, stat in self._pending.items():
+                current = _get_stat(path)
+                if current is None or current == stat:
+                    ready.append(path)
+                else:
+                    self._pending[path] = current
+
+            if len(ready) == 0:
+                return
+
+            ## Files stay pending if an ingestion is running already
+            if not self.worker.start(scenes=ready):
+                return
+
+            for path in ready:
+                del self._pending[path]
+
+        print(f"~~ The watcher noticed {len(ready)} new, changed or removed "
+              f"files, which will now be ingested.")
+
+
+class _EventHandler(FileSystemEventHandler):
+    """Passes events of watchdog to the DataWatcher."""
+
+    def __init__(self, watcher):
+        super().__init__()
+        self.watcher = watcher
+
+    def on_any_event(self, event):
+        if event.is_directory:
+            return
+        self.watcher.notify(event.src_path)
+        if hasattr(event, 'dest_path'):
+            self.watcher.notify(event.dest_path)
+
+
+## Watcher of the data directory (started in routes.py if
+## Watcher.enabled is True)
+data_watcher = DataWatcher()
+
+
+def _is_scene(path):
+    return re.search(r'\.tif$', os.path.basename(path)) is not None
+
+
+def _get_stat(path):
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime